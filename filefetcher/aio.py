@@ -0,0 +1,549 @@
+"""
+Asyncio counterparts of the asset manager and the remote manifest, for applications that run an event loop
+
+Network transfers stream over non-blocking sockets. Everything else that could block the loop for a noticeable time
+    (writing and hashing data, copying files, and updating the local manifest) runs in worker threads.
+"""
+import asyncio
+from concurrent import futures
+import email.parser
+import functools
+import hashlib
+import http.client
+import io
+import logging
+import os
+import ssl
+import time
+import typing as ty
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from . import exceptions, manager, manifest, mirrors, transfer
+
+logger = logging.getLogger(__name__)
+
+# Failures in transit that can be retried (in addition to those of the blocking implementation)
+RETRYABLE_ERRORS = transfer.RETRYABLE_ERRORS + (asyncio.TimeoutError, asyncio.IncompleteReadError)
+
+
+async def _run(func: ty.Callable, *args, executor: futures.Executor = None, **kwargs):
+    """Run a blocking function in a worker thread"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+async def _wait(awaitable, timeout: ty.Optional[float]):
+    if timeout is None:
+        return await awaitable
+    return await asyncio.wait_for(awaitable, timeout)
+
+
+class AsyncResponse:
+    """A streaming HTTP response, read from an asyncio stream. Close it (or use `async with`) when done."""
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, status: int, reason: str,
+                 headers: http.client.HTTPMessage, timeout: ty.Optional[float]):
+        self._reader = reader
+        self._writer = writer
+        self._timeout = timeout
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+
+        self._chunked = 'chunked' in headers.get('Transfer-Encoding', '').lower()
+        length = headers.get('Content-Length')
+        self._remaining = None  # type: ty.Optional[int]
+        if status in (204, 304):
+            self._remaining = 0
+        elif length is not None and not self._chunked:
+            self._remaining = int(length)
+        self._chunk_left = 0
+        self._eof = False
+
+    def getcode(self) -> int:
+        return self.status
+
+    async def read(self, amt: int = -1) -> bytes:
+        """Read up to `amt` bytes of the body (or all of it). Returns an empty string at the end of the body."""
+        if amt is None or amt < 0:
+            parts = []
+            while True:
+                data = await self.read(transfer.CHUNK_SIZE)
+                if not data:
+                    return b''.join(parts)
+                parts.append(data)
+
+        if self._eof:
+            return b''
+        if self._chunked:
+            data = await self._read_chunk(amt)
+        elif self._remaining is not None:
+            data = b''
+            if self._remaining:
+                data = await _wait(self._reader.read(min(amt, self._remaining)), self._timeout)
+                if not data:
+                    raise http.client.IncompleteRead(b'', self._remaining)
+                self._remaining -= len(data)
+        else:
+            data = await _wait(self._reader.read(amt), self._timeout)
+
+        if not data:
+            self._eof = True
+            self.close()
+        return data
+
+    async def _read_chunk(self, amt: int) -> bytes:
+        if self._chunk_left == 0:
+            line = await _wait(self._reader.readline(), self._timeout)
+            try:
+                size = int(line.split(b';')[0].strip(), 16)
+            except ValueError:
+                raise http.client.IncompleteRead(line)
+            if size == 0:
+                # Skip any trailers
+                while (await _wait(self._reader.readline(), self._timeout)) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''
+            self._chunk_left = size
+
+        data = await _wait(self._reader.read(min(amt, self._chunk_left)), self._timeout)
+        if not data:
+            raise http.client.IncompleteRead(b'', self._chunk_left)
+        self._chunk_left -= len(data)
+        if self._chunk_left == 0:
+            await _wait(self._reader.readexactly(2), self._timeout)  # The line break after each chunk
+        return data
+
+    def close(self):
+        self._writer.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+
+class _ThreadedResponse:
+    """A blocking `urllib` response (eg for `file://` URLs), read in a worker thread"""
+    def __init__(self, response):
+        self._response = response
+        self.status = response.getcode() or 200  # Non-HTTP URLs have no status code
+        self.headers = response.headers
+
+    def getcode(self) -> int:
+        return self.status
+
+    async def read(self, amt: int = -1) -> bytes:
+        return await _run(self._response.read, amt if amt is not None and amt >= 0 else None)
+
+    def close(self):
+        self._response.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+
+async def open_url(url: str, headers: ty.Optional[dict] = None, timeout: ty.Optional[float] = None,
+                   max_redirects: int = 5):
+    """
+    Open a (streaming) response for the given URL. Like `transfer.open_url`, redirects are followed, and error
+        statuses raise `urllib.error.HTTPError`. Each request uses a new connection.
+    """
+    headers = dict(headers or {})
+    for _ in range(max_redirects + 1):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or transfer.uses_proxy(url):
+            request = urllib.request.Request(url, headers=headers)
+            return _ThreadedResponse(await _run(urllib.request.urlopen, request, timeout=timeout))
+
+        response = await _request(parts, headers, timeout)
+        if 200 <= response.status < 300:
+            return response
+
+        location = response.headers.get('Location')
+        if response.status in transfer.Transport.REDIRECT_CODES and location:
+            response.close()
+            url = urllib.parse.urljoin(url, location)
+            continue
+
+        body = b''
+        if response._remaining is not None and response._remaining <= 2 ** 16:
+            body = await response.read()
+        response.close()
+        raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+    raise urllib.error.HTTPError(url, response.status, 'Too many redirects', response.headers, io.BytesIO())
+
+
+async def _request(parts: urllib.parse.SplitResult, headers: dict, timeout: ty.Optional[float]) -> AsyncResponse:
+    secure = parts.scheme == 'https'
+    host = parts.hostname or ''
+    port = parts.port or (443 if secure else 80)
+    connect_options = {'ssl': ssl.create_default_context(), 'server_hostname': host} if secure else {}
+    reader, writer = await _wait(asyncio.open_connection(host, port, **connect_options), timeout)
+
+    try:
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        request_headers = {'Host': parts.netloc.rsplit('@', 1)[-1], 'Accept-Encoding': 'identity',
+                           'Connection': 'close'}
+        request_headers.update(headers)
+        lines = ['GET {} HTTP/1.1'.format(path)] + ['{}: {}'.format(k, v) for k, v in request_headers.items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await _wait(writer.drain(), timeout)
+
+        status_line = (await _wait(reader.readline(), timeout)).decode('latin-1').rstrip('\r\n')
+        status_parts = status_line.split(' ', 2)
+        if len(status_parts) < 2 or not status_parts[0].startswith('HTTP/') or not status_parts[1].isdigit():
+            raise http.client.BadStatusLine(status_line)
+
+        header_lines = []
+        while True:
+            line = await _wait(reader.readline(), timeout)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            header_lines.append(line)
+        response_headers = email.parser.Parser(_class=http.client.HTTPMessage).parsestr(
+            b''.join(header_lines).decode('iso-8859-1'))
+    except BaseException:
+        writer.close()
+        raise
+
+    reason = status_parts[2] if len(status_parts) > 2 else ''
+    return AsyncResponse(reader, writer, int(status_parts[1]), reason, response_headers, timeout)  # type: ignore
+
+
+async def fetch_file(url: str, dest: str, sha256: str, *, chunk_size: int = transfer.CHUNK_SIZE,
+                     timeout: ty.Optional[float] = None, retries: int = 3,
+                     backoff: float = 1.0) -> transfer.TransferResult:
+    """
+    Async counterpart of `transfer.fetch_file`: stream a file into a `.part` file, resuming and retrying as needed,
+        and rename it into place once the hash has been validated.
+
+    Data is written and hashed in a worker thread, so the event loop is never blocked. If the download is cancelled,
+        the `.part` file is removed.
+    """
+    part = transfer._PartialFile(transfer.get_part_path(dest))
+    result = transfer.TransferResult()
+    # All file operations for this download go through one thread, in order (so cleanup always comes last)
+    file_io = futures.ThreadPoolExecutor(max_workers=1)
+    try:
+        while True:
+            try:
+                await _stream_to_part(url, part, result, chunk_size, timeout, file_io)
+            except urllib.error.HTTPError as e:
+                if e.code not in transfer.RETRY_STATUS_CODES or result.n_retries >= retries:
+                    raise exceptions.DownloadError('Could not download {}: {}'.format(url, e))
+                await _wait_to_retry(url, e, result, backoff)
+                continue
+            except RETRYABLE_ERRORS as e:
+                if not part.resumable:
+                    await _run(part.reset, executor=file_io)
+                if result.n_retries >= retries:
+                    raise exceptions.DownloadError('Could not download {}: {}'.format(url, e))
+                await _wait_to_retry(url, e, result, backoff)
+                continue
+
+            if part.shasum.hexdigest() == sha256:
+                break
+
+            await _run(part.reset, executor=file_io)
+            if result.n_resumed:
+                # The partial data kept from an earlier attempt may itself have been bad. Start over, exactly once.
+                logger.warning('Resumed download of {} failed validation; restarting from the beginning'.format(url))
+                result.n_resumed = 0
+                continue
+            raise exceptions.IntegrityError
+
+        await _run(os.replace, part.path, dest, executor=file_io)
+    except asyncio.CancelledError:
+        # Unlike an interrupted blocking download, a cancelled one is not resumed later
+        await _run(transfer._discard, part.path, executor=file_io)
+        raise
+    finally:
+        file_io.shutdown(wait=False)
+
+    logger.debug('Downloaded {} bytes from {} ({} resumed)'.format(result.n_bytes, url, result.n_resumed))
+    return result
+
+
+async def _stream_to_part(url: str, part: transfer._PartialFile, result: transfer.TransferResult, chunk_size: int,
+                          timeout: ty.Optional[float], file_io: futures.Executor):
+    """Make one attempt to fetch the rest of the file, appending to any data already present"""
+    offset = part.current_size() if part.resumable else 0
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+    try:
+        response = await open_url(url, headers=headers, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code == 416 and offset:
+            # Range not satisfiable: the part file already holds the whole body (or is garbage, as the hash will tell)
+            e.close()
+            await _run(part.sync_hash, offset, executor=file_io)
+            result.n_resumed += offset
+            return
+        raise
+
+    async with response:
+        status = response.getcode()
+        if offset and status == 206 and transfer.parse_content_range(response.headers.get('Content-Range')) == offset:
+            await _run(part.sync_hash, offset, executor=file_io)
+            result.n_resumed += offset
+            mode = 'ab'
+        else:
+            # Servers that ignore the Range header send the full body; start over
+            part.shasum = hashlib.sha256()
+            part.n_hashed = 0
+            mode = 'wb'
+            part.resumable = response.headers.get('Accept-Ranges', '').lower() == 'bytes' or status == 206
+
+        expected = response.headers.get('Content-Length')
+        n_received = 0
+        f = await _run(open, part.path, mode, executor=file_io)
+        try:
+            while True:
+                chunk = await response.read(chunk_size)
+                if not chunk:
+                    break
+                await _run(_write_and_hash, f, part, chunk, executor=file_io)
+                n_received += len(chunk)
+            await _run(_flush, f, executor=file_io)
+        finally:
+            await _run(f.close, executor=file_io)
+        result.n_bytes += n_received
+
+    if expected is not None and n_received < int(expected):
+        raise http.client.IncompleteRead(b'', int(expected) - n_received)
+
+
+def _write_and_hash(f: ty.BinaryIO, part: transfer._PartialFile, chunk: bytes):
+    f.write(chunk)
+    part.shasum.update(chunk)
+    part.n_hashed += len(chunk)
+
+
+def _flush(f: ty.BinaryIO):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+async def _wait_to_retry(url: str, error: Exception, result: transfer.TransferResult, backoff: float):
+    delay = backoff * 2 ** result.n_retries
+    result.n_retries += 1
+    logger.warning('Download of {} failed ({}); retry {} in {:.1f}s'.format(url, error, result.n_retries, delay))
+    await asyncio.sleep(delay)
+
+
+class AsyncRemoteManifest(manifest.RemoteManifest):
+    """
+    A remote manifest that can also be loaded without blocking the event loop (see `load_async`). The cached copy,
+        conditional requests, and mirror failover work the same way as for a blocking `load`.
+    """
+    def __init__(self, *args, **kwargs):
+        super(AsyncRemoteManifest, self).__init__(*args, **kwargs)
+        self._load_task = None  # type: ty.Optional[asyncio.Future]
+
+    def __getstate__(self):
+        # A load in progress belongs to one event loop, and is not copied
+        state = super(AsyncRemoteManifest, self).__getstate__()
+        state['_load_task'] = None
+        return state
+
+    async def load_async(self):
+        """Load the manifest. Concurrent callers share a single request."""
+        if self._loaded:
+            return
+        if self._load_task is None:
+            self._load_task = asyncio.ensure_future(self._load())
+        try:
+            await asyncio.shield(self._load_task)
+        finally:
+            if self._load_task is not None and self._load_task.done():
+                self._load_task = None
+
+    async def _load(self):
+        cached_meta = await _run(self._read_cache_meta)
+        data = await _run(self._fresh_cache, cached_meta)
+        if data is None:
+            data = await self._fetch_async(cached_meta)
+        if not self._loaded:
+            self.load(data)
+
+    async def _fetch_async(self, cached_meta: ty.Optional[dict]) -> dict:
+        error = None  # type: ty.Optional[Exception]
+        for url in await _run(self.mirrors.ranked):
+            start = time.monotonic()
+            try:
+                async with await open_url(url, headers=self._request_headers(cached_meta, url)) as response:
+                    body = await response.read()
+                self.mirrors.record(url, time.monotonic() - start)
+                return await _run(self._accept, cached_meta, url, body, response.headers)
+            except urllib.error.HTTPError as e:
+                e.close()
+                if e.code == 304 and cached_meta:
+                    return await _run(self._accept, cached_meta, url, None, None)
+                error = e
+            except RETRYABLE_ERRORS as e:
+                error = e
+            self.mirrors.record_failure(url)
+            logger.info('Mirror {} failed ({}); trying the next one'.format(url, error))
+
+        if isinstance(error, urllib.error.HTTPError):
+            raise exceptions.ManifestNotFound
+        return await _run(self._offline, cached_meta, error)
+
+
+class _Manager(manager.AssetManager):
+    remote_manifest_class = AsyncRemoteManifest
+
+
+class AsyncAssetManager:
+    """
+    Locate and download assets from async code. Accepts the same options as `AssetManager`, which is available (for
+        blocking operations such as builds) as the `manager` attribute.
+
+    At most `max_concurrency` downloads run at once. Concurrent requests for the same asset share a single download,
+        which is cancelled (and its partial file removed) only if every caller waiting on it is cancelled.
+    """
+    def __init__(self, library_name: str, remote_url: ty.Union[str, ty.Sequence[str]], local_manifest: str = None,
+                 *, max_concurrency: int = 4, **kwargs):
+        self.manager = _Manager(library_name, remote_url, local_manifest, **kwargs)  # type: manager.AssetManager
+        self._max_concurrency = max_concurrency
+        # Created on first use, so that they belong to the running event loop
+        self._semaphore = None  # type: ty.Optional[asyncio.Semaphore]
+        # Downloads in progress (by asset file name), and how many callers are waiting for each
+        self._in_flight = {}  # type: ty.Dict[str, asyncio.Future]
+        self._n_waiting = {}  # type: ty.Dict[asyncio.Future, int]
+
+    @property
+    def _remote(self) -> AsyncRemoteManifest:
+        return self.manager._remote  # type: ignore
+
+    async def locate(self, item_type, auto_build=None, auto_fetch=None, **kwargs) -> str:
+        """
+        Find an asset in the local store, and optionally, download (or build) it
+
+        Return the (local) path to the asset at the end of this process
+        """
+        auto_build = auto_build if auto_build is not None else self.manager._auto_build
+        auto_fetch = auto_fetch if auto_fetch is not None else self.manager._auto_fetch
+
+        def find() -> str:
+            return self.manager.locate(item_type, auto_build=False, auto_fetch=False, **kwargs)
+
+        try:
+            # Usually a lookup in memory, but this may wait for a lock, or copy a file from a shared cache
+            return await _run(find)
+        except (exceptions.NoMatchingAsset, exceptions.ManifestNotFound) as e:
+            if not auto_fetch and not auto_build:
+                raise e
+
+        if auto_fetch:
+            try:
+                record = await self.download(item_type, **kwargs)
+                return self.manager._local.get_path(record)
+            except exceptions.ImmutableManifestError:
+                # Another process downloaded the asset while we were waiting for it
+                return await _run(find)
+            except exceptions.BaseAssetException as e:
+                if not auto_build:
+                    raise e
+
+        record = await _run(self.manager.build, item_type, **kwargs)
+        return self.manager._local.get_path(record)
+
+    async def download(self, item_type, **kwargs) -> dict:
+        """Fetch a file from the remote repository to the local cache directory, and update the local manifest"""
+        await self._remote.load_async()
+        remote_record = self._remote.locate(item_type, **kwargs)
+
+        key = remote_record['_path']
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._download_record(remote_record))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await self._join(task)
+
+    async def download_many(self, queries: ty.Iterable[dict]) -> ty.List[manager.TaskResult]:
+        """
+        Download several assets concurrently (up to `max_concurrency` at a time). A failure to fetch one asset does not
+            stop the others: the result for each query reports the new local record, or the exception that was raised.
+        """
+        async def fetch_one(query: dict) -> manager.TaskResult:
+            item_type, tags = manager._split_query(query)
+            try:
+                record = await self.download(item_type, **tags)
+            except Exception as e:
+                logger.debug('Failed to download asset {}: {!r}'.format(item_type, e))
+                return manager.TaskResult(item_type, tags, error=e)
+            return manager.TaskResult(item_type, tags, record=record)
+
+        return list(await asyncio.gather(*[fetch_one(query) for query in queries]))
+
+    async def _join(self, task: asyncio.Future) -> dict:
+        """Wait for a shared download. The download is only cancelled if every caller waiting for it is cancelled."""
+        self._n_waiting[task] = self._n_waiting.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._n_waiting[task] == 1 and not task.done():
+                task.cancel()
+            raise
+        finally:
+            self._n_waiting[task] -= 1
+            if not self._n_waiting[task]:
+                del self._n_waiting[task]
+
+    async def _download_record(self, remote_record: dict) -> dict:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+
+        async with self._semaphore:
+            # Other processes may be downloading the same file (see `AssetManager._download_record`)
+            lock = self.manager._named_lock(remote_record['_path'])
+            waited = await self._acquire(lock)
+            try:
+                existing = await _run(self.manager._check_new_download, remote_record, waited=waited)
+                if existing is not None:
+                    return existing
+                dest = self.manager._local.get_path(remote_record)
+                if not await _run(self.manager._place_without_network, remote_record['_sha256'], dest):
+                    await self._fetch_from_mirrors(remote_record, dest)
+                return await _run(self.manager._record_download, remote_record, dest)
+            finally:
+                lock.release()
+
+    async def _acquire(self, lock) -> bool:
+        """Acquire a file lock without blocking the event loop. Returns whether the lock was held by someone else."""
+        deadline = None if lock.timeout is None else time.monotonic() + lock.timeout
+        waited = False
+        while not lock.acquire(blocking=False):
+            if deadline is not None and time.monotonic() >= deadline:
+                raise exceptions.LockTimeout('Timed out waiting for lock: {}'.format(lock.path))
+            waited = True
+            await asyncio.sleep(lock.poll_interval)
+        return waited
+
+    async def _fetch_from_mirrors(self, remote_record: dict, dest: str) -> transfer.TransferResult:
+        """Download from the fastest mirror, failing over to the others (see `AssetManager._fetch_from_mirrors`)"""
+        mirror_set = self._remote.mirrors
+        error = None  # type: ty.Optional[BaseException]
+        for mirror_url in await _run(mirror_set.ranked):
+            url = self._remote.get_mirror_path(mirror_url, remote_record)
+            start = time.monotonic()
+            try:
+                stats = await fetch_file(url, dest, remote_record['_sha256'], timeout=self.manager._transport.timeout,
+                                         retries=self.manager._retries, backoff=self.manager._retry_backoff)
+            except mirrors.MIRROR_ERRORS as e:
+                mirror_set.record_failure(mirror_url)
+                logger.info('Mirror {} failed ({}); trying the next one'.format(mirror_url, e))
+                error = e
+                continue
+            mirror_set.record(mirror_url, time.monotonic() - start, stats.n_bytes)
+            return stats
+        raise error  # type: ignore
@@ -0,0 +1,187 @@
+"""
+A content-addressed store of asset files, shared by every package that uses the same asset root directory
+
+Packages keep their own manifest and their own `<sha256>_<basename>` file for each asset, but that file is a hardlink
+    to a single blob (named by its sha256). When two packages need the same reference file, it is downloaded and
+    stored only once.
+
+Each package copy that uses a blob leaves a reference marker next to it. A blob is deleted when the last reference is
+    released, so one package can evict an asset without affecting the others.
+
+Since every copy of a blob is a hardlink, a package file that is modified in place damages the blob as well. Before a
+    blob is handed out, its size and modification time are checked against those recorded when it was last known to be
+    good, and if they differ, the blob is re-hashed. A damaged blob is deleted, so that the asset is downloaded again.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import typing as ty
+
+from . import locking, util
+
+logger = logging.getLogger(__name__)
+
+
+class BlobStore:
+    """
+    Blobs are stored as `<root>/.blobs/<sha[:2]>/<sha256>`. References to a blob are marker files in the folder
+        `<sha256>.refs/`, one per package copy (each marker records the path of the copy that it represents). The
+        fingerprint of a verified blob is stored as `<sha256>.verified`.
+    """
+    def __init__(self, root: str, lock_timeout: float = None):
+        self.root = str(root)
+        self._base_path = os.path.join(self.root, '.blobs')
+        self._lock_timeout = lock_timeout
+
+    def get_path(self, sha256: str) -> str:
+        return os.path.join(self._base_path, sha256[:2], sha256)
+
+    def has(self, sha256: str) -> bool:
+        return os.path.isfile(self.get_path(sha256))
+
+    def refcount(self, sha256: str) -> int:
+        try:
+            return len(os.listdir(self._refs_dir(sha256)))
+        except FileNotFoundError:
+            return 0
+
+    def get(self, sha256: str, dest_path: str) -> bool:
+        """
+        Place a copy of a blob at `dest_path` (a hardlink where possible), and record a reference to it
+
+        :return: False if the store has no (intact) blob with this hash
+        """
+        with self._lock(sha256):
+            blob_path = self.get_path(sha256)
+            if not os.path.isfile(blob_path):
+                return False
+            if not self._verify(sha256):
+                logger.warning('Blob does not match its hash, and will be deleted: {}'.format(sha256))
+                self._delete(sha256)
+                return False
+            self._link(blob_path, dest_path, sha256)
+            self._add_ref(sha256, dest_path)
+        return True
+
+    def put(self, path: str, sha256: str):
+        """Add a file (already verified to match `sha256`) to the store, and record that `path` refers to it"""
+        with self._lock(sha256):
+            blob_path = self.get_path(sha256)
+            if not os.path.isfile(blob_path):
+                self._link(path, blob_path, sha256)
+                self._write_fingerprint(sha256)
+            self._add_ref(sha256, path)
+
+    def release(self, sha256: str, path: str):
+        """Remove the reference from one copy of a blob. The blob is deleted when nothing refers to it any more."""
+        with self._lock(sha256):
+            _remove_quietly(self._ref_path(sha256, path))
+            if self.refcount(sha256) == 0:
+                self._delete(sha256)
+
+    def discard(self, sha256: str):
+        """Delete a (damaged) blob, regardless of references. Existing copies are left in place."""
+        with self._lock(sha256):
+            self._delete(sha256)
+
+    def prune(self) -> ty.List[str]:
+        """
+        Drop references to package copies that no longer exist (eg a package cache folder was deleted by hand), and
+            delete any blobs that are no longer referenced
+
+        :return: The hashes of the deleted blobs
+        """
+        removed = []
+        if not os.path.isdir(self._base_path):
+            return removed
+        for prefix in os.listdir(self._base_path):
+            prefix_dir = os.path.join(self._base_path, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                if '.' in name:
+                    # Reference folders, lock files, and temporary files
+                    continue
+                with self._lock(name):
+                    for marker in self._list_refs(name):
+                        with open(marker, 'r') as f:
+                            target = f.read()
+                        if not os.path.exists(target):
+                            _remove_quietly(marker)
+                    if self.refcount(name) == 0:
+                        self._delete(name)
+                        removed.append(name)
+        return removed
+
+    def _verify(self, sha256: str) -> bool:
+        """Check that a blob is intact: cheaply if it is unchanged since the last check, and by re-hashing if not"""
+        try:
+            with open(self._fingerprint_path(sha256), 'r') as f:
+                expected = json.load(f)
+        except (OSError, ValueError):
+            expected = None
+        if expected is not None and expected == self._fingerprint(sha256):
+            return True
+        if util.get_file_sha256(self.get_path(sha256)) != sha256:
+            return False
+        self._write_fingerprint(sha256)
+        return True
+
+    def _fingerprint(self, sha256: str) -> list:
+        stat = os.stat(self.get_path(sha256))
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def _write_fingerprint(self, sha256: str):
+        util.write_atomic(self._fingerprint_path(sha256), json.dumps(self._fingerprint(sha256)))
+
+    def _fingerprint_path(self, sha256: str) -> str:
+        return self.get_path(sha256) + '.verified'
+
+    def _refs_dir(self, sha256: str) -> str:
+        return self.get_path(sha256) + '.refs'
+
+    def _ref_path(self, sha256: str, path: str) -> str:
+        digest = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+        return os.path.join(self._refs_dir(sha256), digest)
+
+    def _list_refs(self, sha256: str) -> ty.List[str]:
+        refs_dir = self._refs_dir(sha256)
+        try:
+            return [os.path.join(refs_dir, name) for name in os.listdir(refs_dir)]
+        except FileNotFoundError:
+            return []
+
+    def _add_ref(self, sha256: str, path: str):
+        os.makedirs(self._refs_dir(sha256), exist_ok=True)
+        util.write_atomic(self._ref_path(sha256, path), os.path.abspath(path))
+
+    def _delete(self, sha256: str):
+        logger.debug('Deleting unreferenced blob: {}'.format(sha256))
+        _remove_quietly(self.get_path(sha256))
+        _remove_quietly(self._fingerprint_path(sha256))
+        shutil.rmtree(self._refs_dir(sha256), ignore_errors=True)
+
+    def _lock(self, sha256: str) -> locking.FileLock:
+        os.makedirs(os.path.dirname(self.get_path(sha256)), exist_ok=True)
+        return locking.FileLock(self.get_path(sha256) + '.lock', timeout=self._lock_timeout)
+
+    @staticmethod
+    def _link(src_path: str, dest_path: str, sha256: str):
+        """Link (or if the filesystem doesn't allow it, copy) a file into place, without exposing a partial file"""
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        temp_path = '{}.{}.link'.format(dest_path, os.getpid())
+        try:
+            util.copy_file_hashed(src_path, temp_path, sha256=sha256, allow_link=True)
+            os.replace(temp_path, dest_path)
+        except BaseException:
+            _remove_quietly(temp_path)
+            raise
+
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
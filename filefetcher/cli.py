@@ -6,7 +6,7 @@ from pprint import pprint as pp
 import sys
 import typing as ty
 
-from . import exceptions, manager
+from . import exceptions, manager, requirements, server
 
 
 class AssetCLI:
@@ -31,6 +31,8 @@ class AssetCLI:
 
         parser.add_argument('--local', nargs='?', default=None, help='Base path for the local cache directory')
         parser.add_argument('--remote', nargs='?', default=None, help='Base URL for downloading pre-built assets')
+        parser.add_argument('--shared', action='append', default=None,
+                            help='Manifest of a read-only cache to check before downloading (repeatable)')
         # parser.add_argument('-y', '--yes', help='Automatic yes to prompts; run non-interactively')
 
         subparsers = parser.add_subparsers(dest='cmd', help='Several sub-commands are available')
@@ -48,13 +50,66 @@ class AssetCLI:
         download_parser.set_defaults(func=self.download_command)
         download_parser.add_argument('--no-update', dest='no_update', default=False, action='store_true',
                                      help='Skip downloading of assets that already exist locally')
+        download_parser.add_argument('--jobs', type=int, default=1,
+                                     help='Number of assets to download concurrently')
+        download_parser.add_argument('--from-file', dest='from_file', default=None,
+                                     help='Download the assets listed in a requirements file (JSON or TOML)')
+        download_parser.add_argument('--latest', default=False, action='store_true',
+                                     help='Only download the newest version of each asset')
+        download_parser.add_argument('--group-by', dest='group_by', action='append', default=None,
+                                     help='A tag that identifies versions of the same asset (repeatable)')
+        download_parser.add_argument('--dry-run', dest='dry_run', default=False, action='store_true',
+                                     help='Show what would be downloaded (and how many bytes), without downloading')
+
+        sync_parser = subparsers.add_parser('sync', help='Download remote assets that are missing from the local cache')
+        sync_parser.set_defaults(func=self.sync_command)
+        sync_parser.add_argument('--latest', default=False, action='store_true',
+                                 help='Only download the newest version of each asset')
+        sync_parser.add_argument('--group-by', dest='group_by', action='append', default=None,
+                                 help='A tag that identifies versions of the same asset (may be given more than once)')
+        sync_parser.add_argument('--jobs', type=int, default=4, help='Number of assets to download concurrently')
+        sync_parser.add_argument('--dry-run', dest='dry_run', default=False, action='store_true',
+                                 help='Show what would be downloaded, without downloading anything')
 
         build_parser = subparsers.add_parser('build', help='Build the specified assets from a recipe')
         add_common(build_parser)
         build_parser.set_defaults(func=self.build_command)
+        build_parser.add_argument('--jobs', type=int, default=1,
+                                  help='Number of recipes to run concurrently (each in its own process)')
+
+        verify_parser = subparsers.add_parser('verify', help='Check the integrity of all assets in the local cache')
+        verify_parser.set_defaults(func=self.verify_command)
+        verify_parser.add_argument('--quick', default=False, action='store_true',
+                                   help='Only check file sizes and modification times, rather than hashing every file')
+        verify_parser.add_argument('--jobs', type=int, default=4, help='Number of files to hash concurrently')
+        verify_parser.add_argument('--repair', choices=['quarantine', 'redownload'], default=None,
+                                   help='Move damaged assets out of the cache, and optionally download them again')
+
+        gc_parser = subparsers.add_parser('gc', help='Remove old or rarely used assets from the local cache')
+        gc_parser.set_defaults(func=self.gc_command)
+        gc_parser.add_argument('--max-size', dest='max_size', type=_parse_size, default=None,
+                               help='Evict the least recently used assets until the cache fits, eg "500M" or "20G"')
+        gc_parser.add_argument('--keep', type=int, default=None,
+                               help='Keep only this many of the newest versions of each asset')
+        gc_parser.add_argument('--group-by', dest='group_by', action='append', default=None,
+                               help='A tag that identifies versions of the same asset (may be given more than once)')
+        gc_parser.add_argument('--dry-run', dest='dry_run', default=False, action='store_true',
+                               help='Show what would be removed, without removing anything')
+
+        serve_parser = subparsers.add_parser('serve', help='Serve the local cache over HTTP, as a remote for peers')
+        serve_parser.set_defaults(func=self.serve_command)
+        serve_parser.add_argument('--bind', default='127.0.0.1',
+                                  help='Address to listen on (use 0.0.0.0 to accept connections from other hosts)')
+        serve_parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+
         return parser.parse_args()
 
     def _validate_common(self, args):
+        if getattr(args, 'from_file', None):
+            if args.all or args.type is not None or args.tag:
+                sys.exit('Option "--from-file" cannot be combined with "--all", "--type", or "--tag"')
+            return
+
         single_item = args.type is not None
         if args.all and single_item:
             sys.exit('Options "--all" and "--type" are mutually exclusive')
@@ -69,9 +124,24 @@ class AssetCLI:
         if args.remote:
             self._manager.set_remote_manifest(args.remote)
 
+        if args.shared:
+            self._manager.set_shared_caches(args.shared)
+
     def _get_matching_records(self, args, manifest) -> ty.List[dict]:
         """Get one or more matching records"""
-        if args.all:
+        if getattr(args, 'from_file', None):
+            try:
+                queries = requirements.load(args.from_file)
+            except exceptions.InvalidRequirements as e:
+                sys.exit(str(e))
+            records = []
+            for query in queries:
+                item_type, tags = manager._split_query(query)
+                try:
+                    records.append(manifest.locate(item_type, **tags))
+                except exceptions.NoMatchingAsset:
+                    sys.exit('No matching item found for requirement: {}'.format(query))
+        elif args.all:
             records = manifest._items  # type: ty.List[dict]
         else:
             tags = dict(args.tag or [])
@@ -125,19 +195,67 @@ class AssetCLI:
         if not len(records):
             sys.exit("No matching items found.")
 
-        for record in records:
-            try:
-                self._manager.download(record['_type'], **record)
-                print('Successfully downloaded file: {}'.format(record['_path']))
-            except exceptions.ImmutableManifestError as e:
-                if args.no_update:
-                    print('Asset already exists; will not download: {}'.format(record['_path']))
-                else:
-                    raise e
-
-        if len(records) > 1:
+        # Skip superseded versions, and fetch each distinct file only once
+        plan = self._manager.plan_download(records, latest=args.latest, group_by=args.group_by,
+                                           skip_existing=args.no_update)
+        for record in plan.existing:
+            print('Asset already exists; will not download: {}'.format(record['_path']))
+
+        if args.dry_run:
+            for record in plan.transfers:
+                print('Download: {} ({} bytes)'.format(record['_path'], record.get('_size') or 'unknown'))
+            for record in plan.copies:
+                print('Copy from local cache: {}'.format(record['_path']))
+            print('Matched {} assets ({} bytes). Plan: {} assets to add; {} bytes to download.'.format(
+                len(records), plan.n_bytes_requested, len(plan.records), plan.n_bytes))
+            return
+
+        n_failed = 0
+        n_resumed = 0
+        for result in self._manager.sync(plan=plan, max_workers=args.jobs):
+            if result.ok:
+                print('Successfully downloaded file: {}'.format(result.record['_path']))
+                if result.transfer.n_resumed:
+                    n_resumed += result.transfer.n_resumed
+                    print('    Resumed an interrupted download; saved {} bytes'.format(result.transfer.n_resumed))
+            else:
+                n_failed += 1
+                print('Could not download {} ({}): {}'.format(
+                    result.item_type, result.tags.get('_path', ''), result.error))
+
+        if n_resumed:
+            print('Resuming interrupted downloads saved a total of {} bytes'.format(n_resumed))
+
+        if n_failed:
+            sys.exit('{} of {} assets could not be downloaded.'.format(n_failed, len(plan.records)))
+
+        if len(plan.records) > 1:
             print('All files successfully downloaded. Thank you.')
 
+    def sync_command(self, args):
+        """
+        Bring the local cache up to date with the remote, fetching only what is missing
+        """
+        self._set_manifests(args)
+
+        plan = self._manager.plan_sync(latest=args.latest, group_by=args.group_by)
+        for record in plan.transfers:
+            print('Download: {} ({} bytes)'.format(record['_path'], record.get('_size') or 'unknown'))
+        for record in plan.copies:
+            print('Copy from local cache: {}'.format(record['_path']))
+        print('{} assets to add; {} bytes to download.'.format(len(plan.records), plan.n_bytes))
+
+        if args.dry_run or not plan.records:
+            return
+
+        results = self._manager.sync(plan=plan, max_workers=args.jobs)
+        failed = [result for result in results if not result.ok]
+        for result in failed:
+            print('Could not download {} ({}): {}'.format(result.item_type, result.tags.get('_path', ''), result.error))
+        if failed:
+            sys.exit('{} of {} assets could not be downloaded.'.format(len(failed), len(results)))
+        print('The local cache is up to date.')
+
     def build_command(self, args):
         """
         Build one or more assets from the specified recipe
@@ -152,9 +270,80 @@ class AssetCLI:
         if not len(records):
             sys.exit("No matching items found.")
 
-        for record in records:
-            result = self._manager.build(record['_type'], **record)
-            print('The requested asset has been built: {}'.format(result['_path']))
+        # One result for each requested asset (in order), followed by any dependencies that had to be provided first
+        results = self._manager.build_many(records, max_workers=args.jobs)
+        n_failed = 0
+        for i, result in enumerate(results):
+            requested = i < len(records)
+            if result.ok:
+                print('The requested asset has been built: {}'.format(result.record['_path']) if requested
+                      else 'Dependency has been provided: {}'.format(result.record['_path']))
+            else:
+                if requested:
+                    n_failed += 1
+                print('Could not build {} ({}): {}'.format(
+                    result.item_type, result.tags.get('_label', ''), result.error))
+
+        if n_failed:
+            sys.exit('{} of {} requested assets could not be built.'.format(n_failed, len(records)))
 
         if len(records) > 1:
             print('All files have been successfully built. Thank you.')
+
+    def verify_command(self, args):
+        """
+        Check that all assets in the local cache exist and are intact
+        """
+        self._set_manifests(args)
+
+        results = self._manager.verify(quick=args.quick, max_workers=args.jobs, repair=args.repair)
+        damaged = [result for result in results if not result.ok]
+        for result in damaged:
+            print('{}: {}'.format(result.error, result.note or 'not repaired'))
+
+        print('Checked {} assets: {} damaged or missing.'.format(len(results), len(damaged)))
+        if any(result.note != 'downloaded again' for result in damaged):
+            sys.exit(1)
+
+    def gc_command(self, args):
+        """
+        Remove superseded or least recently used assets from the local cache
+        """
+        self._set_manifests(args)
+        if args.max_size is None and args.keep is None:
+            sys.exit('Must specify a limit using `--max-size` and/or `--keep`')
+
+        evicted = self._manager.gc(max_bytes=args.max_size, keep_versions=args.keep, group_by=args.group_by,
+                                   dry_run=args.dry_run)
+        for record in evicted:
+            print('{}: {}'.format('Would remove' if args.dry_run else 'Removed', record['_path']))
+
+        n_bytes = sum(record.get('_size') or 0 for record in evicted)
+        print('{} {} assets ({} bytes).'.format('Would free' if args.dry_run else 'Freed', len(evicted), n_bytes))
+
+    def serve_command(self, args):
+        """
+        Publish the local cache in the layout of a remote manifest, so that other hosts can download from it
+        """
+        self._set_manifests(args)
+
+        httpd = server.serve(self._manager._local, host=args.bind, port=args.port)
+        print('Serving {} at {}'.format(self._manager._local._base_path, httpd.url))
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
+
+
+def _parse_size(value: str) -> int:
+    """Parse a size in bytes, with an optional (binary) unit suffix: eg 1500, 500K, or 20G"""
+    units = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+    value = value.strip().upper().rstrip('B')
+    try:
+        if value and value[-1] in units:
+            return int(float(value[:-1]) * units[value[-1]])
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Invalid size: {}'.format(value))
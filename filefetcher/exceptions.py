@@ -37,3 +37,27 @@ class IntegrityError(BaseAssetException):
 
 class AssetAlreadyExists(BaseAssetException):
     DEFAULT_MESSAGE = 'You already have the newest version of the requested asset'
+
+
+class DownloadError(BaseAssetException):
+    DEFAULT_MESSAGE = 'Could not download the requested asset from the remote location'
+
+
+class LockTimeout(BaseAssetException):
+    DEFAULT_MESSAGE = 'Timed out while waiting for another process to release a lock'
+
+
+class PrefetchTimeout(BaseAssetException):
+    DEFAULT_MESSAGE = 'Timed out while waiting for an asset to be fetched in the background'
+
+
+class DependencyError(BaseAssetException):
+    DEFAULT_MESSAGE = 'Could not build an asset because one of its dependencies could not be provided'
+
+
+class DependencyCycle(DependencyError):
+    DEFAULT_MESSAGE = 'Recipes have a circular dependency'
+
+
+class InvalidRequirements(BaseAssetException):
+    DEFAULT_MESSAGE = 'Could not read the list of required assets'
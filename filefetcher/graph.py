@@ -0,0 +1,80 @@
+"""
+Plan the order in which assets must be built, based on the upstream assets that each recipe depends on
+"""
+import json
+import typing as ty
+
+from . import exceptions
+
+
+class BuildNode:
+    """
+    One step in a build plan: either run a recipe, or (for a dependency that has no recipe) download the asset
+    """
+    def __init__(self, item_type: str, tags: dict, recipe: ty.Optional[dict] = None):
+        self.item_type = item_type
+        self.tags = tags
+        self.recipe = recipe
+
+        self.upstream = []  # type: ty.List[BuildNode]
+        self.downstream = []  # type: ty.List[BuildNode]
+
+    @property
+    def key(self) -> ty.Hashable:
+        """Several queries may resolve to the same recipe, which should only be built once"""
+        if self.recipe is not None:
+            return 'recipe', id(self.recipe)
+        return 'download', json.dumps([self.item_type, self.tags], sort_keys=True, default=str)
+
+    @property
+    def dependencies(self) -> ty.List[dict]:
+        return (self.recipe or {}).get('_depends') or []
+
+    def __repr__(self):
+        return '<BuildNode {} {}>'.format(self.item_type, self.tags)
+
+
+def plan(roots: ty.Iterable[BuildNode],
+         resolve: ty.Callable[[str, dict], ty.Optional[BuildNode]]) -> ty.List[BuildNode]:
+    """
+    Expand the dependencies of the requested nodes into a graph, and return every node in an order where each
+        node comes after all of its upstream dependencies.
+
+    :param roots: The nodes that were requested explicitly
+    :param resolve: Given the query for a dependency, return the node that would provide it. Returns None if the
+        dependency is already satisfied (eg the asset exists locally), in which case it is skipped.
+    :raises DependencyCycle: If any recipe depends (directly or indirectly) on itself. This is checked before any
+        build step is run.
+    """
+    nodes = {}  # type: ty.Dict[ty.Hashable, BuildNode]
+    visiting = []  # type: ty.List[BuildNode]
+    order = []  # type: ty.List[BuildNode]
+
+    def visit(node: BuildNode) -> BuildNode:
+        if node.key in nodes:
+            return nodes[node.key]
+
+        if any(other.key == node.key for other in visiting):
+            cycle = visiting[[other.key for other in visiting].index(node.key):] + [node]
+            raise exceptions.DependencyCycle('Recipes have a circular dependency: {}'.format(
+                ' -> '.join(other.item_type for other in cycle)))
+
+        visiting.append(node)
+        for query in node.dependencies:
+            tags = dict(query)
+            upstream = resolve(tags.pop('_type'), tags)
+            if upstream is None:
+                continue
+            upstream = visit(upstream)
+            if upstream not in node.upstream:
+                node.upstream.append(upstream)
+                upstream.downstream.append(node)
+        visiting.pop()
+
+        nodes[node.key] = node
+        order.append(node)
+        return node
+
+    for root in roots:
+        visit(root)
+    return order
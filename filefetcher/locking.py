@@ -0,0 +1,125 @@
+"""
+Advisory file locks, used to coordinate access to the cache directory between threads and processes
+"""
+import json
+import logging
+import os
+import socket
+import time
+import typing as ty
+
+from . import exceptions
+
+logger = logging.getLogger(__name__)
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None  # type: ignore
+    import msvcrt
+
+
+class FileLock:
+    """
+    An advisory lock based on a lock file.
+
+    Locks are held by the operating system (`flock` on POSIX, `msvcrt.locking` on Windows), so they are released
+        automatically if the holder crashes. Each instance opens its own file handle, which means that two
+        instances conflict even when they belong to the same process. Shared (reader) locks are only supported on
+        POSIX; elsewhere they behave as exclusive locks.
+
+    The holder of an exclusive lock writes its identity into the lock file, and erases it upon release. If the lock
+        is acquired while that information is still present, the previous holder must have crashed: this stale lock
+        is reported (see `stale_owner`) so that callers can clean up after it.
+    """
+    def __init__(self, path: str, timeout: ty.Optional[float] = None, shared: bool = False,
+                 poll_interval: float = 0.05):
+        self.path = str(path)
+        self.timeout = timeout
+        self.shared = shared
+        self.poll_interval = poll_interval
+        self._fd = None  # type: ty.Optional[int]
+        # Identity of a previous holder that exited without releasing the lock (if any)
+        self.stale_owner = None  # type: ty.Optional[dict]
+
+    @property
+    def is_locked(self) -> bool:
+        return self._fd is not None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """
+        Acquire the lock, waiting up to `timeout` seconds (forever if None). Non-blocking calls return False if the
+            lock is held elsewhere; blocking calls raise `LockTimeout` if the lock could not be acquired in time.
+        """
+        if self._fd is not None:
+            raise RuntimeError('Lock is not reentrant: {}'.format(self.path))
+
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        except PermissionError:
+            if not self.shared:
+                raise
+            # A reader may not be allowed to write to an existing lock file. A shared lock works on a read-only handle.
+            fd = os.open(self.path, os.O_RDONLY)
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            if self._try_lock(fd):
+                self._fd = fd
+                if not self.shared:
+                    self._claim(fd)
+                return True
+            if not blocking or (deadline is not None and time.monotonic() >= deadline):
+                os.close(fd)
+                if not blocking:
+                    return False
+                raise exceptions.LockTimeout('Timed out waiting for lock: {}'.format(self.path))
+            time.sleep(self.poll_interval)
+
+    def release(self):
+        if self._fd is None:
+            return
+        fd, self._fd = self._fd, None
+        try:
+            if not self.shared:
+                os.ftruncate(fd, 0)
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            else:  # pragma: no cover
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(fd)
+
+    def _claim(self, fd: int):
+        """Check for a crashed previous holder, then record the identity of the new one"""
+        os.lseek(fd, 0, os.SEEK_SET)
+        previous = os.read(fd, 4096)
+        if previous.strip():
+            try:
+                self.stale_owner = json.loads(previous.decode('utf-8'))
+            except ValueError:
+                self.stale_owner = {}
+            logger.warning('Recovered a stale lock left by crashed process {}: {}'.format(self.stale_owner, self.path))
+
+        owner = json.dumps({'pid': os.getpid(), 'host': socket.gethostname(), 'time': time.time()})
+        os.ftruncate(fd, 0)
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, owner.encode('utf-8'))
+
+    def _try_lock(self, fd: int) -> bool:
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, (fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+            else:  # pragma: no cover
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+        return True
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
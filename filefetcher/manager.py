@@ -2,19 +2,31 @@
 Manager class: responsible for finding, downloading, or building assets as appropriate
 """
 import abc
+import collections
+from concurrent import futures
+import contextlib
 import functools
+import hashlib
+import json
 import logging
+import operator
 import os
+import pickle
 import re
+import shutil
 import tempfile
+import threading
+import time
 import typing as ty
-import urllib.request
 
-from . import exceptions, manifest, util
+from . import blobs, exceptions, graph, locking, manifest, requirements, transfer, util
 
 
 logger = logging.getLogger(__name__)
 
+# Marks the threads that are running a prefetch
+_prefetch_thread = threading.local()
+
 
 class BuildTask(abc.ABC):
     """A build task (recipe) can be any callable, but this provides machinery for some common operations"""
@@ -35,7 +47,12 @@ class BuildTask(abc.ABC):
 
     @abc.abstractmethod
     def build(self, manager: 'AssetManager', item_type: str, build_folder: str, **kwargs) -> ty.Tuple[str, dict]:
-        """Perform the actual build step, resulting in an output file and metadata"""
+        """
+        Perform the actual build step, resulting in an output file and metadata
+
+        If the build step already knows the sha256 of the output (eg by writing it with `util.HashingWriter`), it can
+            return it as the `_sha256` metadata field. The file will then not need to be read again to hash it.
+        """
         pass
 
     def __call__(self, manager: 'AssetManager', item_type: str, build_folder: str, **kwargs) -> ty.Tuple[str, dict]:
@@ -46,7 +63,8 @@ class BuildTask(abc.ABC):
         :param item_type: The type of asset (eg `snp_to_rsid`)
         :param build_folder: A temp folder that is automatically created during the build process for use by this
             build task. This folder and its contents will automatically be removed when the build completes; this may
-            or may not be the desired behavior for you.
+            or may not be the desired behavior for you. It is located on the same filesystem as the asset cache (by
+            default), so that the output file can be moved into place without copying it.
         :param kwargs: Custom tags that can be used to further define the asset (eg `genome_build`)
         :return:
         """
@@ -54,10 +72,117 @@ class BuildTask(abc.ABC):
         return self.build(manager, item_type, build_folder, **kwargs)
 
 
+class TaskResult:
+    """The outcome of a single asset operation (eg download) performed as part of a batch"""
+    def __init__(self, item_type: str, tags: dict, record: dict = None, error: Exception = None,
+                 transfer: 'transfer.TransferResult' = None):
+        self.item_type = item_type
+        self.tags = tags
+        self.record = record
+        self.error = error
+        # Details of the download (if any), eg how many bytes were saved by resuming an interrupted transfer
+        self.transfer = transfer
+        # A short description of any follow-up action (eg how a damaged asset was repaired)
+        self.note = None  # type: ty.Optional[str]
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __repr__(self):
+        return '<TaskResult {} {}: {}>'.format(self.item_type, self.tags, 'ok' if self.ok else repr(self.error))
+
+
+class DownloadPlan:
+    """
+    The remote records to add to the local cache. Each distinct file (by sha256) crosses the network at most once:
+        `transfers` are downloaded, and `copies` (files that are already local, or downloaded by an earlier transfer)
+        are copied from the local cache. Records left out of the plan are listed as `superseded` (not the newest
+        version) or `existing` (already in the local cache).
+    """
+    def __init__(self, transfers: ty.List[dict], copies: ty.List[dict], superseded: ty.List[dict] = None,
+                 existing: ty.List[dict] = None):
+        self.transfers = transfers
+        self.copies = copies
+        self.superseded = superseded or []
+        self.existing = existing or []
+
+    @property
+    def records(self) -> ty.List[dict]:
+        return self.transfers + self.copies
+
+    @property
+    def n_bytes(self) -> int:
+        """Total size of the files to download"""
+        return _total_size(self.transfers)
+
+    @property
+    def n_bytes_requested(self) -> int:
+        """Total size of every record that was considered, ie the cost of downloading each one without a plan"""
+        return _total_size(self.records + self.superseded + self.existing)
+
+    def __repr__(self):
+        return '<DownloadPlan {} records, {} bytes>'.format(len(self.records), self.n_bytes)
+
+
+def _total_size(records: ty.Iterable[dict]) -> int:
+    return sum(record.get('_size') or 0 for record in records)
+
+
+def _locate_key(item_type: str, tags: dict) -> ty.Optional[tuple]:
+    """Identify a query, for the `locate` cache. Lookups with unhashable tag values are valid, but have no key."""
+    key = (item_type, tuple(sorted(tags.items())))
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def _version_key(record: dict, group_by: ty.Optional[ty.List[str]]) -> str:
+    """
+    Identify an asset, regardless of version: by type and tags (apart from the release date), or by type and the
+        tags listed in `group_by`
+    """
+    if group_by is None:
+        key = [(k, v) for k, v in sorted(record.items()) if k not in manifest.SYSTEM_TAGS]
+    else:
+        key = [(k, record.get(k)) for k in group_by]
+    return json.dumps([record['_type'], key], default=str)
+
+
+def _newest_versions(records: ty.Iterable[dict], group_by: ty.Optional[ty.List[str]]) -> ty.List[dict]:
+    """Keep only the newest version of each asset. Like `locate`, ties go to the record that appears first."""
+    newest = collections.OrderedDict()  # type: ty.Dict[str, dict]
+    for record in records:
+        key = _version_key(record, group_by)
+        if key not in newest or (record.get('_date') or '') > (newest[key].get('_date') or ''):
+            newest[key] = record
+    return list(newest.values())
+
+
+def _split_query(query: dict) -> ty.Tuple[str, dict]:
+    """Separate a query (or a full manifest record) into an item type and the remaining tags"""
+    tags = dict(query)
+    item_type = tags.pop('_type')
+    return item_type, tags
+
+
 class AssetManager:
     """Locate, download, or build assets as appropriate"""
-    def __init__(self, library_name: str, remote_url: str, local_manifest: str = None, *,
+    # The class used to track remote assets (subclasses may provide, eg, an async implementation)
+    remote_manifest_class = manifest.RemoteManifest  # type: ty.Type[manifest.RemoteManifest]
+
+    def __init__(self, library_name: str, remote_url: ty.Union[str, ty.Sequence[str]], local_manifest: str = None, *,
                  auto_fetch: bool = False, auto_build: bool = False,
+                 retries: int = 3, retry_backoff: float = 1.0,
+                 segments: int = 1, segment_threshold: int = 2 ** 30,
+                 cache_size: int = 1024, cache_check_exists: bool = False,
+                 lock_timeout: float = None, remote_cache_ttl: float = 3600,
+                 staging_dir: str = None, access_interval: float = 60, shared_blobs: bool = False,
+                 shared_caches: ty.Iterable[str] = None, promote: bool = True, hedge_delay: float = None,
+                 pool_size: int = 4, network_timeout: float = 60, revalidate_interval: float = None,
+                 prefetch_workers: int = 4,
                  # Whether to autoload the local manifest (useful for testing to avoid blank files)
                  auto_load: bool = True):
         self.name = library_name
@@ -75,7 +200,19 @@ class AssetManager:
 
         # Identify places to fetch pre-build assets
         self._local = manifest.LocalManifest(local_manifest)
-        self._remote = manifest.RemoteManifest(remote_url)
+        # A copy of the remote manifest is cached alongside local assets, and revalidated every `remote_cache_ttl` sec
+        self._remote_cache_ttl = remote_cache_ttl
+        # The remote may be a list of mirrors (each the URL of a manifest). Requests go to the fastest mirror, and fail
+        #   over to the others. With `hedge_delay`, a request that is slow to start is also sent to the next best one.
+        self._hedge_delay = hedge_delay
+        # Connections to remote servers are kept open and reused (up to `pool_size` idle connections per host)
+        self._transport = transfer.Transport(pool_size=pool_size, timeout=network_timeout)
+        self._remote = self._make_remote_manifest(remote_url)
+        # Between the two, there may be read-only caches maintained by someone else (eg a site-wide copy on a shared
+        #   filesystem), checked in order. Assets found there are copied into the local cache (`promote`), or else
+        #   used in place.
+        self._shared = []  # type: ty.List[manifest.SharedManifest]
+        self._promote = promote
 
         # Store information about any relevant build scripts that can be used to make manifest items
         self._recipes = manifest.RecipeManifest(local_manifest)
@@ -83,6 +220,58 @@ class AssetManager:
         self._auto_fetch = auto_fetch
         self._auto_build = auto_build
 
+        # Interrupted downloads are resumed and retried with exponential backoff
+        self._retries = retries
+        self._retry_backoff = retry_backoff
+
+        # Very large files can be fetched as several byte ranges in parallel (1 = always use a single connection)
+        self._segments = segments
+        self._segment_threshold = segment_threshold
+
+        # Batch operations run in worker threads; changes to the local manifest must be serialized
+        self._lock = threading.RLock()
+
+        # When several threads or processes need the same missing asset, one fetches or builds it while the others
+        #   wait (up to `lock_timeout` seconds; forever if None)
+        self._lock_timeout = lock_timeout
+
+        # Recipes build their outputs in a scratch folder. By default this is a hidden folder of the package cache, so
+        #   that publishing a finished asset is a cheap rename (rather than a copy between filesystems)
+        self._staging_dir = staging_dir
+
+        # Remember the result of recent lookups, until the manifest changes
+        self._locate_cache = util.LocateCache(maxsize=cache_size, check_exists=cache_check_exists)
+
+        # `locate` records when each asset was last used (as the file access time), so that `gc` can evict the least
+        #   recently used assets. To keep lookups cheap, a file is touched at most once every `access_interval` sec.
+        self._access_interval = access_interval
+        self._last_touched = {}  # type: ty.Dict[str, float]
+
+        # Background lookups started by `prefetch` (by query), which `locate` can join rather than repeat. Every call
+        #   to `prefetch` (and every check for a newer release, below) shares one pool of at most `prefetch_workers`
+        #   threads, which is started on first use.
+        self._prefetching = {}  # type: ty.Dict[tuple, futures.Future]
+        self._prefetch_workers = max(prefetch_workers, 1)
+        self._prefetch_executor = None  # type: ty.Optional[futures.ThreadPoolExecutor]
+
+        # Stale-while-revalidate: with a `revalidate_interval`, `locate` returns the newest local copy immediately,
+        #   and (at most once per interval for each query, and never twice at once) checks the remote for a newer
+        #   release in the shared background pool, which is downloaded and used by later lookups.
+        #   None = never look for updates.
+        self._revalidate_interval = revalidate_interval
+        self._last_revalidated = {}  # type: ty.Dict[tuple, float]
+        # Queries that are being checked right now. Checks run in the same pool of threads as `prefetch`.
+        self._revalidating = set()  # type: ty.Set[tuple]
+
+        # Packages that share an asset root (by default, every package) can also share a single copy of each file.
+        #   Downloads are then skipped entirely when another package already has the same file.
+        self._blobs = None  # type: ty.Optional[blobs.BlobStore]
+        if shared_blobs:
+            asset_root = os.path.dirname(os.path.abspath(package_cache_dir))
+            self._blobs = blobs.BlobStore(asset_root, lock_timeout=lock_timeout)
+
+        self.set_shared_caches(shared_caches or [])
+
         # Load the manifest files into memory (creating if needed)
         if auto_load:
             # Ensure that the local asset directory exists for all future checks
@@ -97,122 +286,1108 @@ class AssetManager:
         """
         self._local = manifest.LocalManifest(manifest_path)
         self._local.load()
-        self.locate.cache_clear()
+        self._locate_cache.clear()
 
-    def set_remote_manifest(self, manifest_path: str):
+    def set_remote_manifest(self, manifest_path: ty.Union[str, ty.Sequence[str]]):
         """
         Change the manifest path used to track remote assets. This is useful for, eg, CLI functionality
         We don't download the remote manifest until it is actually needed, but we do clear the cache.
         """
-        self._remote = manifest.RemoteManifest(manifest_path)
-        self.locate.cache_clear()
+        self._remote = self._make_remote_manifest(manifest_path)
+        self._locate_cache.clear()
+
+    def set_shared_caches(self, manifest_paths: ty.Iterable[str]):
+        """
+        Change the list of read-only caches that are checked (in order) before downloading anything. Each is the path
+            to the manifest of an existing asset cache.
+        """
+        self._shared = [manifest.SharedManifest(path) for path in manifest_paths]
+        self._locate_cache.clear()
+
+    def _make_remote_manifest(self, url: ty.Union[str, ty.Sequence[str]]) -> manifest.RemoteManifest:
+        urls = [url] if isinstance(url, str) else list(url)
+        return self.remote_manifest_class(urls[0], mirrors=urls[1:], cache_dir=self._local._base_path,
+                                          ttl=self._remote_cache_ttl, hedge_delay=self._hedge_delay,
+                                          transport=self._transport)
 
     # Methods to modify the collection of items in the manager
     def add_recipe(self,
                    item_type,
                    source: ty.Callable[['AssetManager', str,  str], ty.Tuple[str, dict]],
                    label: str = None,
+                   depends_on: ty.Iterable[dict] = None,
                    **kwargs):
         """
         Add a recipe for a single item. The source can be a filename (direct copy) or a callable
             that receives the provided args and kwargs, and returns a dict with any tags that should be written to
             the manifest. (eg: "generic build command that can run on a schedule to get newest data releases")
+
+        A recipe can declare the upstream assets that it needs, as a list of queries (each a dict with an `_type`
+            key plus tags). Before the recipe is run, any upstream asset that is not available locally will be built
+            from its own recipe (or downloaded, if no recipe exists).
         """
-        self._recipes.add_record(item_type, label=label, _source=source, **kwargs)
+        self._recipes.add_record(item_type, label=label, _source=source, _depends=list(depends_on or []), **kwargs)
+
+    def cache_info(self) -> util.CacheInfo:
+        """Report hits and misses for the `locate` cache"""
+        return self._locate_cache.info()
+
+    def cache_clear(self):
+        """Forget all cached `locate` results"""
+        self._locate_cache.clear()
+
+    def _cache_generation(self) -> tuple:
+        """Identify the current state of the local manifest. Any change (or a new manifest) invalidates the cache."""
+        shared = tuple((id(tier), tier._generation) for tier in self._shared)
+        return id(self._local), self._local._generation, shared
 
     # Methods for retrieving an asset (precedence is local copy -> remote download -> build from scratch)
-    @functools.lru_cache()
-    def locate(self, item_type, auto_build=None, auto_fetch=None, **kwargs) -> str:
+    def locate(self, item_type, auto_build=None, auto_fetch=None, wait: float = None, **kwargs) -> str:
         """
         Find an asset in the local store, and optionally, try to auto-download it
 
+        If the same asset is being fetched in the background (see `prefetch`), wait up to `wait` seconds for that to
+            finish (forever if None) rather than starting a second download. If it takes longer, `PrefetchTimeout` is
+            raised.
+
         Return the (local) path to the asset at the end of this process
         """
+        key = _locate_key(item_type, kwargs)
+        if key is not None:
+            self._join_prefetch(key, wait)
+
+        generation = self._cache_generation()
+        path = self._locate_cache.get(key, generation) if key is not None else None
+        if path is None:
+            path = self._locate(item_type, auto_build=auto_build, auto_fetch=auto_fetch, **kwargs)
+            if key is not None:
+                self._locate_cache.put(key, generation, path)
+        self._touch(path)
+        if self._revalidate_interval is not None and key is not None:
+            # An asset that was fetched (or built) just now is already current
+            self._schedule_revalidation(key, item_type, kwargs, check=self._cache_generation() == generation)
+        return path
+
+    def prefetch(self, spec: ty.Union[str, ty.Iterable[requirements.Requirement]], auto_fetch: bool = True,
+                 auto_build: bool = None) -> ty.List[futures.Future]:
+        """
+        Start locating (and if needed, downloading or building) a list of assets in background threads, eg when a
+            service starts. Later calls to `locate` for the same assets wait for the prefetch instead of repeating it.
+
+        :param spec: A list of requirements (see `filefetcher.requirements`), or the path to a JSON or TOML file
+        :return: One future per requirement, whose result is the local path to the asset
+        """
+        queries = requirements.load(spec) if isinstance(spec, str) else requirements.parse(spec)
+        jobs = []
+        for query in queries:
+            item_type, tags = _split_query(query)
+            key = _locate_key(item_type, tags)
+            with self._lock:
+                job = self._prefetching.get(key) if key is not None else None
+                if job is None:
+                    job = self._background_executor().submit(self._prefetch_one, item_type, auto_build, auto_fetch,
+                                                             tags)
+                    if key is not None:
+                        self._prefetching[key] = job
+                        job.add_done_callback(functools.partial(self._end_prefetch, key))
+            jobs.append(job)
+        return jobs
+
+    def _background_executor(self) -> futures.ThreadPoolExecutor:
+        """The pool of threads used for background work (started on first use)"""
+        with self._lock:
+            if self._prefetch_executor is None:
+                self._prefetch_executor = futures.ThreadPoolExecutor(max_workers=self._prefetch_workers)
+            return self._prefetch_executor
+
+    def _prefetch_one(self, item_type: str, auto_build: ty.Optional[bool], auto_fetch: bool, tags: dict) -> str:
+        _prefetch_thread.active = True
+        try:
+            return self.locate(item_type, auto_build=auto_build, auto_fetch=auto_fetch, **tags)
+        finally:
+            _prefetch_thread.active = False
+
+    def _join_prefetch(self, key: tuple, wait: ty.Optional[float]):
+        job = self._prefetching.get(key)
+        if job is None or getattr(_prefetch_thread, 'active', False):
+            # A prefetch (or a recipe that it runs) must not wait for itself
+            return
+        try:
+            job.result(timeout=wait)
+        except futures.TimeoutError:
+            raise exceptions.PrefetchTimeout('Timed out waiting for a prefetch of asset: {}'.format(key[0]))
+        except Exception as e:
+            # Look the asset up as usual, and let that report any problem according to the options of this call
+            logger.debug('Prefetch of asset {} failed: {!r}'.format(key[0], e))
+
+    def _end_prefetch(self, key: tuple, job: futures.Future):
+        with self._lock:
+            if self._prefetching.get(key) is job:
+                del self._prefetching[key]
+
+    def _schedule_revalidation(self, key: tuple, item_type: str, tags: dict, check: bool = True):
+        """Check for a newer release of an asset in the background, unless that was done recently"""
+        now = time.monotonic()
+        with self._lock:
+            if key in self._revalidating:
+                return
+            if now - self._last_revalidated.get(key, -self._revalidate_interval) < self._revalidate_interval:
+                return
+            self._last_revalidated[key] = now
+            if not check:
+                return
+            self._revalidating.add(key)
+        job = self._background_executor().submit(self._revalidate, item_type, tags)
+        job.add_done_callback(lambda _: self._end_revalidation(key))
+
+    def _end_revalidation(self, key: tuple):
+        with self._lock:
+            self._revalidating.discard(key)
+
+    def _revalidate(self, item_type: str, tags: dict):
+        """Download the newest remote release of an asset, if it is newer than every local match"""
+        try:
+            self._remote.refresh()
+            remote_record = self._remote.locate(item_type, **tags)
+            local_record = self._local.locate(item_type, err_on_missing=False, **tags)
+            if local_record is not None and local_record['_date'] >= remote_record['_date']:
+                return
+            if self._local.locate(item_type, err_on_missing=False, **remote_record):
+                return
+
+            logger.info('Downloading a newer release of asset {} in the background'.format(item_type))
+            with self._asset_lock(item_type, tags):
+                self._download_record(remote_record)
+        except exceptions.ImmutableManifestError:
+            # Someone else downloaded it first
+            pass
+        except exceptions.NoMatchingAsset:
+            # Eg an asset that was built locally, and is not published on the remote
+            logger.debug('No remote release of asset {} to check against'.format(item_type))
+        except Exception as e:
+            # The local copy remains usable; the check will be repeated after the next interval
+            logger.warning('Could not check for a newer release of asset {}: {!r}'.format(item_type, e))
+
+    @contextlib.contextmanager
+    def hold(self, item_type, **kwargs) -> ty.Iterator[str]:
+        """
+        Locate an asset, and protect it from `gc` (in any process) for as long as the context is open
+
+            with manager.hold('snp_to_rsid', genome_build='GRCh38') as path:
+                ...read the file...
+
+        Accepts the same arguments as `locate`.
+        """
+        path = self.locate(item_type, **kwargs)
+        lock = self._named_lock(os.path.basename(path), shared=True)
+        lock.acquire()
+        try:
+            if not os.path.exists(path):
+                # The asset was evicted between the lookup and taking the lock: look again (and fetch or build it,
+                #   if the options allow)
+                lock.release()
+                self._locate_cache.clear()
+                with self._lock:
+                    self._local.refresh()
+                path = self.locate(item_type, **kwargs)
+                lock = self._named_lock(os.path.basename(path), shared=True)
+                lock.acquire()
+            yield path
+        finally:
+            lock.release()
+
+    def _touch(self, path: str):
+        """Record that an asset was used, by updating the access time of the file (but not its modification time)"""
+        now = time.monotonic()
+        if now - self._last_touched.get(path, -self._access_interval) < self._access_interval:
+            return
+        self._last_touched[path] = now
+        try:
+            stat = os.stat(path)
+            os.utime(path, ns=(int(time.time() * 1e9), stat.st_mtime_ns))
+        except OSError:
+            # Eg a missing file, or an asset in a read-only location. Access tracking is only advisory.
+            pass
+
+    def _locate(self, item_type, auto_build=None, auto_fetch=None, **kwargs) -> str:
         # Auto build can be overridden for specific method calls. This is useful to avoid infinite loops when checking
         # "asset already exists" during build.
         auto_build = auto_build if auto_build is not None else self._auto_build
         auto_fetch = auto_fetch if auto_fetch is not None else self._auto_fetch
 
         try:
-            data = self._local.locate(item_type, **kwargs)
-            return self._local.get_path(data)
-        except (exceptions.NoMatchingAsset, exceptions.ManifestNotFound) as e:
-            if not auto_fetch and not auto_build:
-                raise e
-
-        if auto_fetch:
-            # If auto-fetch is active, try to auto-download the newest and best possible match
+            return self._find_local(item_type, **kwargs)
+        except (exceptions.NoMatchingAsset, exceptions.ManifestNotFound, exceptions.AssetNotFound) as e:
+            missing = e
+
+        # Shared caches don't require any network access
+        path = self._find_shared(item_type, **kwargs)
+        if path is not None:
+            return path
+
+        if not auto_fetch and not auto_build:
+            raise missing
+
+        # Only one thread or process at a time may fetch or build a given asset. Those that had to wait for the lock
+        #   will usually find that the asset is now available locally.
+        with self._asset_lock(item_type, kwargs):
+            with self._lock:
+                self._local.refresh()
             try:
-                data = self.download(item_type, **kwargs)
-                logger.debug('Automatically downloaded asset from remote: {}'.format(item_type))
-                return self._local.get_path(data)
-            except exceptions.BaseAssetException as e:
-                if not auto_build:
-                    raise e
+                return self._find_local(item_type, **kwargs)
+            except exceptions.NoMatchingAsset:
+                pass
+            except exceptions.AssetNotFound:
+                # The file was deleted from the cache, but its record remains. Forget it, so that it can be replaced.
+                with self._lock:
+                    stale = self._local.locate(item_type, **kwargs)
+                    self._local.remove_record(stale)
+                    self._local.save()
+                logger.warning('Asset file is missing, and will be replaced: {}'.format(stale['_path']))
 
-        if auto_build:
-            # If auto-build is active, and all other options have failed, try to build the asset
-            logger.debug('Automatically built asset from recipe: {}'.format(item_type))
-            data = self.build(item_type, **kwargs)
-            return self._local.get_path(data)
+            if auto_fetch:
+                # If auto-fetch is active, try to auto-download the newest and best possible match
+                try:
+                    data = self.download(item_type, **kwargs)
+                    logger.debug('Automatically downloaded asset from remote: {}'.format(item_type))
+                    return self._local.get_path(data)
+                except exceptions.ImmutableManifestError:
+                    # A caller that used a different query for the same asset downloaded it after our lookup above
+                    return self._find_local(item_type, **kwargs)
+                except exceptions.BaseAssetException as e:
+                    if not auto_build:
+                        raise e
+
+            if auto_build:
+                # If auto-build is active, and all other options have failed, try to build the asset
+                logger.debug('Automatically built asset from recipe: {}'.format(item_type))
+                data = self.build(item_type, **kwargs)
+                return self._local.get_path(data)
 
         raise exceptions.NoMatchingAsset
 
-    def download(self, item_type, save=True, **kwargs) -> dict:
-        """Fetch a file from the remote repository to the local cache directory, and update the local manifest"""
+    def _find_local(self, item_type, **kwargs) -> str:
+        """Find the path of an asset that is already in the local cache"""
+        data = self._local.locate(item_type, **kwargs)
+        path = self._local.get_path(data)
+        if self._locate_cache.check_exists and not os.path.exists(path):
+            raise exceptions.AssetNotFound
+        return path
+
+    def _find_shared(self, item_type, **kwargs) -> ty.Optional[str]:
+        """Find an asset in the first shared cache that has it, and copy it into the local cache (if promoting)"""
+        for tier in self._shared:
+            try:
+                if tier._loaded:
+                    tier.refresh()
+                else:
+                    tier.load()
+            except exceptions.ManifestNotFound:
+                logger.warning('Shared asset cache is not available: {}'.format(tier._manifest_path))
+                continue
+
+            record = tier.locate(item_type, err_on_missing=False, **kwargs)
+            if record is None:
+                continue
+            if not self._promote:
+                return tier.get_path(record)
+            try:
+                return self._local.get_path(self._promote_record(tier, record))
+            except exceptions.IntegrityError:
+                logger.warning('Shared cache has a damaged copy of the asset: {}'.format(tier.get_path(record)))
+        return None
+
+    def _promote_record(self, tier: manifest.SharedManifest, record: dict) -> dict:
+        """Copy an asset from a shared cache into the local cache (as a reflink, where the filesystem allows)"""
+        with self._named_lock(record['_path']):
+            with self._lock:
+                self._local.refresh()
+            existing = self._local.locate(record['_type'], err_on_missing=False, **record)
+            if existing is not None:
+                return existing
+
+            dest = self._local.get_path(record)
+            self._copy_in(tier.get_path(record), dest, record['_sha256'])
+            with self._lock:
+                local_record = self._local.add_record(record['_type'], source_path=dest, date=record.get('_date'),
+                                                      **record)
+                self._local.save()
+        logger.debug('Copied asset from shared cache: {}'.format(dest))
+        return local_record
+
+    def _copy_from_shared(self, sha256: str, dest: str) -> bool:
+        """Look for an exact copy of a file in the shared caches, and if found, copy it to `dest`"""
+        for tier in self._shared:
+            try:
+                tier.load()
+            except exceptions.ManifestNotFound:
+                continue
+            for record in tier.find_by_sha256(sha256):
+                path = tier.get_path(record)
+                if not os.path.isfile(path):
+                    continue
+                try:
+                    self._copy_in(path, dest, sha256)
+                except exceptions.IntegrityError:
+                    logger.warning('Shared cache has a damaged copy of the asset: {}'.format(path))
+                    continue
+                return True
+        return False
+
+    @staticmethod
+    def _copy_in(source: str, dest: str, sha256: str):
+        """
+        Copy a file into the cache. The copy is hashed as it is made (someone may have modified the source since it was
+            added to its own cache), and is only moved into place if it matches `sha256`.
+        """
+        temp_path = '{}.{}.promote'.format(dest, os.getpid())
+        try:
+            if util.copy_file_hashed(source, temp_path) != sha256:
+                raise exceptions.IntegrityError('Copied file does not match the expected hash: {}'.format(source))
+            os.replace(temp_path, dest)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _asset_lock(self, item_type: str, tags: dict) -> locking.FileLock:
+        """A lock that allows only one thread or process at a time to fetch or build the asset matching a query"""
+        user_tags = sorted(((k, v) for k, v in tags.items() if k not in manifest.SYSTEM_TAGS),
+                           key=operator.itemgetter(0))
+        return self._named_lock(json.dumps([item_type, user_tags], default=str))
+
+    def _named_lock(self, name: str, shared: bool = False) -> locking.FileLock:
+        """Lock files are kept in a hidden folder of the package cache directory"""
+        lock_dir = os.path.join(self._local._base_path, '.locks')
+        os.makedirs(lock_dir, exist_ok=True)
+        digest = hashlib.sha1(name.encode('utf-8')).hexdigest()
+        return locking.FileLock(os.path.join(lock_dir, '{}.lock'.format(digest)), timeout=self._lock_timeout,
+                                shared=shared)
+
+    def import_file(self, item_type: str, path: str, label: str = None, link: bool = False, date: str = None,
+                    **kwargs) -> dict:
+        """
+        Add an existing local file to the cache (as a copy), and record it in the local manifest with the given tags
+
+        The file is copied and hashed in a single pass, or cloned where the filesystem supports it. Pass `link=True`
+            to allow a hardlink, if the original file will never be modified in place.
+
+        Versions of an asset are ordered by date (eg by `gc`). The release `date` (an ISO 8601 string) defaults to
+            the modification time of the file.
+        """
+        with self._lock:
+            record = self._local.add_record(item_type, source_path=path, label=label, date=date, copy_file=True,
+                                            link=link, **kwargs)
+            self._local.save()
+        return record
+
+    def download(self, item_type, save=True, segments: int = None, **kwargs) -> dict:
+        """
+        Fetch a file from the remote repository to the local cache directory, and update the local manifest
+
+        Files larger than the manager's `segment_threshold` are fetched over `segments` parallel connections. Pass
+            `segments` to override the manager-wide default for this call.
+        """
+        local_record, _ = self._download(item_type, save=save, segments=segments, **kwargs)
+        return local_record
+
+    def _download(self, item_type, save=True, segments: int = None,
+                  **kwargs) -> ty.Tuple[dict, transfer.TransferResult]:
+        """Download an asset, and report details of the transfer along with the new local record"""
         self._remote.load()  # Load manifest (if not already loaded)
         remote_record = self._remote.locate(item_type, **kwargs)
-        url = self._remote.get_path(remote_record)
+        return self._download_record(remote_record, save=save, segments=segments)
+
+    def _download_record(self, remote_record: dict, save=True,
+                         segments: int = None) -> ty.Tuple[dict, transfer.TransferResult]:
+        """Download the file described by one specific remote manifest record"""
         dest = self._local.get_path(remote_record)
 
-        urllib.request.urlretrieve(url, dest)
+        # Two processes must never write to the same partial file. Whoever waited for the lock may find that the asset
+        #   has been downloaded in the meantime (perhaps by a caller that asked for it with a different query).
+        lock = self._named_lock(remote_record['_path'])
+        waited = not lock.acquire(blocking=False)
+        if waited:
+            lock.acquire()
+        try:
+            if lock.stale_owner is not None:
+                logger.info('Resuming a download interrupted by a crashed process: {}'.format(dest))
+            stats = transfer.TransferResult()
+            existing = self._check_new_download(remote_record, waited=waited)
+            if existing is not None:
+                return existing, stats
 
-        # Validate that sha256 of the downloaded file matches the record
-        sha = remote_record['_sha256']
-        if not os.path.isfile(dest) or util.get_file_sha256(dest) != sha:
-            raise exceptions.IntegrityError
+            if not self._place_without_network(remote_record['_sha256'], dest):
+                stats = self._fetch_from_mirrors(remote_record, dest, segments)
+            local_record = self._record_download(remote_record, dest, save=save)
+        finally:
+            lock.release()
+        return local_record, stats
 
-        # Since we are downloading directly to the cache dir, we don't need to move or copy the file, and the remote
-        #   manifest has already provided us with the appropriate metadata info
-        local_record = self._local.add_record(item_type, source_path=dest, **remote_record)
-        if save:
-            # Can turn off auto-save if downloading a batch of records at once
-            self._local.save()
+    # The steps of a download, for use by both the blocking and async managers. The caller holds the per-file lock.
+    def _check_new_download(self, remote_record: dict, waited: bool = False) -> ty.Optional[dict]:
+        """
+        Fail before transferring any data if the asset is already tracked locally. If the caller had to wait for
+            someone else to finish downloading it, that is not an error: the existing local record is returned.
+        """
+        with self._lock:
+            self._local.refresh()
+        existing = self._local.find_exact(remote_record['_type'], **remote_record)
+        if existing is not None and not waited:
+            raise exceptions.ImmutableManifestError('Attempted to download an asset that already exists locally')
+        return existing
+
+    def _place_without_network(self, sha256: str, dest: str) -> bool:
+        """Try to get an exact copy of a file from the blob store or a shared cache, rather than downloading it"""
+        if self._blobs is not None and self._blobs.get(sha256, dest):
+            # Another package has already downloaded this exact file
+            logger.debug('Linked asset from the shared blob store: {}'.format(dest))
+            return True
+        if self._copy_from_shared(sha256, dest):
+            logger.debug('Copied asset from shared cache instead of downloading: {}'.format(dest))
+            return True
+        if self._copy_from_local(sha256, dest):
+            logger.debug('Copied an identical file already in the local cache: {}'.format(dest))
+            return True
+        return False
+
+    def _copy_from_local(self, sha256: str, dest: str) -> bool:
+        """The same file may be listed in the remote manifest more than once (eg under different tags)"""
+        with self._lock:
+            records = self._local.find_by_sha256(sha256)
+        for record in records:
+            path = self._local.get_path(record)
+            if not os.path.isfile(path):
+                continue
+            try:
+                if os.path.abspath(path) != os.path.abspath(dest):
+                    self._copy_in(path, dest, sha256)
+                elif util.get_file_sha256(path) != sha256:
+                    raise exceptions.IntegrityError
+            except exceptions.IntegrityError:
+                logger.warning('Local copy of the asset does not match its hash: {}'.format(path))
+                continue
+            return True
+        return False
+
+    def _record_download(self, remote_record: dict, dest: str, save: bool = True) -> dict:
+        """Add a downloaded file to the local manifest (and to the blob store, if one is in use)"""
+        if self._blobs is not None:
+            self._blobs.put(dest, remote_record['_sha256'])
+
+        # Since we are downloading directly to the cache dir, we don't need to move or copy the file, and the
+        #   remote manifest has already provided us with the appropriate metadata info. The release date of the
+        #   remote record is preserved so that "newest" means the same thing locally, regardless of download order.
+        with self._lock:
+            local_record = self._local.add_record(remote_record['_type'], source_path=dest,
+                                                  date=remote_record.get('_date'), allow_versions=True,
+                                                  **remote_record)
+            if save:
+                # Can turn off auto-save if downloading a batch of records at once
+                self._local.save()
         return local_record
 
+    def _fetch_from_mirrors(self, remote_record: dict, dest: str, segments: int = None) -> transfer.TransferResult:
+        """
+        Download an asset file from the fastest mirror, failing over to the others in turn. A partial download is
+            resumed from the next mirror; since the file is only accepted once it matches the sha256 in the manifest,
+            it does not matter which mirror provided which bytes.
+
+        With `hedge_delay`, a transfer that has not finished within that many seconds is raced against a second one
+            from the next best mirror. Whichever delivers the file first wins, and the other transfer is cancelled.
+        """
+        sha256 = remote_record['_sha256']
+        segments = segments if segments is not None else self._segments
+        size = remote_record.get('_size') or 0
+        # Set by the transfer that delivers the file, to stop a hedged transfer of the same file that is still running
+        done = threading.Event()
+        running = []  # type: ty.List[str]
+        running_lock = threading.Lock()
+
+        def fetch(mirror_url: str) -> transfer.TransferResult:
+            # The file is hashed as it streams in, and only appears at `dest` once the sha256 matches
+            url = self._remote.get_mirror_path(mirror_url, remote_record)
+            with running_lock:
+                # Failover continues from the same `.part` file; a hedged transfer running alongside gets its own
+                target = dest if dest not in running else dest + '.hedge'
+                running.append(target)
+            try:
+                if segments > 1 and size > self._segment_threshold:
+                    result = transfer.fetch_file_segmented(url, target, sha256, size, segments, retries=self._retries,
+                                                           backoff=self._retry_backoff, transport=self._transport,
+                                                           cancel=done)
+                else:
+                    result = transfer.fetch_file(url, target, sha256, retries=self._retries,
+                                                 backoff=self._retry_backoff, transport=self._transport, cancel=done)
+                if target != dest:
+                    os.replace(target, dest)
+            finally:
+                with running_lock:
+                    running.remove(target)
+            done.set()
+            return result
+
+        _, stats = self._remote.mirrors.call(fetch, hedge_delay=self._hedge_delay)
+        return stats
+
+    def download_many(self, queries: ty.Iterable[dict], max_workers: int = 4) -> ty.List[TaskResult]:
+        """
+        Download several assets concurrently, and save the local manifest once when all transfers are done
+
+        Each query is a dict with an `_type` key plus any tags (a full remote manifest record is also a valid query).
+            A failure to fetch one asset does not stop the others: the result for each query reports the new local
+            record, or the exception that was raised.
+        """
+        queries = list(queries)
+        self._remote.load()  # Load once up front, rather than racing to do so in every worker
+
+        def fetch_one(query: dict) -> TaskResult:
+            item_type, tags = _split_query(query)
+            return self._download_task(item_type, tags, lambda: self._download(item_type, save=False, **tags))
+
+        with futures.ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+            results = list(executor.map(fetch_one, queries))
+
+        if any(result.ok for result in results):
+            with self._lock:
+                self._local.save()
+        return results
+
+    @staticmethod
+    def _download_task(item_type: str, tags: dict,
+                       download: ty.Callable[[], ty.Tuple[dict, transfer.TransferResult]]) -> TaskResult:
+        """Run one download of a batch, and report the outcome rather than raising"""
+        try:
+            record, stats = download()
+        except Exception as e:
+            logger.debug('Failed to download asset {}: {!r}'.format(item_type, e))
+            return TaskResult(item_type, tags, error=e)
+        return TaskResult(item_type, tags, record=record, transfer=stats)
+
+    def plan_sync(self, latest: bool = False, group_by: ty.Iterable[str] = None) -> DownloadPlan:
+        """
+        Work out which remote assets are missing from the local cache (see `sync`), without downloading anything
+        """
+        self._remote.load()
+        return self.plan_download(self._remote._items, latest=latest, group_by=group_by)
+
+    def plan_download(self, records: ty.Iterable[dict], latest: bool = False, group_by: ty.Iterable[str] = None,
+                      skip_existing: bool = True) -> DownloadPlan:
+        """
+        Choose which of the given remote records to download. With `skip_existing`, a record is skipped if the local
+            cache already has a record with the same type and tags. With `latest`, only the newest version of each
+            asset is kept (see `gc` for how versions are grouped).
+
+        The plan lists the chosen records themselves, and `sync(plan=...)` fetches exactly those.
+        """
+        records = list(records)
+        superseded = []  # type: ty.List[dict]
+        if latest:
+            newest = _newest_versions(records, sorted(group_by) if group_by is not None else None)
+            kept = {id(record) for record in newest}
+            superseded = [record for record in records if id(record) not in kept]
+            records = newest
+
+        with self._lock:
+            self._local.refresh()
+
+        transfers = []  # type: ty.List[dict]
+        copies = []  # type: ty.List[dict]
+        existing = []  # type: ty.List[dict]
+        planned_shas = set()  # type: ty.Set[str]
+        for record in records:
+            if skip_existing and self._local.find_exact(record['_type'], **record):
+                existing.append(record)
+                continue
+            sha256 = record.get('_sha256')
+            if sha256 in planned_shas or self._local.find_by_sha256(sha256):
+                copies.append(record)
+            else:
+                planned_shas.add(sha256)
+                transfers.append(record)
+        return DownloadPlan(transfers, copies, superseded=superseded, existing=existing)
+
+    def sync(self, latest: bool = False, group_by: ty.Iterable[str] = None, max_workers: int = 4,
+             plan: DownloadPlan = None) -> ty.List[TaskResult]:
+        """
+        Download every remote asset that is missing from the local cache (or with `latest`, only the newest version
+            of each asset). Assets that are already present are not downloaded again, and a file that appears more
+            than once in the remote manifest is only transferred once.
+
+        Pass a `plan` (from `plan_sync`) to fetch exactly what it lists, eg after showing it to the user.
+        """
+        if plan is None:
+            plan = self.plan_sync(latest=latest, group_by=group_by)
+        return self._execute_plan(plan, max_workers=max_workers)
+
+    def _execute_plan(self, plan: DownloadPlan, max_workers: int = 4) -> ty.List[TaskResult]:
+        """
+        Fetch exactly the remote records that the plan lists. (Looking each one up again by its tags could pick a
+            different version of the asset.) The local manifest is saved once, when all records are done.
+        """
+        def fetch_one(remote_record: dict) -> TaskResult:
+            item_type, tags = _split_query(remote_record)
+            return self._download_task(item_type, tags,
+                                       lambda: self._download_record(remote_record, save=False))
+
+        results = []  # type: ty.List[TaskResult]
+        with futures.ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+            # Copies are made once every transfer has finished, so that their source files are in place
+            for batch in (plan.transfers, plan.copies):
+                results += executor.map(fetch_one, batch)
+
+        if any(result.ok for result in results):
+            with self._lock:
+                self._local.save()
+        return results
+
     def build(self, item_type, save=True, **kwargs) -> dict:
         """
-        Build a specified asset. This is a very crude build system and is not intended to handle nested
-            dependencies, multi-file builds, etc. It is assumed the function can operate completely from within
-            a temp folder and that that folder can be cleaned up when done.
+        Build a specified asset. It is assumed the function can operate completely from within a temp folder and
+            that that folder can be cleaned up when done. Upstream dependencies declared by the recipe are built
+            first (see `build_many`).
         """
         recipe = self._recipes.locate(item_type, **kwargs)
         recipe_func = recipe['_source']
 
         # When building "all recipes", the source (a function) might get passed as a kwarg. Remove it from the
         #   list of "custom tags"- it's a "system-defined key" and not part of the metadata that goes in the manifest
-        kwargs.pop('_source', None)
+        kwargs = _recipe_tags(kwargs)
 
-        with tempfile.TemporaryDirectory() as tmpdirname:
+        if recipe.get('_depends'):
+            # Provide only the upstream assets that are missing (building or downloading them), then run this recipe
+            node = graph.BuildNode(item_type, kwargs, recipe)
+            upstream = [step for step in graph.plan([node], self._resolve_dependency) if step is not node]
+            outcomes = self._run_plan(upstream)
+            if save and any(result.ok for result in outcomes.values()):
+                with self._lock:
+                    self._local.save()
+            for result in outcomes.values():
+                if not result.ok:
+                    raise exceptions.DependencyError('Could not provide dependency {} {}: {}'.format(
+                        result.item_type, result.tags, result.error))
+
+        with tempfile.TemporaryDirectory(dir=self._get_staging_dir()) as tmpdirname:
             # All build steps are automatically given a temporary working folder that will be cleaned up when done
-            try:
-                # TODO: Currently we do not provide a mechanism to force rebuild, except to manually edit the local
-                #   registry to remove the record
-                out_fn, build_meta = recipe_func(self, item_type, tmpdirname, **kwargs)
-            except exceptions.AssetAlreadyExists:
-                # The recipe function can raise "asset already exists" to interrupt the build step.
-                # This will fail if the manifest does not find such a matching asset present locally
-                return self._local.locate(item_type, **kwargs)
-
-            if not os.path.isfile(out_fn):
-                raise exceptions.IntegrityError
-
-            # The build is described by the options we pass in (like "genome_build"), and also by any other metadata
-            #   calculated during the process (eg "db_snp_newest_version")
-            build_description = {**kwargs, **build_meta}
-            local_record = self._local.add_record(item_type, source_path=out_fn, move_file=True, **build_description)
+            # TODO: Currently we do not provide a mechanism to force rebuild, except to manually edit the local
+            #   registry to remove the record
+            output = _run_recipe(self, recipe_func, item_type, tmpdirname, kwargs)
+            local_record = self._publish_build(item_type, kwargs, output)
 
         if save:
             # Can turn off auto-save if downloading a batch of records at once
-            self._local.save()
+            with self._lock:
+                self._local.save()
         return local_record
+
+    def build_many(self, queries: ty.Iterable[dict], max_workers: int = 4) -> ty.List[TaskResult]:
+        """
+        Build several assets from their recipes, running up to `max_workers` recipes at once in separate processes
+
+        Dependencies between recipes are resolved first: upstream assets that don't exist locally are added to the
+            plan (built from their own recipe, or downloaded if there is none), and a recipe only starts once
+            everything it depends on is available. Independent branches run in parallel. Circular dependencies are
+            refused before anything is built.
+
+        Each recipe gets its own temp folder. Build outputs are added to the local manifest by this (parent) process,
+            which saves the manifest once at the end. A failure in one recipe does not stop unrelated ones: the result
+            for each step reports the new local record, or the exception that was raised.
+
+        Results are returned in the order of `queries` (one per query), followed by the results of any upstream
+            steps that were added to the plan, in the order that they finished.
+
+        Recipes that cannot be sent to another process (eg lambdas) are run in a thread of this process instead.
+            In a worker process, recipes receive a copy of this manager that has no recipes of its own.
+        """
+        roots = []  # type: ty.List[ty.Union[graph.BuildNode, TaskResult]]
+        for query in queries:
+            item_type, tags = _split_query(query)
+            tags = _recipe_tags(tags)
+            try:
+                roots.append(self._recipe_node(item_type, tags, self._recipes.locate(item_type, **tags)))
+            except exceptions.BaseAssetException as e:
+                roots.append(TaskResult(item_type, tags, error=e))
+
+        plan = graph.plan([root for root in roots if isinstance(root, graph.BuildNode)], self._resolve_dependency)
+        outcomes = self._run_plan(plan, max_workers=max_workers)
+
+        # Several queries may resolve to the same recipe (and so, to the same step of the plan)
+        steps = {node.key: node for node in plan}
+        results = [outcomes[steps[root.key]] if isinstance(root, graph.BuildNode) else root for root in roots]
+        requested = {root.key for root in roots if isinstance(root, graph.BuildNode)}
+        results += [result for node, result in outcomes.items() if node.key not in requested]
+
+        if any(result.ok for result in results):
+            with self._lock:
+                self._local.save()
+        return results
+
+    def _run_plan(self, plan: ty.List[graph.BuildNode],
+                  max_workers: int = 4) -> ty.Dict[graph.BuildNode, TaskResult]:
+        """
+        Run the steps of a build plan, each as soon as everything upstream of it is available. Outputs are added to
+            the (unsaved) local manifest. Returns the result of each step, in the order that the steps finished.
+        """
+        outcomes = collections.OrderedDict()  # type: ty.Dict[graph.BuildNode, TaskResult]
+        waiting = {node: set(node.upstream) for node in plan}
+
+        with futures.ProcessPoolExecutor(max_workers=max(max_workers, 1)) as processes, \
+                futures.ThreadPoolExecutor(max_workers=max(max_workers, 1)) as threads:
+            jobs = {}  # type: ty.Dict[futures.Future, ty.Tuple[graph.BuildNode, ty.Optional[str]]]
+
+            def start(node: graph.BuildNode):
+                if node.recipe is None:
+                    job = threads.submit(self._download, node.item_type, save=False, **node.tags)
+                    jobs[job] = (node, None)
+                    return
+                recipe_func = node.recipe['_source']
+                executor = processes if max_workers > 1 and _is_picklable(recipe_func) else threads
+                build_folder = tempfile.mkdtemp(dir=self._get_staging_dir())
+                jobs[executor.submit(_run_recipe, self, recipe_func, node.item_type, build_folder, node.tags)] = \
+                    (node, build_folder)
+
+            def finish(node: graph.BuildNode, result: TaskResult):
+                outcomes[node] = result
+                del waiting[node]
+                for downstream in node.downstream:
+                    if downstream not in waiting:
+                        continue
+                    if not result.ok:
+                        # Everything that depends on a failed step fails too, without being run
+                        error = exceptions.DependencyError('Upstream asset {} {} could not be provided: {}'.format(
+                            node.item_type, node.tags, result.error))
+                        finish(downstream, TaskResult(downstream.item_type, downstream.tags, error=error))
+                    else:
+                        waiting[downstream].discard(node)
+                        if not waiting[downstream]:
+                            start(downstream)
+
+            for node in plan:
+                if not node.upstream:
+                    start(node)
+
+            while jobs:
+                done, _ = futures.wait(jobs, return_when=futures.FIRST_COMPLETED)
+                for job in done:
+                    node, build_folder = jobs.pop(job)
+                    try:
+                        if build_folder is None:
+                            record = job.result()[0]
+                        else:
+                            record = self._publish_build(node.item_type, node.tags, job.result())
+                    except Exception as e:
+                        logger.debug('Failed to build asset {}: {!r}'.format(node.item_type, e))
+                        finish(node, TaskResult(node.item_type, node.tags, error=e))
+                    else:
+                        finish(node, TaskResult(node.item_type, node.tags, record=record))
+                    finally:
+                        if build_folder is not None:
+                            shutil.rmtree(build_folder, ignore_errors=True)
+        return outcomes
+
+    def _resolve_dependency(self, item_type: str, tags: dict) -> ty.Optional[graph.BuildNode]:
+        """Decide how to provide an upstream asset: skip it (exists locally), build it, or download it"""
+        if self._local.locate(item_type, err_on_missing=False, **tags):
+            return None
+        recipe = self._recipes.locate(item_type, err_on_missing=False, **tags)
+        if recipe is None:
+            return graph.BuildNode(item_type, tags)
+        return self._recipe_node(item_type, tags, recipe)
+
+    @staticmethod
+    def _recipe_node(item_type: str, tags: dict, recipe: dict) -> graph.BuildNode:
+        """A query may name only some of the tags that a recipe was registered with; the recipe receives them all"""
+        recipe_tags = {key: value for key, value in recipe.items() if key not in manifest.SYSTEM_TAGS}
+        return graph.BuildNode(item_type, {**recipe_tags, **tags}, recipe)
+
+    def _publish_build(self, item_type: str, tags: dict, output: ty.Optional[ty.Tuple[str, dict]]) -> dict:
+        """Move the output of a recipe into the local cache, and record it in the (unsaved) local manifest"""
+        if output is None:
+            # The recipe function can raise "asset already exists" to interrupt the build step.
+            # This will fail if the manifest does not find such a matching asset present locally
+            return self._local.locate(item_type, **tags)
+
+        out_fn, build_meta = output
+        if not os.path.isfile(out_fn):
+            raise exceptions.IntegrityError
+
+        # The build is described by the options we pass in (like "genome_build"), and also by any other metadata
+        #   calculated during the process (eg "db_snp_newest_version")
+        build_description = {**tags, **build_meta}
+        # If the recipe has already hashed its output, there is no need to read the file again
+        sha256 = build_description.pop('_sha256', None)
+        with self._lock:
+            return self._local.add_record(item_type, source_path=out_fn, move_file=True, sha256=sha256,
+                                          **build_description)
+
+    def _get_staging_dir(self) -> str:
+        staging_dir = self._staging_dir or os.path.join(self._local._base_path, '.staging')
+        os.makedirs(staging_dir, exist_ok=True)
+        return staging_dir
+
+    # Maintenance of the local cache
+    def verify(self, quick: bool = False, max_workers: int = 4, repair: str = None) -> ty.List[TaskResult]:
+        """
+        Check that every asset file tracked by the local manifest exists and is intact
+
+        A full check hashes every file (in parallel, across `max_workers` processes) and compares it to `_sha256`.
+            A quick check only compares the file size to `_size`, and the size + modification time to the
+            fingerprint recorded the last time the file passed a full check.
+
+        Damaged or missing assets can optionally be repaired: `quarantine` moves the bad file aside (to a
+            `.quarantine` folder) and removes its record from the local manifest; `redownload` also fetches a fresh
+            copy of the same file from the remote manifest.
+
+        :return: A result for each asset. Results for damaged assets have an error.
+        """
+        if repair not in (None, 'quarantine', 'redownload'):
+            raise ValueError('Unknown repair option: {}'.format(repair))
+
+        with self._lock:
+            self._local.refresh()
+            records = [record for record in self._local._items if record.get('_path')]
+
+        fingerprints = self._read_fingerprints()
+        results = []  # type: ty.List[TaskResult]
+        to_hash = []  # type: ty.List[ty.Tuple[TaskResult, os.stat_result]]
+        for record in records:
+            item_type, tags = _split_query(record)
+            result = TaskResult(item_type, tags, record=record)
+            results.append(result)
+            try:
+                stat = os.stat(self._local.get_path(record))
+            except FileNotFoundError:
+                result.error = exceptions.AssetNotFound('Asset file is missing: {}'.format(record['_path']))
+                continue
+
+            fingerprint = [stat.st_size, stat.st_mtime_ns]
+            if record.get('_size') is not None and stat.st_size != record['_size']:
+                result.error = exceptions.IntegrityError('Asset file has the wrong size: {}'.format(record['_path']))
+            elif not quick:
+                to_hash.append((result, stat))
+            elif fingerprints.get(record['_path'], fingerprint) != fingerprint:
+                result.error = exceptions.IntegrityError(
+                    'Asset file was modified after it was last verified: {}'.format(record['_path']))
+
+        if to_hash:
+            with futures.ProcessPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+                jobs = [(result, stat, executor.submit(util.get_file_sha256, self._local.get_path(result.record)))
+                        for result, stat in to_hash]
+                for result, stat, job in jobs:
+                    try:
+                        sha256 = job.result()
+                    except OSError as e:
+                        result.error = exceptions.AssetNotFound('Could not read asset file: {}'.format(e))
+                        continue
+
+                    if sha256 == result.record.get('_sha256'):
+                        fingerprints[result.record['_path']] = [stat.st_size, stat.st_mtime_ns]
+                    else:
+                        fingerprints.pop(result.record['_path'], None)
+                        result.error = exceptions.IntegrityError(
+                            'Asset file does not match its sha256: {}'.format(result.record['_path']))
+            self._write_fingerprints(fingerprints)
+
+        damaged = [result for result in results if not result.ok]
+        if repair and damaged:
+            results += self._repair(damaged, repair)
+        return results
+
+    def _repair(self, damaged: ty.List[TaskResult], mode: str) -> ty.List[TaskResult]:
+        """
+        Move damaged assets out of the cache (and optionally, download them again)
+
+        Every record that uses a damaged file is repaired, including any that were not checked (eg added by another
+            process in the meantime), so that no record is left pointing at a missing file.
+
+        :return: Results for the additional records that were repaired
+        """
+        with self._lock:
+            self._local.refresh()
+            errors = {result.record['_path']: result.error for result in damaged}
+            shas = {result.record['_path']: result.record['_sha256'] for result in damaged}
+            affected = [item for sha256 in set(shas.values()) for item in self._local.find_by_sha256(sha256)
+                        if item['_path'] in errors]
+            affected = list({id(item): item for item in affected}.values())
+            extra = [TaskResult(*_split_query(item), record=item, error=errors[item['_path']])
+                     for item in affected if not any(item == result.record for result in damaged)]
+            repaired = damaged + extra
+
+            self._local.remove_records(affected)
+            self._local.save()
+            for path_name, error in errors.items():
+                path = self._local.get_path(path_name)
+                if os.path.exists(path):
+                    quarantine_dir = os.path.join(self._local._base_path, '.quarantine')
+                    os.makedirs(quarantine_dir, exist_ok=True)
+                    os.replace(path, os.path.join(quarantine_dir, path_name))
+                if self._blobs is not None:
+                    if isinstance(error, exceptions.IntegrityError):
+                        # A hardlinked copy shares its data with the blob, so the blob is probably damaged as well
+                        self._blobs.discard(shas[path_name])
+                    else:
+                        self._blobs.release(shas[path_name], path)
+            for result in repaired:
+                result.note = 'quarantined'
+
+        if mode == 'redownload':
+            self._remote.load()
+            for result in repaired:
+                record = result.record
+                # The same release of the same asset, or failing that, any record of this type with the same file
+                remote_record = self._remote.find_exact(record['_type'], **record)
+                if remote_record is None or remote_record.get('_sha256') != record['_sha256']:
+                    remote_record = next((item for item in self._remote.find_by_sha256(record['_sha256'])
+                                          if item['_type'] == record['_type']), None)
+                try:
+                    if remote_record is None:
+                        raise exceptions.NoMatchingAsset
+                    result.record, _ = self._download_record(remote_record)
+                    result.note = 'downloaded again'
+                except exceptions.BaseAssetException as e:
+                    logger.warning('Could not download a replacement for {}: {!r}'.format(record['_path'], e))
+        return extra
+
+    def _fingerprint_path(self) -> str:
+        return os.path.join(self._local._base_path, '.verified.json')
+
+    def _read_fingerprints(self) -> ty.Dict[str, list]:
+        """The size and mtime of each file, the last time that it passed a full verification"""
+        try:
+            with open(self._fingerprint_path(), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_fingerprints(self, fingerprints: ty.Dict[str, list]):
+        util.write_atomic(self._fingerprint_path(), json.dumps(fingerprints))
+
+    def gc(self, max_bytes: int = None, keep_versions: int = None, group_by: ty.Iterable[str] = None,
+           dry_run: bool = False) -> ty.List[dict]:
+        """
+        Remove assets from the local cache, to keep only the `keep_versions` newest versions of each asset, and/or to
+            bring the total size of the cache under `max_bytes`
+
+        Versions of an asset are records with the same type and tags (apart from the release date), or with the same
+            values for the tags listed in `group_by` (eg `group_by=['genome_build']` treats each dbSNP build as a
+            version of the same asset). To meet the size budget, older versions are evicted first, followed by
+            the least recently used assets.
+
+        An asset is never evicted while another thread or process is downloading it or holding it (see `hold`).
+
+        :return: The records that were (or with `dry_run`, would be) removed
+        """
+        group_by = sorted(group_by) if group_by is not None else None
+        with self._lock:
+            self._local.refresh()
+            records = [record for record in self._local._items if record.get('_path')]
+
+        # Rank each record within its group of versions (0 = newest)
+        groups = {}  # type: ty.Dict[str, ty.List[dict]]
+        for record in records:
+            groups.setdefault(_version_key(record, group_by), []).append(record)
+
+        candidates = []
+        for versions in groups.values():
+            versions.sort(key=lambda item: item.get('_date') or '', reverse=True)
+            for rank, record in enumerate(versions):
+                try:
+                    stat = os.stat(self._local.get_path(record))
+                except FileNotFoundError:
+                    stat = None
+                candidates.append((rank, record, stat))
+
+        # Superseded versions are evicted unconditionally; after that, the oldest versions and least recently
+        #   used files go first
+        candidates.sort(key=lambda c: (-c[0], c[2].st_atime if c[2] else 0))
+        # Several records may share one file (eg the same file listed under different tags). The file is counted
+        #   once, and only frees space (or is deleted) when the last record that uses it is evicted.
+        refs = collections.Counter(record['_path'] for record in records)
+        sizes = {record['_path']: stat.st_size for _, record, stat in candidates if stat}
+        total_bytes = sum(sizes.values())
+
+        evicted = []  # type: ty.List[dict]
+        locks = {}  # type: ty.Dict[str, locking.FileLock]
+        try:
+            for rank, record, stat in candidates:
+                superseded = keep_versions is not None and rank >= keep_versions
+                over_budget = max_bytes is not None and total_bytes > max_bytes
+                if not superseded and not over_budget:
+                    continue
+
+                path = record['_path']
+                if path not in locks:
+                    lock = self._named_lock(path)
+                    if not lock.acquire(blocking=False):
+                        logger.info('Not evicting an asset that is in use: {}'.format(path))
+                        continue
+                    locks[path] = lock
+                evicted.append(record)
+                refs[path] -= 1
+                if refs[path] == 0:
+                    total_bytes -= sizes.get(path, 0)
+
+            if evicted and not dry_run:
+                # Update the manifest before removing any files, so that no record ever points at a missing file
+                with self._lock:
+                    self._local.remove_records(evicted)
+                    self._local.compact()
+                    in_use = {item['_path'] for record in evicted
+                              for item in self._local.find_by_sha256(record.get('_sha256'))}
+                for record in {record['_path']: record for record in evicted}.values():
+                    if record['_path'] in in_use:
+                        # Another record (perhaps added by another process) still uses this file
+                        continue
+                    path = self._local.get_path(record)
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    if self._blobs is not None and record.get('_sha256'):
+                        self._blobs.release(record['_sha256'], path)
+                    self._last_touched.pop(path, None)
+        finally:
+            for lock in locks.values():
+                lock.release()
+        return evicted
+
+    def __getstate__(self):
+        # A copy of the manager is sent to each worker process during parallel builds. Locks can't be pickled, and
+        #   recipes are often closures; workers receive a manager with neither.
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        state['_recipes'] = manifest.RecipeManifest(self._recipes._manifest_path)
+        state['_prefetching'] = {}
+        state['_prefetch_executor'] = None
+        state['_revalidating'] = set()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+        self._recipes.load()
+
+
+def _run_recipe(manager: AssetManager, recipe_func: ty.Callable, item_type: str, build_folder: str,
+                tags: dict) -> ty.Optional[ty.Tuple[str, dict]]:
+    """
+    Run one recipe (possibly in a worker process). Returns the output filename and build metadata, or None if the
+        recipe reports that the asset already exists.
+    """
+    try:
+        return recipe_func(manager, item_type, build_folder, **tags)
+    except exceptions.AssetAlreadyExists:
+        return None
+
+
+def _recipe_tags(tags: dict) -> dict:
+    """Remove the recipe-only system fields from a query, leaving the tags that describe the asset"""
+    return {key: value for key, value in tags.items() if key not in ('_source', '_depends')}
+
+
+def _is_picklable(value) -> bool:
+    try:
+        pickle.dumps(value)
+    except Exception:
+        return False
+    return True
@@ -2,25 +2,31 @@
 Manifest file class (local or remote)
 """
 import abc
+import copy
 from datetime import datetime
+import gzip
+import hashlib
+import http.client
 import json
 import logging
 import operator
 import os
 import shutil
+import threading
+import time
 import typing as ty
 import urllib.error
 import urllib.parse
-import urllib.request
+import uuid
 
-from . import exceptions, util
+from . import exceptions, locking, mirrors, transfer, util
 
 logger = logging.getLogger(__name__)
 
 SCHEMA_VERSION = 1
 # A list of manifest entries that have meaning for the system, but should not be used when searching for a matching item
 # By convention, most of these have the prefix `_`
-SYSTEM_TAGS = frozenset(['_type', '_label', '_date', '_sha256', '_path', '_size', '_source'])
+SYSTEM_TAGS = frozenset(['_type', '_label', '_date', '_sha256', '_path', '_size', '_source', '_depends'])
 
 
 class ManifestBase(abc.ABC):
@@ -36,6 +42,15 @@ class ManifestBase(abc.ABC):
         self._items = []  # type: ty.List[dict]
         self._collections = []  # type: ty.List[dict]
 
+        # Index records by `_type`, and by (`_type`, tag, value) for every user-defined tag. For each of those keys,
+        #   track all candidate records (in manifest order) as well as the newest record.
+        self._candidates = {}  # type: ty.Dict[tuple, ty.List[dict]]
+        self._newest = {}  # type: ty.Dict[tuple, dict]
+        # Records that have a file, by content hash (the same file may be listed more than once, eg under other tags)
+        self._by_sha256 = {}  # type: ty.Dict[str, ty.List[dict]]
+        # Incremented whenever the list of records changes, so that callers can tell when cached lookups are stale
+        self._generation = 0  # type: int
+
         self._loaded = False  # type: bool
 
     # Helper methods for working with manifest
@@ -49,27 +64,107 @@ class ManifestBase(abc.ABC):
         if not self._loaded:
             raise exceptions.ManifestNotFound('Manifest must be loaded before using')
 
-        # Find every record for which the item ID and all user-provided tags describing the record are an exact match
-        #  (but do not consider "system tags" like "filesize", which do not part of how we label items)
+        # Find the newest record for which the item ID and all user-provided tags describing the record are an exact
+        #  match (but do not consider "system tags" like "filesize", which do not part of how we label items)
+        tags = [(key, value) for key, value in kwargs.items() if key not in SYSTEM_TAGS]
+        match = self._find_newest(item_type, tags)
+        if match is None and err_on_missing:
+            raise exceptions.NoMatchingAsset
+        return match
+
+    def _find_newest(self, item_type: str, tags: ty.List[tuple]) -> ty.Optional[dict]:
+        """Use the index to find the newest record that matches all tags, without scanning the whole manifest"""
+        try:
+            keys = [(item_type, key, value) for key, value in tags]
+            if len(keys) <= 1:
+                # The newest match for a single key is tracked as records are added
+                return self._newest.get(keys[0] if keys else (item_type,))
+            candidates = min((self._candidates.get(key, []) for key in keys), key=len)
+        except TypeError:
+            # Unhashable tag values can't be looked up in the index; check every record of this type instead
+            candidates = self._candidates.get((item_type,), [])
+
         matches = [
-            item for item in self._items
-            if item['_type'] == item_type and all(
-                key in item and item[key] == value
-                for key, value in kwargs.items()
-                if key not in SYSTEM_TAGS
-            )
+            item for item in candidates
+            if all(key in item and item[key] == value for key, value in tags)
         ]
-        n_matches = len(matches)
-        if not n_matches:
-            if err_on_missing:
-                raise exceptions.NoMatchingAsset
-            else:
-                return None
+        # Ties go to the record that appears first in the manifest
+        return max(matches, key=operator.itemgetter('_date'), default=None)
 
-        logging.debug('Query for {} found {} matches', item_type, n_matches)
+    def find_by_sha256(self, sha256: str) -> ty.List[dict]:
+        """Find every record (with a file) whose contents have the given hash"""
+        return list(self._by_sha256.get(sha256, []))
 
-        match = sorted(matches, key=operator.itemgetter('_date'), reverse=True)[0]
-        return match
+    def find_exact(self, item_type: str, **kwargs) -> ty.Optional[dict]:
+        """
+        Find the record whose user-defined tags are exactly those given. Unlike `locate`, a record that has additional
+            tags (eg a newer release of the same asset) is not a match.
+        """
+        tags = {key: value for key, value in kwargs.items() if key not in SYSTEM_TAGS}
+        try:
+            keys = [(item_type, key, value) for key, value in tags.items()] or [(item_type,)]
+            candidates = min((self._candidates.get(key, []) for key in keys), key=len)
+        except TypeError:
+            candidates = self._candidates.get((item_type,), [])
+        for record in candidates:
+            if {key: value for key, value in record.items() if key not in SYSTEM_TAGS} == tags:
+                return record
+        return None
+
+    @staticmethod
+    def _index_keys(record: dict) -> ty.List[tuple]:
+        keys = [(record['_type'],)]
+        for key, value in record.items():
+            if key in SYSTEM_TAGS:
+                continue
+            index_key = (record['_type'], key, value)
+            try:
+                hash(index_key)
+            except TypeError:
+                # Records with unhashable tag values are still found through the `_type` index
+                continue
+            keys.append(index_key)
+        return keys
+
+    def _index_record(self, record: dict):
+        if record.get('_sha256') and record.get('_path'):
+            self._by_sha256.setdefault(record['_sha256'], []).append(record)
+
+        for index_key in self._index_keys(record):
+            self._candidates.setdefault(index_key, []).append(record)
+            newest = self._newest.get(index_key)
+            if newest is None or record['_date'] > newest['_date']:
+                self._newest[index_key] = record
+
+    def _unindex_records(self, records: ty.List[dict]):
+        """Remove records from the index. Only the index entries for their own tags are updated."""
+        removed = {id(record) for record in records}
+        keys = {index_key for record in records for index_key in self._index_keys(record)}
+        for index_key in keys:
+            remaining = [item for item in self._candidates.get(index_key, []) if id(item) not in removed]
+            if not remaining:
+                self._candidates.pop(index_key, None)
+                self._newest.pop(index_key, None)
+                continue
+            self._candidates[index_key] = remaining
+            if id(self._newest.get(index_key)) in removed:
+                # Ties go to the record that appears first in the manifest, as when the record was added
+                self._newest[index_key] = max(remaining, key=operator.itemgetter('_date'))
+
+        for sha256 in {record.get('_sha256') for record in records}:
+            remaining = [item for item in self._by_sha256.get(sha256, []) if id(item) not in removed]
+            if remaining:
+                self._by_sha256[sha256] = remaining
+            else:
+                self._by_sha256.pop(sha256, None)
+
+    def _reindex(self):
+        self._generation += 1
+        self._candidates = {}
+        self._newest = {}
+        self._by_sha256 = {}
+        for record in self._items:
+            self._index_record(record)
 
     @abc.abstractmethod
     def get_path(self, basename: ty.Union[str, dict]) -> str:
@@ -77,13 +172,25 @@ class ManifestBase(abc.ABC):
         pass
 
     def add_record(self, item_type, *, source_path: str = None, label: str = None, date: ty.Optional[str] = None,
-                   copy_file=False, move_file=False,
-                   **kwargs):
+                   copy_file=False, move_file=False, sha256: str = None, link: bool = False,
+                   allow_versions: bool = False, **kwargs):
         """
         Add an item record to the internal manifest (and optionally ensure that the file is in the manifest path
          in a systematic format of `sha_basename`)
+
+        If the sha256 of the source file is already known (eg it was calculated while the file was written), pass it
+            in to avoid reading the whole file again. When copying, `link=True` allows the cache to hardlink the source
+            file instead (only safe if the source will never be modified in place).
+
+        A record is refused if `locate` would already find a match for its tags. Records copied from another manifest
+            (eg a download) may be different versions of one asset, where a newer release only adds tags. Pass
+            `allow_versions=True` to refuse only a record with exactly the same tags as an existing one.
         """
-        if self.locate(item_type, err_on_missing=False, **kwargs):
+        if allow_versions:
+            existing = self.find_exact(item_type, **kwargs)
+        else:
+            existing = self.locate(item_type, err_on_missing=False, **kwargs)
+        if existing is not None:
             raise exceptions.ImmutableManifestError('Attempted to add a record that already exists. '
                                                     'The specified tags may be ambiguous.')
 
@@ -98,12 +205,19 @@ class ManifestBase(abc.ABC):
 
         if copy_file or move_file:
             # Move the file to the cached asset folder, and track some extra metadata in the manifest
-            sha256 = util.get_file_sha256(source_path)
-            date = datetime.utcfromtimestamp(os.path.getmtime(source_path)).isoformat()
+            date = date or datetime.utcfromtimestamp(os.path.getmtime(source_path)).isoformat()
             size = os.path.getsize(source_path)
-            dest_fn = '{}_{}'.format(sha256, os.path.basename(source_path))
-            copy_func = shutil.copy2 if copy_file else shutil.move
-            copy_func(source_path, self.get_path(dest_fn))  # type: ignore
+            basename = os.path.basename(source_path)
+            if copy_file:
+                # The destination name depends on the hash, so copy (and hash, in the same pass) to a temp name first
+                tmp_path = self.get_path('.{}.{}.import'.format(uuid.uuid4().hex, basename))
+                sha256 = util.copy_file_hashed(source_path, tmp_path, sha256=sha256, allow_link=link)
+                dest_fn = '{}_{}'.format(sha256, basename)
+                os.replace(tmp_path, self.get_path(dest_fn))
+            else:
+                sha256 = sha256 or util.get_file_sha256(source_path)
+                dest_fn = '{}_{}'.format(sha256, basename)
+                shutil.move(source_path, self.get_path(dest_fn))  # type: ignore
 
             record['_path'] = dest_fn
             record['_sha256'] = sha256
@@ -111,13 +225,33 @@ class ManifestBase(abc.ABC):
 
         record['_date'] = date or datetime.utcnow().isoformat()
         self._items.append(record)
+        self._index_record(record)
+        self._generation += 1
         return record
 
+    def remove_record(self, record: dict):
+        """Stop tracking an item (this does not delete any files)"""
+        self.remove_records([record])
+
+    def remove_records(self, records: ty.Iterable[dict]):
+        """
+        Stop tracking several items at once (this does not delete any files). The index is updated in place, rather
+            than rebuilt, so removing a batch of records costs one pass over the manifest.
+        """
+        records = list(records)
+        if not records:
+            return
+        removed = {id(record) for record in records}
+        self._items = [item for item in self._items if id(item) not in removed]
+        self._unindex_records(records)
+        self._generation += 1
+
     # Reading contents to and from the datastore. Some methods may not be defined for all data types.
     def _parse(self, contents: dict):
         """Parse a JSON object"""
         self._items = contents['items']
         self._collections = contents['collections']
+        self._reindex()
 
     def _serialize(self) -> dict:
         return {
@@ -142,72 +276,494 @@ class ManifestBase(abc.ABC):
 class LocalManifest(ManifestBase):
     """
     Track a list of all packages that exist locally (eg have been created or downloaded at any time)
+
+    Several processes may share one cache directory. New records are appended to a journal file (`.journal`) under a
+        file lock, so that adding a record costs O(1) I/O and never overwrites changes made by someone else. The
+        journal is replayed on load, and periodically compacted into the main `manifest.json`.
     """
+    def __init__(self, manifest_path, *args, compact_every: int = 100, **kwargs):
+        super(LocalManifest, self).__init__(manifest_path, *args, **kwargs)
+        self._journal_path = '{}.journal'.format(manifest_path)  # type: str
+        self._lock_path = '{}.lock'.format(manifest_path)  # type: str
+        self._compact_every = compact_every  # type: int
+
+        # Changes made in this process that have not been written to the journal yet
+        self._pending = []  # type: ty.List[dict]
+        # How much of the shared state on disk is reflected in memory
+        self._journal_offset = 0  # type: int
+        self._journal_entries = 0  # type: int
+        self._manifest_stat = None  # type: ty.Optional[tuple]
+        # Records by their canonical form (see `_record_key`), to apply journal entries written by other processes
+        self._record_keys = {}  # type: ty.Dict[str, ty.List[dict]]
+
     def get_path(self, basename):
         """Get the path for a file record"""
         if isinstance(basename, dict):
             basename = basename['_path']
         return os.path.join(self._base_path, basename)
 
+    def add_record(self, item_type, **kwargs):
+        record = super(LocalManifest, self).add_record(item_type, **kwargs)
+        self._pending.append({'op': 'add', 'record': record})
+        return record
+
+    def remove_records(self, records: ty.Iterable[dict]):
+        records = list(records)
+        super(LocalManifest, self).remove_records(records)
+        self._pending.extend({'op': 'remove', 'record': record} for record in records)
+
     def load(self, data=None):
         if self._loaded:
             return
 
-        if data is None:
-            try:
-                with open(self._manifest_path, 'r') as f:
-                    data = json.load(f)
-            except FileNotFoundError:
-                # Save an empty manifest as a starter, then load it
-                self.save()
-                return self.load()
-            except IOError:
-                raise exceptions.ManifestNotFound
+        if data is not None:
+            # Explicitly provided records are treated as new additions, and merged with the file on disk upon save
+            super(LocalManifest, self).load(data)
+            self._pending = [{'op': 'add', 'record': record} for record in self._items]
+            return
 
-        super(LocalManifest, self).load(data)
+        try:
+            # Reading needs no write access, so a cache can be used from a read-only location
+            self._read_locked(self._read_from_disk)
+            if self._manifest_stat is None:
+                with self._lock():
+                    self._read_from_disk()
+                    if self._manifest_stat is None:
+                        # Save an empty manifest as a starter
+                        self._write_compacted()
+        except (IOError, ValueError):
+            raise exceptions.ManifestNotFound
+        self._loaded = True
 
     def save(self):
-        with open(self._manifest_path, 'w') as f:
+        """Record all local changes in the journal, and merge in any changes that were saved by other processes"""
+        with self._lock():
+            self._save(compact=False)
+
+    def compact(self):
+        """Save, and fold all journal entries into the main manifest file"""
+        with self._lock():
+            self._save(compact=True)
+
+    def refresh(self):
+        """Pick up any records that were saved by other processes since this manifest was loaded"""
+        self._read_locked(self._sync_from_disk)
+
+    # Internal helpers. All methods that touch files on disk assume that the caller holds the lock.
+    def _lock(self, shared=False) -> locking.FileLock:
+        return locking.FileLock(self._lock_path, shared=shared)
+
+    def _read_locked(self, read: ty.Callable[[], None]):
+        """
+        Read from disk under a shared lock. If the lock can't be taken (eg the cache is on a read-only filesystem, or
+            belongs to another user), read without it: the main manifest is only ever replaced atomically, and a
+            partial journal entry is ignored, so a reader at worst misses changes that were made while it was reading.
+        """
+        try:
+            lock = self._lock(shared=True)  # type: ty.Optional[locking.FileLock]
+            lock.acquire()
+        except OSError:
+            lock = None
+        try:
+            read()
+        finally:
+            if lock is not None:
+                lock.release()
+
+    def _save(self, compact: bool):
+        self._sync_from_disk()
+        if self._pending:
+            lines = ''.join(json.dumps(op, sort_keys=True) + '\n' for op in self._pending)
+            with open(self._journal_path, 'a') as f:
+                f.write(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            self._journal_offset = os.path.getsize(self._journal_path)
+            self._journal_entries += len(self._pending)
+            self._pending = []
+
+        if compact or self._manifest_stat is None or self._journal_entries >= self._compact_every:
+            self._write_compacted()
+        self._loaded = True
+
+    def _sync_from_disk(self):
+        manifest_changed = _stat_key(self._manifest_path) != self._manifest_stat
+        if manifest_changed or _file_size(self._journal_path) < self._journal_offset:
+            # Another process has compacted the journal (or replaced the manifest): start over from the new file
+            self._read_from_disk()
+        else:
+            self._replay_journal()
+
+    def _read_from_disk(self):
+        try:
+            with open(self._manifest_path, 'r') as f:
+                stat = os.fstat(f.fileno())
+                data = json.load(f)
+            self._manifest_stat = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            data = {'items': [], 'collections': []}
+            self._manifest_stat = None
+
+        self._parse(data)
+        self._journal_offset = 0
+        self._journal_entries = 0
+        self._replay_journal()
+
+        # Changes that were made in memory (but not yet saved) still apply on top of the new state
+        for op in self._pending:
+            self._apply(op)
+
+    def _replay_journal(self):
+        try:
+            with open(self._journal_path, 'rb') as f:
+                f.seek(self._journal_offset)
+                contents = f.read()
+        except FileNotFoundError:
+            return
+
+        # Ignore a trailing partial line (eg from a writer that crashed midway); it is not part of the journal yet
+        complete = contents[:contents.rfind(b'\n') + 1]
+        for line in complete.splitlines():
+            if line.strip():
+                self._apply(json.loads(line.decode('utf-8')))
+                self._journal_entries += 1
+        self._journal_offset += len(complete)
+
+    def _apply(self, op: dict):
+        record = op['record']
+        key = _record_key(record)
+        if op['op'] == 'add' and key not in self._record_keys:
+            self._items.append(record)
+            self._index_record(record)
+            self._generation += 1
+        elif op['op'] == 'remove' and key in self._record_keys:
+            # Every copy of the record is removed. This is not a new change, so it is not added to the journal again.
+            ManifestBase.remove_records(self, self._record_keys[key])
+
+    def _index_record(self, record: dict):
+        super(LocalManifest, self)._index_record(record)
+        self._record_keys.setdefault(_record_key(record), []).append(record)
+
+    def _unindex_records(self, records: ty.List[dict]):
+        super(LocalManifest, self)._unindex_records(records)
+        removed = {id(record) for record in records}
+        for key in {_record_key(record) for record in records}:
+            remaining = [item for item in self._record_keys.get(key, []) if id(item) not in removed]
+            if remaining:
+                self._record_keys[key] = remaining
+            else:
+                self._record_keys.pop(key, None)
+
+    def _reindex(self):
+        self._record_keys = {}
+        super(LocalManifest, self)._reindex()
+
+    def _write_compacted(self):
+        # Write the complete manifest to a temp file and rename it into place, so that readers never see a partial file
+        tmp_path = '{}.tmp'.format(self._manifest_path)
+        with open(tmp_path, 'w') as f:
             json.dump(
                 self._serialize(),
                 f,
                 indent=2,
                 sort_keys=True
             )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._manifest_path)
+
+        # Every journal entry is now part of the manifest
+        open(self._journal_path, 'w').close()
+        self._journal_offset = 0
+        self._journal_entries = 0
+        self._manifest_stat = _stat_key(self._manifest_path)
+
+
+class SharedManifest(LocalManifest):
+    """
+    A read-only view of an asset cache that is maintained by someone else, eg a site-wide copy on a shared filesystem
+
+    The cache uses the same layout as a `LocalManifest` (and is usually populated by one). If the folder is not
+        writable, it is read without a lock (see `LocalManifest._read_locked`).
+    """
+    def add_record(self, item_type, **kwargs):
+        raise exceptions.ImmutableManifestError('Shared manifests are read-only: {}'.format(self._manifest_path))
+
+    def remove_records(self, records: ty.Iterable[dict]):
+        raise exceptions.ImmutableManifestError('Shared manifests are read-only: {}'.format(self._manifest_path))
+
+    def save(self):
+        raise exceptions.ImmutableManifestError('Shared manifests are read-only: {}'.format(self._manifest_path))
+
+    compact = save
+
+    def load(self, data=None):
+        if self._loaded:
+            return
+
+        if data is not None:
+            ManifestBase.load(self, data)
+            return
+
+        try:
+            self._read_locked(self._read_from_disk)
+        except (IOError, ValueError):
+            raise exceptions.ManifestNotFound
+        if self._manifest_stat is None:
+            raise exceptions.ManifestNotFound('Shared manifest does not exist: {}'.format(self._manifest_path))
+        self._loaded = True
+
+
+def _record_key(record: dict) -> str:
+    """A canonical representation of a record, used to recognize the same record written by different processes"""
+    return json.dumps(record, sort_keys=True, default=str)
+
+
+def _stat_key(path: str) -> ty.Optional[tuple]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
 
 
 class RemoteManifest(ManifestBase):
     """
     Track a list of all packages currently available for download, according to a remote server
+
+    If a `cache_dir` is provided, the downloaded manifest is saved there along with its `ETag`/`Last-Modified`
+        headers. A cached copy younger than `ttl` seconds is used without any network access; an older one is
+        revalidated with a conditional request. If the server cannot be reached, the cached copy is used regardless
+        of age.
+
+    The same manifest (and files) may be available from several `mirrors`, given as the URLs of their manifests. The
+        fastest mirror is used, with automatic failover to the others. With `hedge_delay`, a manifest request that
+        has not been answered within that many seconds is also sent to the next best mirror.
+
+    One thread at a time loads or refreshes the manifest; the others keep using the current contents. A refreshed
+        index is swapped in while holding the lock that lookups use, so a lookup never sees half of the swap.
     """
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, cache_dir: str = None, ttl: float = 3600, mirrors: ty.Iterable[str] = (),
+                 hedge_delay: float = None, transport: transfer.Transport = None, **kwargs):
         super(RemoteManifest, self).__init__(*args, **kwargs)
         if not self._base_path.endswith('/'):
             self._base_path += '/'
+        # All requests share a pool of persistent connections
+        self._transport = transport
+        self.mirrors = _make_mirror_set([self._manifest_path] + list(mirrors), transport)
+        self._hedge_delay = hedge_delay
+
+        self._cache_path = None  # type: ty.Optional[str]
+        if cache_dir:
+            url_hash = hashlib.sha1(self._manifest_path.encode('utf-8')).hexdigest()
+            self._cache_path = os.path.join(cache_dir, '.remote', '{}.json'.format(url_hash))
+        self._ttl = ttl
+        self._loaded_at = None  # type: ty.Optional[float]
+
+        self._index_lock = threading.RLock()
+        self._refresh_lock = threading.Lock()
+
+    def __getstate__(self):
+        # Locks can't be pickled (eg when a manager is sent to a worker process); each copy gets its own
+        state = self.__dict__.copy()
+        del state['_index_lock'], state['_refresh_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._index_lock = threading.RLock()
+        self._refresh_lock = threading.Lock()
 
     def get_path(self, basename):
         if isinstance(basename, dict):
             basename = basename['_path']
         return urllib.parse.urljoin(self._base_path, basename)
 
+    def get_mirror_path(self, mirror_url: str, basename: ty.Union[str, dict]) -> str:
+        """Get the URL of an asset on a specific mirror (identified by the URL of its manifest)"""
+        if isinstance(basename, dict):
+            basename = basename['_path']
+        return urllib.parse.urljoin(mirror_url, basename)
+
     def load(self, data=None):
         """
-        Download a manifest file from a remote URL
+        Download a manifest file from a remote URL (or use a recent copy, if one has been cached)
         """
         if self._loaded:
             return
 
-        if data is None:
-            try:
-                with urllib.request.urlopen(self._manifest_path) as response:
-                    body = response.read()  # type: bytes
-            except urllib.error.URLError:
-                raise exceptions.ManifestNotFound
+        with self._refresh_lock:
+            if self._loaded:
+                # Another thread loaded it while this one was waiting
+                return
+            if data is None:
+                data = self._fetch()
+            with self._index_lock:
+                super(RemoteManifest, self).load(data)
+                self._loaded_at = time.monotonic()
+
+    def refresh(self):
+        """
+        Pick up a newer release of the remote manifest, at most once every `ttl` seconds. Lookups made while the
+            refresh is in progress (eg from other threads) see either the old or the new contents.
+        """
+        if not self._loaded:
+            self.load()
+            return
+        if time.monotonic() - self._loaded_at < self._ttl:
+            return
+        if not self._refresh_lock.acquire(blocking=False):
+            # Another thread is already refreshing; until it is done, the current contents are still good to use
+            return
+        try:
+            if time.monotonic() - self._loaded_at < self._ttl:
+                return
+            # Build the new index separately, then swap it in
+            fresh = copy.copy(self)
+            fresh._parse(self._fetch())
+            with self._index_lock:
+                self._items, self._collections = fresh._items, fresh._collections
+                self._candidates, self._newest, self._by_sha256 = fresh._candidates, fresh._newest, fresh._by_sha256
+                self._generation = fresh._generation
+                self._loaded_at = time.monotonic()
+        finally:
+            self._refresh_lock.release()
+
+    def locate(self, item_type, err_on_missing=True, **kwargs) -> ty.Optional[dict]:
+        with self._index_lock:
+            return super(RemoteManifest, self).locate(item_type, err_on_missing=err_on_missing, **kwargs)
+
+    def find_by_sha256(self, sha256: str) -> ty.List[dict]:
+        with self._index_lock:
+            return super(RemoteManifest, self).find_by_sha256(sha256)
+
+    def find_exact(self, item_type: str, **kwargs) -> ty.Optional[dict]:
+        with self._index_lock:
+            return super(RemoteManifest, self).find_exact(item_type, **kwargs)
 
-            text = body.decode(response.info().get_param('charset', 'utf-8'))  # type: ignore
-            data = json.loads(text)
+    def _fetch(self) -> dict:
+        cached_meta = self._read_cache_meta()
+        cached = self._fresh_cache(cached_meta)
+        if cached is not None:
+            return cached
+
+        def request(url: str) -> ty.Tuple[ty.Optional[bytes], ty.Any]:
+            try:
+                with transfer.open_url(url, headers=self._request_headers(cached_meta, url),
+                                       transport=self._transport) as response:
+                    return response.read(), response.headers
+            except urllib.error.HTTPError as e:
+                if e.code == 304 and cached_meta:
+                    e.close()
+                    return None, None
+                raise
+
+        try:
+            url, (body, response_headers) = self.mirrors.call(request, hedge_delay=self._hedge_delay)
+        except urllib.error.HTTPError as e:
+            e.close()
+            raise exceptions.ManifestNotFound
+        except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+            return self._offline(cached_meta, e)
+        return self._accept(cached_meta, url, body, response_headers)
+
+    # The steps of fetching a manifest, shared with the async implementation
+    def _fresh_cache(self, cached_meta: ty.Optional[dict]) -> ty.Optional[dict]:
+        """The cached copy of the manifest, if it is recent enough to use without asking the server"""
+        if cached_meta and time.time() - cached_meta['fetched'] < self._ttl:
+            cached = self._read_cache()
+            if cached is not None:
+                logger.debug('Using cached copy of remote manifest: {}'.format(self._manifest_path))
+                return cached
+        return None
+
+    @staticmethod
+    def _request_headers(cached_meta: ty.Optional[dict], url: str) -> dict:
+        headers = {'Accept-Encoding': 'gzip'}
+        # Validators are only meaningful to the mirror that issued them
+        if cached_meta and cached_meta.get('url') == url:
+            if cached_meta.get('etag'):
+                headers['If-None-Match'] = cached_meta['etag']
+            if cached_meta.get('last_modified'):
+                headers['If-Modified-Since'] = cached_meta['last_modified']
+        return headers
+
+    def _offline(self, cached_meta: ty.Optional[dict], error: Exception) -> dict:
+        """Fall back to the cached copy (of any age) if the server can't be reached"""
+        cached = self._read_cache() if cached_meta else None
+        if cached is None:
+            raise exceptions.ManifestNotFound
+        logger.warning('Could not reach {} ({}); using the cached copy'.format(self._manifest_path, error))
+        return cached
+
+    def _accept(self, cached_meta: ty.Optional[dict], url: str, body: ty.Optional[bytes], response_headers) -> dict:
+        """Parse (and cache) the server's response. A body of None means "not modified"."""
+        if body is None:
+            # Not modified: the cached copy is still current, and good for another `ttl` seconds
+            cached = self._read_cache()
+            if cached is not None:
+                self._write_cache_meta({**cached_meta, 'fetched': time.time()})  # type: ignore
+                return cached
+            raise exceptions.ManifestNotFound
 
-        super(RemoteManifest, self).load(data)
+        if response_headers.get('Content-Encoding', '').lower() == 'gzip':
+            body = gzip.decompress(body)
+        text = body.decode(response_headers.get_param('charset', 'utf-8'))  # type: ignore
+        data = json.loads(text)
+
+        if self._cache_path:
+            self._write_cache(text, {
+                'url': url,
+                'etag': response_headers.get('ETag'),
+                'last_modified': response_headers.get('Last-Modified'),
+                'fetched': time.time(),
+            })
+        return data
+
+    # Local copies of the remote manifest are stored as a pair of files: the manifest itself, and response metadata
+    def _read_cache_meta(self) -> ty.Optional[dict]:
+        if not self._cache_path:
+            return None
+        try:
+            with open(self._cache_path + '.meta', 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _read_cache(self) -> ty.Optional[dict]:
+        try:
+            with open(self._cache_path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _write_cache(self, text: str, meta: dict):
+        try:
+            os.makedirs(os.path.dirname(self._cache_path), exist_ok=True)
+            util.write_atomic(self._cache_path, text)
+            self._write_cache_meta(meta)
+        except OSError as e:
+            # The cache is an optimization: a read-only cache directory should not prevent use of the remote manifest
+            logger.warning('Could not cache remote manifest: {}'.format(e))
+
+    def _write_cache_meta(self, meta: dict):
+        util.write_atomic(self._cache_path + '.meta', json.dumps(meta))
+
+
+def _make_mirror_set(urls: ty.List[str], transport: ty.Optional[transfer.Transport]) -> mirrors.MirrorSet:
+    # The same mirror may be listed twice (eg the primary URL is repeated in the list of mirrors)
+    unique = []  # type: ty.List[str]
+    for url in urls:
+        if url not in unique:
+            unique.append(url)
+    return mirrors.MirrorSet(unique, transport=transport)
 
 
 class RecipeManifest(ManifestBase):
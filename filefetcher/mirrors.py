@@ -0,0 +1,196 @@
+"""
+Choose between several mirrors of the same remote manifest, based on how quickly each one has responded
+"""
+from concurrent import futures
+import logging
+import threading
+import time
+import typing as ty
+import urllib.error
+
+from . import exceptions, transfer
+
+logger = logging.getLogger(__name__)
+
+# Errors that mean "this mirror could not provide the file", and another mirror should be tried
+MIRROR_ERRORS = (exceptions.BaseAssetException,) + transfer.RETRYABLE_ERRORS
+
+# Mirrors are compared by the estimated time to fetch this many bytes
+_REFERENCE_SIZE = 2 ** 20
+# Transfers smaller than this measure latency rather than throughput
+_MIN_THROUGHPUT_SAMPLE = 2 ** 16
+# Weight of the newest measurement in the moving averages
+_SMOOTHING = 0.3
+
+
+class _MirrorStats:
+    def __init__(self):
+        self.latency = None  # type: ty.Optional[float]
+        self.throughput = None  # type: ty.Optional[float]
+        self.failed_at = None  # type: ty.Optional[float]
+
+    def score(self) -> float:
+        """Estimated seconds to fetch a reference-sized file (lower is better)"""
+        if self.latency is None:
+            return float('inf')
+        if not self.throughput:
+            return self.latency
+        return self.latency + _REFERENCE_SIZE / self.throughput
+
+
+def _smooth(old: ty.Optional[float], new: float) -> float:
+    return new if old is None else (1 - _SMOOTHING) * old + _SMOOTHING * new
+
+
+class MirrorSet:
+    """
+    A list of URLs that serve identical copies of a manifest (and its files), ranked by measured speed
+
+    Every mirror is probed once, the first time the ranking is needed. After that, the ranking is updated from the
+        timing of real requests. A mirror that fails is moved to the back of the list for `failure_cooldown` seconds.
+    """
+    def __init__(self, urls: ty.Iterable[str], probe_timeout: float = 5.0, failure_cooldown: float = 60.0,
+                 transport: transfer.Transport = None):
+        self.urls = list(urls)
+        if not self.urls:
+            raise ValueError('At least one mirror URL is required')
+        self.probe_timeout = probe_timeout
+        self.failure_cooldown = failure_cooldown
+        self.transport = transport
+        self._stats = {url: _MirrorStats() for url in self.urls}
+        self._lock = threading.Lock()
+        self._probed = len(self.urls) == 1  # Nothing to choose between
+
+    def __getstate__(self):
+        # Copies (eg sent to another process) keep the measurements made so far, but not the lock
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def ranked(self) -> ty.List[str]:
+        """All mirrors, best first. Mirrors that have not been measured keep their configured order."""
+        if not self._probed:
+            self.probe()
+
+        now = time.monotonic()
+        with self._lock:
+            def sort_key(url: str):
+                stats = self._stats[url]
+                cooling_down = stats.failed_at is not None and now - stats.failed_at < self.failure_cooldown
+                return cooling_down, stats.score()
+            return sorted(self.urls, key=sort_key)
+
+    def probe(self):
+        """Measure the latency of every mirror (concurrently), by fetching the first byte of its manifest"""
+        def probe_one(url: str):
+            start = time.monotonic()
+            try:
+                fetch_first_byte(url, timeout=self.probe_timeout, transport=self.transport)
+            except transfer.RETRYABLE_ERRORS as e:
+                logger.info('Mirror {} is not responding: {}'.format(url, e))
+                self.record_failure(url)
+                return
+            self.record(url, time.monotonic() - start)
+
+        with futures.ThreadPoolExecutor(max_workers=len(self.urls)) as executor:
+            list(executor.map(probe_one, self.urls))
+        self._probed = True
+
+    def record(self, url: str, elapsed: float, n_bytes: int = 0):
+        """Update the speed estimates for a mirror after a successful request"""
+        with self._lock:
+            stats = self._stats[url]
+            stats.failed_at = None
+            if n_bytes >= _MIN_THROUGHPUT_SAMPLE:
+                stats.throughput = _smooth(stats.throughput, n_bytes / max(elapsed, 1e-6))
+            else:
+                stats.latency = _smooth(stats.latency, elapsed)
+
+    def record_failure(self, url: str):
+        with self._lock:
+            self._stats[url].failed_at = time.monotonic()
+
+    def call(self, func: ty.Callable[[str], ty.Any], hedge_delay: float = None,
+             prefer: str = None) -> ty.Tuple[str, ty.Any]:
+        """
+        Call `func(mirror_url)` on the best mirror, failing over to the next one (in rank order) on error. File
+            transfers (calls that return a `TransferResult`) also update the throughput estimate.
+
+        With `hedge_delay`, if the best mirror has not answered within that many seconds, the same call is also
+            made to the second best, and whichever succeeds first is used. Only hedge calls that are safe to repeat:
+            the slower call keeps running in the background, unless `func` stops it once the other has succeeded.
+
+        A `prefer`red mirror (eg the winner of an earlier hedged request) is tried first, regardless of rank.
+
+        :return: The URL of the mirror that answered, and the result of the call
+        """
+        ranked = self.ranked()
+        if prefer in ranked:
+            ranked.remove(prefer)
+            ranked.insert(0, prefer)
+        if hedge_delay is not None and len(ranked) > 1:
+            try:
+                return self._hedged(func, ranked[:2], hedge_delay)
+            except MIRROR_ERRORS as e:
+                if len(ranked) == 2:
+                    raise e
+            ranked = ranked[2:]
+
+        error = None  # type: ty.Optional[BaseException]
+        for url in ranked:
+            try:
+                return url, self._timed(func, url)
+            except urllib.error.HTTPError as e:
+                e.close()
+                error = e
+            except MIRROR_ERRORS as e:
+                error = e
+            logger.info('Mirror {} failed ({}); trying the next one'.format(url, error))
+        raise error  # type: ignore
+
+    def _timed(self, func: ty.Callable[[str], ty.Any], url: str):
+        start = time.monotonic()
+        try:
+            result = func(url)
+        except MIRROR_ERRORS:
+            self.record_failure(url)
+            raise
+        n_bytes = result.n_bytes if isinstance(result, transfer.TransferResult) else 0
+        self.record(url, time.monotonic() - start, n_bytes)
+        return result
+
+    def _hedged(self, func: ty.Callable[[str], ty.Any], urls: ty.List[str],
+                hedge_delay: float) -> ty.Tuple[str, ty.Any]:
+        executor = futures.ThreadPoolExecutor(max_workers=len(urls))
+        try:
+            jobs = {executor.submit(self._timed, func, urls[0]): urls[0]}
+            done, _ = futures.wait(jobs, timeout=hedge_delay)
+            if not done:
+                logger.debug('Mirror {} is slow to answer; also trying {}'.format(urls[0], urls[1]))
+                jobs[executor.submit(self._timed, func, urls[1])] = urls[1]
+
+            error = None  # type: ty.Optional[BaseException]
+            pending = set(jobs)
+            while pending:
+                done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                for job in done:
+                    if job.exception() is None:
+                        return jobs[job], job.result()
+                    error = job.exception()
+
+            if len(jobs) < len(urls):
+                # The first mirror failed quickly, before the hedge was sent
+                return urls[1], self._timed(func, urls[1])
+            raise error  # type: ignore
+        finally:
+            executor.shutdown(wait=False)
+
+
+def fetch_first_byte(url: str, timeout: float = None, transport: transfer.Transport = None) -> bytes:
+    """A cheap request that measures how quickly a server starts to respond"""
+    with transfer.open_url(url, headers={'Range': 'bytes=0-0'}, timeout=timeout, transport=transport) as response:
+        return response.read(1)
@@ -0,0 +1,67 @@
+"""
+Requirements lists: the assets that an application will need, declared up front so that they can be fetched (or built)
+    before first use
+
+A requirement is a query, in the same form used elsewhere (eg the `depends_on` argument of a recipe): a dict with an
+    `_type` key, plus any tags. In code, an `(item_type, tags)` pair is also accepted. In a file, requirements are a
+    JSON list, or a list under the key `assets` (as a JSON object, or as an array of tables in TOML):
+
+    [[assets]]
+    _type = "snp_to_rsid"
+    genome_build = "GRCh38"
+"""
+import json
+import os
+import typing as ty
+
+from . import exceptions
+
+try:
+    import tomllib  # type: ignore
+except ImportError:  # pragma: no cover
+    try:
+        import tomli as tomllib  # type: ignore
+    except ImportError:
+        tomllib = None  # TOML files are only supported on Python 3.11+, or where `tomli` is installed
+
+Requirement = ty.Union[dict, ty.Tuple[str, dict]]
+
+
+def parse(items: ty.Iterable[Requirement]) -> ty.List[dict]:
+    """Validate a list of requirements, and convert each to a query dict"""
+    queries = []
+    for item in items:
+        if isinstance(item, (tuple, list)) and len(item) == 2 and isinstance(item[0], str):
+            item_type, tags = item
+            query = dict(tags or {}, _type=item_type)
+        elif isinstance(item, dict) and isinstance(item.get('_type'), str):
+            query = dict(item)
+        else:
+            raise exceptions.InvalidRequirements('Each requirement must specify an asset type: {!r}'.format(item))
+        queries.append(query)
+    return queries
+
+
+def load(path: str) -> ty.List[dict]:
+    """Read a list of requirements from a JSON or TOML file (by extension)"""
+    path = str(path)
+    try:
+        if os.path.splitext(path)[1].lower() == '.toml':
+            if tomllib is None:
+                raise exceptions.InvalidRequirements('Reading TOML requires Python 3.11+, or the `tomli` package')
+            with open(path, 'rb') as f:
+                contents = tomllib.load(f)
+        else:
+            with open(path, 'r') as f:
+                contents = json.load(f)
+    except exceptions.InvalidRequirements:
+        raise
+    except (OSError, ValueError) as e:
+        # Decoding errors from both parsers are subclasses of ValueError
+        raise exceptions.InvalidRequirements('Could not read requirements file {}: {}'.format(path, e))
+
+    if isinstance(contents, dict):
+        contents = contents.get('assets')
+    if not isinstance(contents, list):
+        raise exceptions.InvalidRequirements('Requirements file must contain a list of assets: {}'.format(path))
+    return parse(contents)
@@ -0,0 +1,199 @@
+"""
+Serve a local asset cache over HTTP, so that it can act as the remote for other machines (eg peers in the same rack)
+
+The layout matches what `RemoteManifest` and `AssetManager.download` expect: `manifest.json` at the root, and each
+    asset file at its `_path` relative to that.
+"""
+import gzip
+import hashlib
+import http.server
+import json
+import logging
+import os
+import re
+import socketserver
+import threading
+import time
+import typing as ty
+import urllib.parse
+
+from . import manifest
+
+logger = logging.getLogger(__name__)
+
+
+class AssetServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    A threaded HTTP server that publishes the contents of one local manifest (read-only)
+
+    Changes to the local cache are picked up at most once every `refresh_interval` seconds. The published manifest is
+        only rebuilt when the records have changed, so most requests are answered without any disk access.
+    """
+    daemon_threads = True
+
+    def __init__(self, local: manifest.LocalManifest, server_address: ty.Tuple[str, int],
+                 refresh_interval: float = 1):
+        super(AssetServer, self).__init__(server_address, AssetRequestHandler)
+        self.local = local
+        self.refresh_interval = refresh_interval
+        self._refresh_lock = threading.Lock()
+        self._refreshed_at = time.monotonic()
+        # The manifest body, its ETag, and the records that it describes: replaced as a whole, so requests can read it
+        #   without a lock
+        self._snapshot = self._build_snapshot()
+        self._snapshot_generation = self.local._generation  # type: int
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return 'http://{}:{}/'.format(host, port)
+
+    def snapshot(self) -> ty.Tuple[bytes, str, ty.Dict[str, dict]]:
+        """
+        Return the manifest to publish (with its ETag), plus the records that it describes (indexed by file path)
+
+        If it is time to check for changes, one request does so. The others don't wait, and are answered from the
+            current snapshot.
+        """
+        if time.monotonic() - self._refreshed_at >= self.refresh_interval and self._refresh_lock.acquire(False):
+            try:
+                self.local.refresh()
+                self._refreshed_at = time.monotonic()
+                if self.local._generation != self._snapshot_generation:
+                    self._snapshot = self._build_snapshot()
+                    self._snapshot_generation = self.local._generation
+            finally:
+                self._refresh_lock.release()
+        return self._snapshot
+
+    def _build_snapshot(self) -> ty.Tuple[bytes, str, ty.Dict[str, dict]]:
+        body = json.dumps(self.local._serialize(), sort_keys=True).encode('utf-8')
+        etag = '"{}"'.format(hashlib.sha256(body).hexdigest())
+        files = {record['_path']: record for record in self.local._items if record.get('_path')}
+        return body, etag, files
+
+
+class AssetRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serve `manifest.json` and the files that it lists (and nothing else from the cache folder). Files support single
+        `Range` requests, and use the sha256 of the asset as an `ETag`. Data is sent with `sendfile` where possible.
+    """
+    # Keep connections open, so that clients can fetch several files without reconnecting
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def do_GET(self):
+        self._respond(send_body=True)
+
+    def _respond(self, send_body: bool):
+        body, manifest_etag, files = self.server.snapshot()
+        name = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path).lstrip('/')
+        if name == 'manifest.json':
+            self._send_manifest(body, manifest_etag, send_body)
+            return
+
+        record = files.get(name)
+        path = self.server.local.get_path(record) if record else None
+        if path is None or not os.path.isfile(path):
+            self.send_error(404)
+            return
+        self._send_file(path, '"{}"'.format(record['_sha256']), send_body)
+
+    def _send_manifest(self, body: bytes, etag: str, send_body: bool):
+        if self.headers.get('If-None-Match') == etag:
+            self._send_not_modified(etag)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', etag)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def _send_file(self, path: str, etag: str, send_body: bool):
+        if self.headers.get('If-None-Match') == etag:
+            self._send_not_modified(etag)
+            return
+
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            byte_range = _parse_range(self.headers.get('Range'), size)
+            # A Range is only honored if the client's copy (if any) is still current
+            if_range = self.headers.get('If-Range')
+            if byte_range is not None and if_range is not None and if_range != etag:
+                byte_range = None
+
+            if byte_range == 'unsatisfiable':
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            if byte_range is None:
+                start, end = 0, size - 1
+                self.send_response(200)
+            else:
+                start, end = byte_range
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(end - start + 1))
+            self.end_headers()
+
+            if send_body and end >= start:
+                # `socket.sendfile` copies in the kernel where the platform supports it, and falls back to `send`
+                self.wfile.flush()
+                self.connection.sendfile(f, offset=start, count=end - start + 1)
+
+    def _send_not_modified(self, etag: str):
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+def _parse_range(header: ty.Optional[str], size: int) -> ty.Union[None, str, ty.Tuple[int, int]]:
+    """
+    Parse a single-range `Range` header into an inclusive (start, end) pair. Returns None if the whole file should be
+        sent (no header, or a form that is not supported), or 'unsatisfiable' if the range lies outside the file.
+    """
+    match = re.match(r'bytes=(\d*)-(\d*)$', (header or '').strip())
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+
+    first, last = match.groups()
+    if not first:
+        # A suffix range: the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            return 'unsatisfiable'
+        return max(size - length, 0), size - 1
+
+    start = int(first)
+    if last and int(last) < start:
+        # Invalid, and so ignored
+        return None
+    if start >= size:
+        return 'unsatisfiable'
+    end = min(int(last), size - 1) if last else size - 1
+    return start, end
+
+
+def serve(local: manifest.LocalManifest, host: str = '127.0.0.1', port: int = 8000,
+          refresh_interval: float = 1) -> AssetServer:
+    """Create a server for the given local cache. Call `serve_forever()` on the result to start handling requests."""
+    local.load()
+    return AssetServer(local, (host, port), refresh_interval=refresh_interval)
@@ -0,0 +1,500 @@
+"""
+Transfer asset files from a remote location into the local cache
+"""
+from concurrent import futures
+import hashlib
+import http.client
+import io
+import logging
+import os
+import re
+import socket
+import ssl
+import threading
+import time
+import typing as ty
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from . import exceptions, util
+
+logger = logging.getLogger(__name__)
+
+# Read and hash the response body in chunks, so that large assets never need to fit in memory
+CHUNK_SIZE = 2 ** 20
+
+# Server responses that indicate a temporary problem, worth retrying after a pause
+RETRY_STATUS_CODES = frozenset([408, 429, 500, 502, 503, 504])
+
+# Failures in transit (dropped connections, timeouts, DNS hiccups) that can be retried. Other OS errors (eg a full
+#   disk, or a permissions problem with the `.part` file) would only happen again, and are raised immediately.
+RETRYABLE_ERRORS = (urllib.error.URLError, http.client.HTTPException, ConnectionError, socket.timeout,
+                    socket.gaierror)
+
+
+class TransferCancelled(Exception):
+    """The caller asked for a transfer to stop (eg because the same file has already arrived from another mirror)"""
+
+
+class TransferResult:
+    """Summarize a completed file transfer"""
+    def __init__(self):
+        self.n_bytes = 0  # type: int
+        self.n_resumed = 0  # type: int
+        self.n_retries = 0  # type: int
+
+    def __repr__(self):
+        return '<TransferResult bytes={} resumed={} retries={}>'.format(self.n_bytes, self.n_resumed, self.n_retries)
+
+
+class _PartialFile:
+    """Track the state of a `.part` file (and the hash of its contents) across several connection attempts"""
+    def __init__(self, path: str):
+        self.path = path
+        self.shasum = hashlib.sha256()
+        self.n_hashed = 0
+        # Until the server says otherwise, assume that it can resume a previous transfer
+        self.resumable = True
+
+    def current_size(self) -> int:
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def sync_hash(self, size: int):
+        """Ensure the running hash describes exactly the first `size` bytes on disk (eg left by an earlier process)"""
+        if size == self.n_hashed:
+            return
+        self.shasum = hashlib.sha256()
+        self.n_hashed = 0
+        with open(self.path, 'rb') as f:
+            while self.n_hashed < size:
+                data = f.read(min(CHUNK_SIZE, size - self.n_hashed))
+                if not data:
+                    break
+                self.shasum.update(data)
+                self.n_hashed += len(data)
+
+    def reset(self):
+        _discard(self.path)
+        self.shasum = hashlib.sha256()
+        self.n_hashed = 0
+
+
+def get_part_path(dest: str) -> str:
+    """Incomplete downloads are written beside the final destination, and are never visible under the real name"""
+    return dest + '.part'
+
+
+class Transport:
+    """
+    Make HTTP(S) requests over persistent connections, so that fetching many files from the same server pays for the
+        TCP (and TLS) handshake only once
+
+    Up to `pool_size` idle connections are kept open per host. Any number of requests can run at once: a request that
+        finds no idle connection opens a new one, which is kept for reuse afterwards if there is room in the pool.
+
+    Responses behave like those of `urllib.request.urlopen`: redirects are followed, and error statuses (including
+        `304 Not Modified`) raise `urllib.error.HTTPError`. A connection goes back to the pool once the response body
+        has been read to the end and the response is closed. URLs for other schemes (eg `file://`), or for hosts that
+        must be reached through a proxy, are opened with `urllib` instead.
+    """
+    REDIRECT_CODES = frozenset([301, 302, 303, 307, 308])
+
+    def __init__(self, pool_size: int = 4, timeout: ty.Optional[float] = 60, max_redirects: int = 5):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        # The number of new connections made so far (a measure of how well connections are being reused)
+        self.n_connects = 0
+        self._idle = {}  # type: ty.Dict[tuple, ty.List[http.client.HTTPConnection]]
+        self._lock = threading.Lock()
+        self._ssl_context = None  # type: ty.Optional[ssl.SSLContext]
+
+    def __getstate__(self):
+        # Copies (eg sent to another process) keep the settings, but not the open connections
+        return {'pool_size': self.pool_size, 'timeout': self.timeout, 'max_redirects': self.max_redirects}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def open(self, url: str, headers: ty.Optional[dict] = None, timeout: ty.Optional[float] = None,
+             method: str = 'GET') -> ty.Any:
+        """Open a (streaming) response for the given URL"""
+        timeout = timeout if timeout is not None else self.timeout
+        headers = dict(headers or {})
+        response = None  # type: ty.Optional[_PooledResponse]
+        for _ in range(self.max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            if parts.scheme not in ('http', 'https') or uses_proxy(url):
+                request = urllib.request.Request(url, headers=headers, method=method)
+                return urllib.request.urlopen(request, timeout=timeout)
+
+            response = self._request(parts, method, headers, timeout)
+            if 200 <= response.status < 300:
+                return response
+
+            location = response.getheader('Location')
+            if response.status in self.REDIRECT_CODES and location:
+                response.drain()
+                url = urllib.parse.urljoin(url, location)
+                if response.status == 303:
+                    method = 'GET'
+                continue
+
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers,
+                                         io.BytesIO(response.drain()))
+        raise urllib.error.HTTPError(url, response.status, 'Too many redirects', response.headers,  # type: ignore
+                                     io.BytesIO())
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+    def _request(self, parts: urllib.parse.SplitResult, method: str, headers: dict,
+                 timeout: ty.Optional[float]) -> '_PooledResponse':
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        while True:
+            conn, reused = self._checkout(key, timeout)
+            try:
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if reused:
+                    # The server closed an idle connection while it was in the pool; that is not an error
+                    continue
+                raise
+            except BaseException:
+                conn.close()
+                raise
+            return _PooledResponse(response, conn, lambda: self._checkin(key, conn))
+
+    def _checkout(self, key: tuple, timeout: ty.Optional[float]) -> ty.Tuple[http.client.HTTPConnection, bool]:
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                conn = idle.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+            self.n_connects += 1
+
+        scheme, host, port = key
+        if scheme == 'https':
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            return http.client.HTTPSConnection(host, port, timeout=timeout, context=self._ssl_context), False
+        return http.client.HTTPConnection(host, port, timeout=timeout), False
+
+    def _checkin(self, key: tuple, conn: http.client.HTTPConnection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.pool_size:
+                idle.append(conn)
+                return
+        conn.close()
+
+
+class _PooledResponse:
+    """An HTTP response that returns its connection to the pool when closed (if the connection can be reused)"""
+    # Redirects and error responses with a body up to this size are read in full, so that the connection can be reused
+    MAX_DRAIN = 2 ** 16
+
+    def __init__(self, response: http.client.HTTPResponse, conn: http.client.HTTPConnection,
+                 release: ty.Callable[[], None]):
+        self._response = response
+        self._conn = conn
+        self._release = release
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+
+    def getcode(self) -> int:
+        return self.status
+
+    def getheader(self, name: str, default: str = None) -> ty.Optional[str]:
+        return self._response.getheader(name, default)
+
+    def read(self, amt: int = None) -> bytes:
+        return self._response.read(amt)
+
+    def drain(self) -> bytes:
+        """Read a short response body, and close the response"""
+        length = self._response.length
+        body = self._response.read() if length is not None and length <= self.MAX_DRAIN else b''
+        self.close()
+        return body
+
+    def close(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        # The response closes itself once the whole body has been read
+        if self._response.isclosed() and not self._response.will_close:
+            self._release()
+        else:
+            self._response.close()
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def uses_proxy(url: str) -> bool:
+    """Whether requests for this URL must go through a proxy (according to the environment)"""
+    parts = urllib.parse.urlsplit(url)
+    proxies = urllib.request.getproxies()
+    return parts.scheme in proxies and not urllib.request.proxy_bypass(parts.hostname or '')
+
+
+# Shared by all callers that don't provide a transport of their own
+_default_transport = Transport()
+
+
+def open_url(url: str, headers: ty.Optional[dict] = None, timeout: ty.Optional[float] = None,
+             transport: Transport = None):
+    """Open a (streaming) response for the given URL"""
+    return (transport or _default_transport).open(url, headers=headers, timeout=timeout)
+
+
+def parse_content_range(value: ty.Optional[str]) -> ty.Optional[int]:
+    """Get the first byte offset from a `Content-Range: bytes start-end/total` header"""
+    match = re.match(r'bytes\s+(\d+)-\d+/(\d+|\*)', value or '')
+    return int(match.group(1)) if match else None
+
+
+def fetch_file(url: str, dest: str, sha256: str, *, chunk_size: int = CHUNK_SIZE,
+               timeout: ty.Optional[float] = None, retries: int = 3, backoff: float = 1.0,
+               transport: Transport = None, cancel: threading.Event = None) -> TransferResult:
+    """
+    Download a file in a single pass, hashing each chunk as it arrives. The data is written to a temporary `.part`
+        file in the destination folder, and only renamed to the final path once the hash has been validated.
+
+    If a transfer is interrupted, the `.part` file is kept: the next attempt (in this call or a later one) asks the
+        server for only the missing bytes via an HTTP `Range` request. Failures in transit are retried up to
+        `retries` times, waiting `backoff * 2 ** n` seconds before the nth retry.
+
+    Once the `cancel` event is set, the transfer stops at the next chunk, discards its `.part` file, and raises
+        `TransferCancelled`.
+    """
+    part = _PartialFile(get_part_path(dest))
+    result = TransferResult()
+
+    while True:
+        try:
+            _stream_to_part(url, part, result, chunk_size, timeout, transport, cancel)
+        except TransferCancelled:
+            part.reset()
+            raise
+        except urllib.error.HTTPError as e:
+            if e.code not in RETRY_STATUS_CODES or result.n_retries >= retries:
+                raise exceptions.DownloadError('Could not download {}: {}'.format(url, e))
+            _wait_to_retry(url, e, result, backoff)
+            continue
+        except RETRYABLE_ERRORS as e:
+            if not part.resumable:
+                part.reset()
+            if result.n_retries >= retries:
+                raise exceptions.DownloadError('Could not download {}: {}'.format(url, e))
+            _wait_to_retry(url, e, result, backoff)
+            continue
+
+        if part.shasum.hexdigest() == sha256:
+            break
+
+        if result.n_resumed:
+            # The partial data kept from an earlier attempt may itself have been bad. Start over, exactly once.
+            logger.warning('Resumed download of {} failed validation; restarting from the beginning'.format(url))
+            part.reset()
+            result.n_resumed = 0
+            continue
+
+        part.reset()
+        raise exceptions.IntegrityError
+
+    # Atomic on the same filesystem: other readers see either no file, or the complete and validated one
+    os.replace(part.path, dest)
+    logger.debug('Downloaded {} bytes from {} ({} resumed)'.format(result.n_bytes, url, result.n_resumed))
+    return result
+
+
+def _stream_to_part(url: str, part: _PartialFile, result: TransferResult, chunk_size: int,
+                    timeout: ty.Optional[float], transport: ty.Optional[Transport],
+                    cancel: ty.Optional[threading.Event] = None):
+    """Make one attempt to fetch the rest of the file, appending to any data already present"""
+    offset = part.current_size() if part.resumable else 0
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+    try:
+        response = open_url(url, headers=headers, timeout=timeout, transport=transport)
+    except urllib.error.HTTPError as e:
+        if e.code == 416 and offset:
+            # Range not satisfiable: the part file already holds the whole body (or is garbage, as the hash will tell)
+            e.close()
+            part.sync_hash(offset)
+            result.n_resumed += offset
+            return
+        raise
+
+    with response:
+        status = response.getcode() or 200  # Non-HTTP URLs (eg `file://`) have no status code
+        if offset and status == 206 and parse_content_range(response.headers.get('Content-Range')) == offset:
+            part.sync_hash(offset)
+            result.n_resumed += offset
+            mode = 'ab'
+        else:
+            # Servers that ignore the Range header send the full body; start over
+            part.shasum = hashlib.sha256()
+            part.n_hashed = 0
+            mode = 'wb'
+            part.resumable = response.headers.get('Accept-Ranges', '').lower() == 'bytes' or status == 206
+
+        expected = response.headers.get('Content-Length')
+        n_received = 0
+        with open(part.path, mode) as f:
+            while True:
+                if cancel is not None and cancel.is_set():
+                    raise TransferCancelled
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                f.write(chunk)
+                part.shasum.update(chunk)
+                part.n_hashed += len(chunk)
+                n_received += len(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        result.n_bytes += n_received
+
+        if expected is not None and n_received < int(expected):
+            # A streaming read does not complain when the server hangs up early; treat that as a dropped connection
+            raise http.client.IncompleteRead(b'', int(expected) - n_received)
+
+
+def fetch_file_segmented(url: str, dest: str, sha256: str, size: int, n_segments: int, *,
+                         chunk_size: int = CHUNK_SIZE, timeout: ty.Optional[float] = None,
+                         retries: int = 3, backoff: float = 1.0, transport: Transport = None,
+                         cancel: threading.Event = None) -> TransferResult:
+    """
+    Download a large file over several parallel connections, each fetching one byte range into a preallocated
+        `.part` file. The hash is checked once over the assembled file before it is renamed into place.
+
+    Servers that do not honor `Range` requests are handled by falling back to a single streaming download. The
+        `cancel` event stops every segment, as in `fetch_file`.
+    """
+    if n_segments < 2 or size < n_segments:
+        return fetch_file(url, dest, sha256, chunk_size=chunk_size, timeout=timeout, retries=retries, backoff=backoff,
+                          transport=transport, cancel=cancel)
+
+    part_path = get_part_path(dest)
+    bounds = [size * i // n_segments for i in range(n_segments + 1)]
+    segments = [(start, end - 1) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+    with open(part_path, 'wb') as f:
+        f.truncate(size)
+
+    result = TransferResult()
+    lock = threading.Lock()
+
+    def fetch_segment(start: int, end: int):
+        n_retries = 0
+        while True:
+            try:
+                n_bytes = _stream_range(url, part_path, start, end, chunk_size, timeout, transport, cancel)
+                break
+            except urllib.error.HTTPError as e:
+                if e.code not in RETRY_STATUS_CODES or n_retries >= retries:
+                    raise
+            except RETRYABLE_ERRORS:
+                if n_retries >= retries:
+                    raise
+            time.sleep(backoff * 2 ** n_retries)
+            n_retries += 1
+        with lock:
+            result.n_bytes += n_bytes
+            result.n_retries += n_retries
+
+    try:
+        with futures.ThreadPoolExecutor(max_workers=len(segments)) as executor:
+            for job in [executor.submit(fetch_segment, start, end) for start, end in segments]:
+                job.result()
+    except TransferCancelled:
+        _discard(part_path)
+        raise
+    except _RangeNotSupported:
+        _discard(part_path)
+        logger.info('Server does not support range requests; downloading {} as a single stream'.format(url))
+        return fetch_file(url, dest, sha256, chunk_size=chunk_size, timeout=timeout, retries=retries, backoff=backoff,
+                          transport=transport, cancel=cancel)
+    except RETRYABLE_ERRORS as e:
+        # A file with holes in it must never be mistaken for a resumable (contiguous) partial download
+        _discard(part_path)
+        raise exceptions.DownloadError('Could not download {}: {}'.format(url, e))
+
+    if util.get_file_sha256(part_path) != sha256:
+        _discard(part_path)
+        raise exceptions.IntegrityError
+
+    os.replace(part_path, dest)
+    logger.debug('Downloaded {} bytes from {} in {} segments'.format(result.n_bytes, url, len(segments)))
+    return result
+
+
+class _RangeNotSupported(Exception):
+    """The server replied to a range request with the full file"""
+
+
+def _stream_range(url: str, part_path: str, start: int, end: int, chunk_size: int,
+                  timeout: ty.Optional[float], transport: ty.Optional[Transport],
+                  cancel: ty.Optional[threading.Event] = None) -> int:
+    """Fetch bytes `start` to `end` (inclusive) of a file, and write them to the same position in the part file"""
+    headers = {'Range': 'bytes={}-{}'.format(start, end)}
+    with open_url(url, headers=headers, timeout=timeout, transport=transport) as response:
+        status = response.getcode() or 200
+        if status != 206 or parse_content_range(response.headers.get('Content-Range')) != start:
+            raise _RangeNotSupported
+
+        expected = end - start + 1
+        n_received = 0
+        with open(part_path, 'r+b') as f:
+            f.seek(start)
+            while n_received < expected:
+                if cancel is not None and cancel.is_set():
+                    raise TransferCancelled
+                chunk = response.read(min(chunk_size, expected - n_received))
+                if not chunk:
+                    break
+                f.write(chunk)
+                n_received += len(chunk)
+
+    if n_received < expected:
+        raise http.client.IncompleteRead(b'', expected - n_received)
+    return n_received
+
+
+def _wait_to_retry(url: str, error: Exception, result: TransferResult, backoff: float):
+    delay = backoff * 2 ** result.n_retries
+    result.n_retries += 1
+    logger.warning('Download of {} failed ({}); retry {} in {:.1f}s'.format(url, error, result.n_retries, delay))
+    time.sleep(delay)
+
+
+def _discard(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
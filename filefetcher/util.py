@@ -1,7 +1,11 @@
+import collections
 import hashlib
 import os
+import shutil
 import stat
 import sys
+import threading
+import typing as ty
 
 from .exceptions import BaseAssetException
 
@@ -19,6 +23,200 @@ def get_file_sha256(src_path: str, block_size: int = 2 ** 20) -> str:
         return shasum_256.hexdigest()
 
 
+# ioctl request to clone a file's extents (a "reflink") on copy-on-write filesystems such as btrfs and XFS (Linux)
+FICLONE = 0x40049409
+
+
+def copy_file_hashed(src_path: str, dest_path: str, sha256: str = None, allow_link: bool = False,
+                     block_size: int = 2 ** 20) -> str:
+    """
+    Copy a file and return its (hex string) sha256, reading the source only once. The cheapest available strategy is
+        used, and each one falls back cleanly to the next:
+
+    - A hardlink (only if `allow_link`: the cache then shares data with a file that may be modified later)
+    - A reflink, ie a copy-on-write clone, where the filesystem supports it
+    - If the hash is already known: an in-kernel copy (`copy_file_range` or `sendfile`)
+    - Otherwise, a single streaming pass that hashes each block as it is written
+
+    Linked and cloned files don't need the data to be copied, so the source is read once just to hash it (if needed).
+    """
+    if allow_link and _try_copy(os.link, src_path, dest_path):
+        return sha256 or get_file_sha256(src_path, block_size)
+
+    if _try_copy(_reflink, src_path, dest_path):
+        shutil.copystat(src_path, dest_path)
+        return sha256 or get_file_sha256(src_path, block_size)
+
+    if sha256 and _try_copy(_kernel_copy, src_path, dest_path):
+        shutil.copystat(src_path, dest_path)
+        return sha256
+
+    shasum_256 = hashlib.sha256()
+    try:
+        with open(src_path, 'rb') as src, open(dest_path, 'wb') as dest:
+            while True:
+                data = src.read(block_size)
+                if not data:
+                    break
+                shasum_256.update(data)
+                dest.write(data)
+    except BaseException:
+        _remove_quietly(dest_path)
+        raise
+    shutil.copystat(src_path, dest_path)
+    return shasum_256.hexdigest()
+
+
+def _try_copy(strategy, src_path: str, dest_path: str) -> bool:
+    """Attempt one copy strategy, leaving nothing behind if the filesystem (or platform) does not support it"""
+    try:
+        strategy(src_path, dest_path)
+    except (OSError, AttributeError):
+        _remove_quietly(dest_path)
+        return False
+    return True
+
+
+def _reflink(src_path: str, dest_path: str):
+    import fcntl  # Not available on all platforms
+    with open(src_path, 'rb') as src, open(dest_path, 'wb') as dest:
+        fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+
+
+def _kernel_copy(src_path: str, dest_path: str):
+    """Copy data between files without passing it through user space"""
+    copy_range = getattr(os, 'copy_file_range', None)
+    with open(src_path, 'rb') as src, open(dest_path, 'wb') as dest:
+        remaining = os.fstat(src.fileno()).st_size
+        offset = 0
+        while remaining > 0:
+            if copy_range is not None:
+                n_copied = copy_range(src.fileno(), dest.fileno(), remaining)
+            else:
+                n_copied = os.sendfile(dest.fileno(), src.fileno(), offset, remaining)
+            if n_copied == 0:
+                raise OSError('Unexpected end of file: {}'.format(src_path))
+            offset += n_copied
+            remaining -= n_copied
+
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class HashingWriter:
+    """
+    A binary file opened for writing, which calculates the sha256 of the contents as they are written. This saves
+        reading a (large) file back from disk just to hash it.
+
+    Eg:
+        with HashingWriter(path) as f:
+            f.write(data)
+        sha = f.hexdigest()
+    """
+    def __init__(self, path: str):
+        self._file = open(path, 'wb')
+        self._shasum_256 = hashlib.sha256()
+
+    def write(self, data: bytes) -> int:
+        self._shasum_256.update(data)
+        return self._file.write(data)
+
+    def hexdigest(self) -> str:
+        return self._shasum_256.hexdigest()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class LocateCache:
+    """
+    A bounded, thread-safe LRU cache of asset lookups.
+
+    Each lookup is stored along with a "generation" token that describes the state of the manifest(s) at the time.
+        As soon as a lookup is made against a different generation, all stored entries are discarded.
+    """
+    def __init__(self, maxsize: int = 1024, check_exists: bool = False):
+        self.maxsize = maxsize
+        # Optionally, verify (with one `stat` call) that a cached path still exists before returning it
+        self.check_exists = check_exists
+
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = collections.OrderedDict()  # type: collections.OrderedDict
+        self._generation = None  # type: ty.Any
+        self._lock = threading.Lock()
+
+    def get(self, key: ty.Hashable, generation: ty.Any) -> ty.Optional[str]:
+        """Return the cached path for this key, or None if it is missing or stale"""
+        with self._lock:
+            if generation != self._generation:
+                self._entries.clear()
+                self._generation = generation
+
+            path = self._entries.get(key)
+            if path is not None and self.check_exists and not os.path.exists(path):
+                del self._entries[key]
+                path = None
+
+            if path is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return path
+
+    def put(self, key: ty.Hashable, generation: ty.Any, path: str):
+        """Store a path, unless the manifest has changed since the lookup began"""
+        with self._lock:
+            if generation != self._generation or self.maxsize <= 0:
+                return
+            self._entries[key] = path
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation = None
+            self.hits = 0
+            self.misses = 0
+
+    def info(self) -> CacheInfo:
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
+
+    def __getstate__(self):
+        # Copies (eg sent to another process) keep the settings, but start out empty
+        return {'maxsize': self.maxsize, 'check_exists': self.check_exists}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+def write_atomic(path: str, text: str):
+    """Write a file under a temporary name, then rename it into place, so that readers never see a partial file"""
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
 def is_writable(path):
     """
     Determine whether a specific directory is writable
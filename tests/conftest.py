@@ -1,6 +1,16 @@
 """
 Shared unit test fixtures
 """
+import gzip
+import hashlib
+import http.server
+import json
+import os
+import re
+import socketserver
+import threading
+import urllib.parse
+
 import pytest
 
 from filefetcher import manifest
@@ -35,3 +45,136 @@ def local_manifest(tmpdir):
         'collections': []  # Reserved for future features
     })
     return fixture
+
+
+@pytest.fixture
+def remote_folder(tmpdir):
+    """
+    A folder that mimics a remote server, with a manifest file and a few assets. The manifest can be accessed by a
+        `file://` URL, so no server is needed for tests.
+    """
+    folder = tmpdir.mkdir('remote')
+    contents = {
+        'first_file.txt': b'The first asset',
+        'second_file.txt': b'The second asset',
+        'corrupt_file.txt': b'This does not match the manifest hash',
+    }
+    items = []
+    for i, (name, data) in enumerate(sorted(contents.items())):
+        sha = 'badhash' if name.startswith('corrupt') else hashlib.sha256(data).hexdigest()
+        path = '{}_{}'.format(sha, name)
+        (folder / path).write_binary(data)
+        items.append({
+            '_type': name.split('.')[0],
+            '_label': 'A remote asset',
+            '_date': '2020-01-0{}'.format(i + 1),
+            '_sha256': sha,
+            '_path': path,
+            '_size': len(data),
+            'genome_build': 'GRCh37',
+        })
+
+    (folder / 'manifest.json').write_text(json.dumps({'items': items, 'collections': []}), 'utf-8')
+    return folder
+
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    A stand-in for a remote asset server, with support for (single) HTTP Range requests and keep-alive connections.
+        Set `fail_after` on the server to drop the connection after sending that many bytes of the next response
+        body. Requests for `/redirect/<path>` are redirected to `/<path>`.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def translate_path(self, path):
+        # Serve files from the server's root folder (the `directory` argument of the base class needs Python 3.7+)
+        parts = urllib.parse.unquote(urllib.parse.urlsplit(path).path).split('/')
+        return os.path.join(self.server.root, *[part for part in parts if part not in ('', '.', '..')])
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path.startswith('/redirect/'):
+            self.send_response(302)
+            self.send_header('Location', self.path[len('/redirect'):])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        with open(path, 'rb') as f:
+            etag = '"{}"'.format(hashlib.sha256(f.read()).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if path.endswith('.json') and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            with open(path, 'rb') as f:
+                body = gzip.compress(f.read())
+            self.send_response(200)
+            self.send_header('Content-Encoding', 'gzip')
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or end), end)
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+
+        with open(path, 'rb') as f:
+            f.seek(start)
+            body = f.read(end - start + 1)
+
+        fail_after = self.server.fail_after
+        if fail_after is not None:
+            # Simulate a dropped connection partway through the transfer
+            self.server.fail_after = None
+            self.wfile.write(body[:fail_after])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+class _ThreadedHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def http_server(remote_folder):
+    """Serve the fake remote folder over HTTP, on a local port"""
+    server = _ThreadedHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+    server.root = str(remote_folder)
+    server.fail_after = None
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+    server.url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,84 @@
+"""
+Test the asyncio interface
+"""
+import asyncio
+import os
+from unittest import mock
+
+import pytest
+
+from filefetcher import aio, exceptions, transfer
+
+
+def _run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+@pytest.fixture
+def async_manager(tmpdir, http_server):
+    return aio.AsyncAssetManager('mypackage', http_server.url + 'manifest.json',
+                                 local_manifest=str(tmpdir.mkdir('local') / 'manifest.json'))
+
+
+def test_download_streams_file_over_http(async_manager: aio.AsyncAssetManager):
+    record = _run(async_manager.download('first_file', genome_build='GRCh37'))
+
+    path = async_manager.manager._local.get_path(record)
+    with open(path, 'rb') as f:
+        assert f.read() == b'The first asset'
+    assert async_manager.manager.locate('first_file', auto_fetch=False) == path
+
+
+def test_locate_fetches_missing_asset(async_manager: aio.AsyncAssetManager):
+    path = _run(async_manager.locate('second_file', auto_fetch=True))
+    assert os.path.isfile(path)
+
+    with pytest.raises(exceptions.NoMatchingAsset):
+        _run(async_manager.locate('first_file', auto_fetch=False))
+
+
+def test_download_reports_corrupt_file(async_manager: aio.AsyncAssetManager):
+    results = _run(async_manager.download_many([{'_type': 'first_file'}, {'_type': 'corrupt_file'}]))
+
+    by_type = {result.item_type: result for result in results}
+    assert by_type['first_file'].ok
+    assert isinstance(by_type['corrupt_file'].error, exceptions.IntegrityError)
+
+
+def test_concurrent_requests_share_one_download(async_manager: aio.AsyncAssetManager):
+    async def fetch_twice():
+        return await asyncio.gather(async_manager.download('first_file'), async_manager.download('first_file'))
+
+    with mock.patch.object(aio, 'fetch_file', wraps=aio.fetch_file) as fetch:
+        first, second = _run(fetch_twice())
+    assert fetch.call_count == 1
+    assert first == second
+
+
+def test_cancelled_download_removes_part_file(tmpdir, http_server, remote_folder):
+    name = next(fn for fn in os.listdir(str(remote_folder)) if fn.endswith('first_file.txt'))
+    dest = str(tmpdir / name)
+    real_read = aio.AsyncResponse.read
+
+    async def slow_read(self, amt=-1):
+        data = await real_read(self, amt)
+        if os.path.exists(transfer.get_part_path(dest)):
+            await asyncio.sleep(10)
+        return data
+
+    async def cancel_midway():
+        task = asyncio.ensure_future(aio.fetch_file(http_server.url + name, dest, name.split('_')[0], chunk_size=4))
+        while not os.path.exists(transfer.get_part_path(dest)):
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    with mock.patch.object(aio.AsyncResponse, 'read', slow_read):
+        _run(cancel_midway())
+    assert not os.path.exists(transfer.get_part_path(dest))
+    assert not os.path.exists(dest)
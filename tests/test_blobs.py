@@ -0,0 +1,63 @@
+"""
+Test the content-addressed blob store shared between packages
+"""
+import hashlib
+import os
+from unittest import mock
+
+from filefetcher import blobs
+
+
+SHA = hashlib.sha256(b'Shared data').hexdigest()
+
+
+def test_blob_is_kept_until_last_reference_is_released(tmpdir):
+    store = blobs.BlobStore(str(tmpdir))
+    first = tmpdir.mkdir('first') / 'data.txt'
+    first.write_binary(b'Shared data')
+    second = str(tmpdir.mkdir('second') / 'data.txt')
+
+    assert store.get(SHA, second) is False
+    store.put(str(first), SHA)
+    assert store.get(SHA, second) is True
+    assert os.path.samefile(second, store.get_path(SHA))
+    assert store.refcount(SHA) == 2
+
+    store.release(SHA, str(first))
+    assert store.has(SHA)
+    store.release(SHA, second)
+    assert not store.has(SHA)
+    assert os.path.isfile(second)  # The package copy is never removed by the store
+
+
+def test_prune_drops_references_to_deleted_copies(tmpdir):
+    store = blobs.BlobStore(str(tmpdir))
+    copy = tmpdir.mkdir('package') / 'data.txt'
+    copy.write_binary(b'Shared data')
+    store.put(str(copy), SHA)
+
+    assert store.prune() == []
+    copy.remove()
+    assert store.prune() == [SHA]
+    assert not store.has(SHA)
+
+
+def test_damaged_blob_is_deleted_instead_of_linked(tmpdir):
+    store = blobs.BlobStore(str(tmpdir))
+    first = tmpdir.mkdir('first') / 'data.txt'
+    first.write_binary(b'Shared data')
+    second = str(tmpdir.mkdir('second') / 'data.txt')
+    store.put(str(first), SHA)
+
+    # An unchanged blob is trusted without reading it again
+    with mock.patch.object(blobs.util, 'get_file_sha256') as rehash:
+        assert store.get(SHA, second) is True
+    assert not rehash.called
+
+    # The package copies are hardlinks to the blob, so changing one in place damages the blob
+    with open(str(first), 'ab') as f:
+        f.write(b', altered')
+    third = str(tmpdir.mkdir('third') / 'data.txt')
+    assert store.get(SHA, third) is False
+    assert not store.has(SHA)
+    assert not os.path.exists(third)
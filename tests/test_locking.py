@@ -0,0 +1,36 @@
+"""
+Test file locks
+"""
+import pytest
+
+from filefetcher import exceptions, locking
+
+
+def test_exclusive_locks_conflict_within_one_process(tmpdir):
+    path = tmpdir / 'asset.lock'
+    with locking.FileLock(path):
+        assert locking.FileLock(path).acquire(blocking=False) is False
+        with pytest.raises(exceptions.LockTimeout):
+            locking.FileLock(path, timeout=0.1).acquire()
+
+    other = locking.FileLock(path)
+    assert other.acquire(blocking=False) is True
+    other.release()
+
+
+def test_shared_locks_allow_other_readers(tmpdir):
+    path = tmpdir / 'asset.lock'
+    with locking.FileLock(path, shared=True):
+        with locking.FileLock(path, shared=True, timeout=0.1):
+            assert locking.FileLock(path).acquire(blocking=False) is False
+
+
+def test_lock_left_by_crashed_holder_is_reported(tmpdir):
+    path = tmpdir / 'asset.lock'
+    path.write_text('{"pid": 12345, "host": "elsewhere"}', 'utf-8')  # As if the holder died without releasing
+
+    with locking.FileLock(path, timeout=0.1) as lock:
+        assert lock.stale_owner['pid'] == 12345
+
+    with locking.FileLock(path, timeout=0.1) as lock:
+        assert lock.stale_owner is None
@@ -3,11 +3,18 @@ Test the manager functionality
 - Find, download, or build assets
 - Set a custom URL
 """
+from concurrent import futures
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
 from unittest import mock
 
 import pytest
 
-from filefetcher import exceptions, manager
+from filefetcher import exceptions, manager, manifest, util
 
 
 @pytest.fixture
@@ -93,3 +100,702 @@ def test_base_cache_dir_auto_selected_somewhere(monkeypatch):
 
 # Test that upon (real) download/build, a new file is successfully copied into the cache directory
 # TODO: Test manifest is saved and can be referenced later
+
+
+# Batch operations
+@pytest.fixture
+def remote_manager(tmpdir, remote_folder):
+    """A manager that downloads (real) files from a fake remote location on disk"""
+    return manager.AssetManager(
+        'mypackage', 'file://{}'.format(remote_folder / 'manifest.json'),
+        local_manifest=str(tmpdir.mkdir('local') / 'manifest.json'),
+    )
+
+
+def test_download_many_reports_each_asset(remote_manager: manager.AssetManager):
+    remote_manager._remote.load()
+    with mock.patch.object(remote_manager._local, 'save', wraps=remote_manager._local.save) as save:
+        results = remote_manager.download_many(remote_manager._remote._items, max_workers=3)
+
+    assert save.call_count == 1
+    by_type = {result.item_type: result for result in results}
+    assert by_type['first_file'].ok and by_type['second_file'].ok
+    assert isinstance(by_type['corrupt_file'].error, exceptions.IntegrityError)
+
+    path = remote_manager.locate('second_file', genome_build='GRCh37')
+    with open(path, 'rb') as f:
+        assert f.read() == b'The second asset'
+
+
+def test_download_refuses_asset_already_present(remote_manager: manager.AssetManager):
+    remote_manager.download('first_file')
+    results = remote_manager.download_many([{'_type': 'first_file'}])
+    assert isinstance(results[0].error, exceptions.ImmutableManifestError)
+
+
+def test_download_uses_segments_above_size_threshold(remote_manager: manager.AssetManager):
+    remote_manager._segment_threshold = 10
+    with mock.patch.object(manager.transfer, 'fetch_file_segmented',
+                           wraps=manager.transfer.fetch_file_segmented) as segmented:
+        remote_manager.download('first_file', segments=3)
+        remote_manager.download('second_file')  # Manager default is a single connection
+
+    assert segmented.call_count == 1
+
+
+# Caching of locate results
+def test_locate_cache_is_per_instance_and_counts_hits(mocked_manager: manager.AssetManager):
+    mocked_manager.locate('snp_to_rsid', genome_build='GRCh37')
+    mocked_manager.locate('snp_to_rsid', genome_build='GRCh37')
+    info = mocked_manager.cache_info()
+    assert info.hits == 1 and info.misses == 1 and info.currsize == 1
+
+
+def test_locate_cache_is_invalidated_when_manifest_changes(mocked_manager: manager.AssetManager):
+    mocked_manager.locate('snp_to_rsid', genome_build='GRCh37')
+    mocked_manager._local.add_record('snp_to_rsid', genome_build='GRCh37', db_snp_build='b154', date='2020-01-01',
+                                     _path='newer.lmdb')
+    assert mocked_manager.locate('snp_to_rsid', genome_build='GRCh37') == mocked_manager._local.get_path('newer.lmdb')
+
+
+def test_locate_cache_is_bounded(mocked_manager: manager.AssetManager):
+    mocked_manager._locate_cache.maxsize = 1
+    mocked_manager.locate('snp_to_rsid', genome_build='GRCh37')
+    mocked_manager.locate('snp_to_rsid', db_snp_build='b152')
+    assert mocked_manager.cache_info().currsize == 1
+
+
+def test_locate_cache_can_check_that_files_exist(mocked_manager: manager.AssetManager):
+    mocked_manager._locate_cache.check_exists = True
+    with pytest.raises(exceptions.AssetNotFound):
+        mocked_manager.locate('snp_to_rsid', genome_build='GRCh37')
+
+
+def test_locate_fetches_again_when_file_is_missing(tmpdir, remote_folder):
+    checking_manager = manager.AssetManager('mypackage', 'file://{}'.format(remote_folder / 'manifest.json'),
+                                            local_manifest=str(tmpdir / 'local' / 'manifest.json'),
+                                            cache_check_exists=True)
+    path = checking_manager.locate('first_file', auto_fetch=True)
+    os.remove(path)
+
+    assert checking_manager.locate('first_file', auto_fetch=True) == path
+    assert os.path.isfile(path)
+    assert len(checking_manager._local._items) == 1
+
+
+def test_locate_accepts_unhashable_tags(mocked_manager: manager.AssetManager):
+    mocked_manager._local.add_record('regions', chroms=['1', '2'], _path='regions.txt')
+    assert mocked_manager.locate('regions', chroms=['1', '2']) == mocked_manager._local.get_path('regions.txt')
+
+
+# Only one thread or process fetches a missing asset
+def test_concurrent_auto_fetch_downloads_asset_once(remote_manager: manager.AssetManager):
+    real_fetch = manager.transfer.fetch_file
+
+    def slow_fetch(*args, **kwargs):
+        time.sleep(0.2)
+        return real_fetch(*args, **kwargs)
+
+    with mock.patch.object(manager.transfer, 'fetch_file', side_effect=slow_fetch) as fetch:
+        with futures.ThreadPoolExecutor(max_workers=4) as executor:
+            jobs = [executor.submit(remote_manager.locate, 'first_file', auto_fetch=True) for _ in range(4)]
+            paths = {job.result() for job in jobs}
+
+    assert fetch.call_count == 1
+    assert len(paths) == 1
+
+
+def test_waiters_time_out_while_asset_is_locked(remote_manager: manager.AssetManager):
+    remote_manager._lock_timeout = 0.1
+    with remote_manager._asset_lock('first_file', {}):
+        with pytest.raises(exceptions.LockTimeout):
+            remote_manager.locate('first_file', auto_fetch=True)
+
+
+class WriteFileRecipe(manager.BuildTask):
+    """A picklable recipe, which can be run in a worker process"""
+    def build(self, manager, item_type, build_folder, **kwargs):
+        if kwargs.get('fail'):
+            raise ValueError('This recipe always fails')
+        out_fn = os.path.join(build_folder, '{}.txt'.format(item_type))
+        with open(out_fn, 'w') as f:
+            f.write('Built in process {}'.format(os.getpid()))
+        return out_fn, {'builder_pid': os.getpid()}
+
+
+def test_build_many_runs_recipes_in_worker_processes(remote_manager: manager.AssetManager):
+    remote_manager.add_recipe('process_built', WriteFileRecipe(), genome_build='GRCh37')
+    remote_manager.add_recipe('thread_built', lambda manager, item_type, folder, **kwargs: (
+        WriteFileRecipe().build(manager, item_type, folder)
+    ))
+    remote_manager.add_recipe('broken', WriteFileRecipe(), fail=True)
+
+    # (Patch the class, because the instance will be pickled for the worker processes)
+    real_save = manifest.LocalManifest.save
+    with mock.patch.object(manifest.LocalManifest, 'save', autospec=True, side_effect=real_save) as save:
+        results = remote_manager.build_many(remote_manager._recipes._items, max_workers=2)
+
+    assert save.call_count == 1
+    # One result per query, in the same order
+    assert [result.item_type for result in results] == ['process_built', 'thread_built', 'broken']
+    by_type = {result.item_type: result for result in results}
+    assert by_type['process_built'].record['builder_pid'] != os.getpid()
+    assert by_type['thread_built'].record['builder_pid'] == os.getpid()
+    assert isinstance(by_type['broken'].error, ValueError)
+    assert os.path.isfile(remote_manager.locate('process_built', genome_build='GRCh37'))
+
+
+class ChainedRecipe(manager.BuildTask):
+    """Write a file that records the contents of each upstream asset"""
+    def __init__(self, *upstream):
+        self.upstream = upstream
+
+    def build(self, manager, item_type, build_folder, **kwargs):
+        out_fn = os.path.join(build_folder, '{}.txt'.format(item_type))
+        with open(out_fn, 'w') as f:
+            f.write(item_type)
+            for name in self.upstream:
+                with open(manager.locate(name), 'r') as upstream_file:
+                    f.write('<' + upstream_file.read())
+        return out_fn, {}
+
+
+def test_build_resolves_dependency_chain(remote_manager: manager.AssetManager):
+    remote_manager.add_recipe('raw_dump', ChainedRecipe())
+    remote_manager.add_recipe('normalized', ChainedRecipe('raw_dump'), depends_on=[{'_type': 'raw_dump'}])
+    remote_manager.add_recipe('index', ChainedRecipe('normalized', 'other_branch'),
+                              depends_on=[{'_type': 'normalized'}, {'_type': 'other_branch'}])
+    remote_manager.add_recipe('other_branch', ChainedRecipe('first_file'), depends_on=[{'_type': 'first_file'}])
+
+    results = remote_manager.build_many([{'_type': 'index'}], max_workers=2)
+    assert all(result.ok for result in results)
+    assert results[0].item_type == 'index'
+    # Independent branches are built, and a dependency with no recipe is downloaded
+    assert sorted(result.item_type for result in results) == [
+        'first_file', 'index', 'normalized', 'other_branch', 'raw_dump']
+
+    with open(remote_manager.locate('index'), 'r') as f:
+        assert f.read() == 'index<normalized<raw_dump<other_branch<The first asset'
+
+    # Upstream assets that already exist are not rebuilt
+    remote_manager.add_recipe('report', ChainedRecipe('index'), depends_on=[{'_type': 'index'}])
+    results = remote_manager.build_many([{'_type': 'report'}])
+    assert [result.item_type for result in results] == ['report']
+
+
+def test_build_downloads_missing_dependency_without_recipe(remote_manager: manager.AssetManager):
+    remote_manager.add_recipe('summary', ChainedRecipe('first_file'), depends_on=[{'_type': 'first_file'}])
+
+    with open(remote_manager._local.get_path(remote_manager.build('summary')), 'r') as f:
+        assert f.read() == 'summary<The first asset'
+
+
+def test_build_reuses_dependency_that_already_exists(remote_manager: manager.AssetManager):
+    remote_manager.add_recipe('raw_dump', ChainedRecipe())
+    remote_manager.add_recipe('normalized', ChainedRecipe('raw_dump'), depends_on=[{'_type': 'raw_dump'}])
+    upstream = remote_manager.build('raw_dump')
+
+    with mock.patch.object(remote_manager, '_run_plan', wraps=remote_manager._run_plan) as run_plan:
+        remote_manager.build('normalized')
+    run_plan.assert_called_once_with([])
+    assert remote_manager._local.locate('raw_dump') == upstream
+
+
+def test_build_refuses_circular_dependencies(remote_manager: manager.AssetManager):
+    recipe = mock.Mock()
+    remote_manager.add_recipe('chicken', recipe, depends_on=[{'_type': 'egg'}])
+    remote_manager.add_recipe('egg', recipe, depends_on=[{'_type': 'chicken'}])
+
+    with pytest.raises(exceptions.DependencyCycle):
+        remote_manager.build('chicken')
+    assert recipe.call_count == 0
+
+
+def test_failed_dependency_fails_downstream_steps(remote_manager: manager.AssetManager):
+    remote_manager.add_recipe('broken', WriteFileRecipe(), fail=True)
+    remote_manager.add_recipe('downstream', ChainedRecipe('broken'), depends_on=[{'_type': 'broken'}])
+
+    results = {result.item_type: result for result in remote_manager.build_many([{'_type': 'downstream'}])}
+    assert isinstance(results['broken'].error, ValueError)
+    assert isinstance(results['downstream'].error, exceptions.DependencyError)
+
+
+class HashingRecipe(manager.BuildTask):
+    """Report the hash of the output, so that the manager does not have to read it again"""
+    def build(self, manager, item_type, build_folder, **kwargs):
+        out_fn = os.path.join(build_folder, 'hashed.txt')
+        with util.HashingWriter(out_fn) as f:
+            f.write(b'Hashed while writing')
+        return out_fn, {'_sha256': f.hexdigest(), 'build_folder': build_folder}
+
+
+def test_build_stages_in_cache_and_uses_precomputed_hash(remote_manager: manager.AssetManager):
+    remote_manager.add_recipe('hashed', HashingRecipe())
+    with mock.patch.object(util, 'get_file_sha256') as get_file_sha256:
+        record = remote_manager.build('hashed')
+
+    assert get_file_sha256.call_count == 0
+    assert record['_sha256'] == hashlib.sha256(b'Hashed while writing').hexdigest()
+    # The build happened on the same filesystem as the cache, so the output was renamed into place
+    assert record['build_folder'].startswith(os.path.join(remote_manager._local._base_path, '.staging'))
+    assert os.path.isfile(remote_manager.locate('hashed'))
+
+
+def test_import_file_copies_into_cache(remote_manager: manager.AssetManager, tmpdir):
+    source = tmpdir / 'my_data.txt'
+    source.write_binary(b'Imported by hand')
+
+    record = remote_manager.import_file('my_data', str(source), genome_build='GRCh38')
+    assert record['_path'] == '{}_my_data.txt'.format(hashlib.sha256(b'Imported by hand').hexdigest())
+    assert remote_manager.locate('my_data', genome_build='GRCh38') == remote_manager._local.get_path(record)
+    assert source.check()  # The original file is left in place
+
+
+def test_verify_finds_missing_and_corrupt_files(remote_manager: manager.AssetManager):
+    first = remote_manager.download('first_file', genome_build='GRCh37')
+    second = remote_manager.download('second_file', genome_build='GRCh37')
+    os.remove(remote_manager._local.get_path(first))
+    with open(remote_manager._local.get_path(second), 'r+b') as f:
+        f.write(b'X')  # Same size, different contents
+
+    results = {result.item_type: result for result in remote_manager.verify(max_workers=2)}
+    assert isinstance(results['first_file'].error, exceptions.AssetNotFound)
+    assert isinstance(results['second_file'].error, exceptions.IntegrityError)
+
+
+def test_quick_verify_detects_changes_since_last_full_check(remote_manager: manager.AssetManager):
+    record = remote_manager.download('first_file', genome_build='GRCh37')
+    assert all(result.ok for result in remote_manager.verify())
+
+    path = remote_manager._local.get_path(record)
+    with open(path, 'r+b') as f:
+        f.write(b'X')
+    os.utime(path, ns=(0, 0))
+
+    with mock.patch.object(util, 'get_file_sha256') as get_file_sha256:
+        results = remote_manager.verify(quick=True)
+    assert get_file_sha256.call_count == 0
+    assert isinstance(results[0].error, exceptions.IntegrityError)
+
+
+def test_verify_repair_quarantines_and_downloads_again(remote_manager: manager.AssetManager):
+    record = remote_manager.download('first_file', genome_build='GRCh37')
+    path = remote_manager._local.get_path(record)
+    with open(path, 'r+b') as f:
+        f.write(b'X')
+
+    results = remote_manager.verify(repair='redownload')
+    assert results[0].note == 'downloaded again'
+    assert os.path.isfile(os.path.join(remote_manager._local._base_path, '.quarantine', record['_path']))
+    assert util.get_file_sha256(path) == record['_sha256']
+    assert len(remote_manager._local._items) == 1
+
+
+def test_verify_repair_includes_every_record_that_uses_the_file(remote_manager: manager.AssetManager,
+                                                                remote_folder):
+    _publish_alias(remote_folder)
+    first = remote_manager.download('second_file', genome_build='GRCh37')
+    second = remote_manager.download('second_file', genome_build='GRCh38')
+    assert second['_path'] == first['_path']
+    path = remote_manager._local.get_path(first)
+    with open(path, 'r+b') as f:
+        f.write(b'X')
+
+    results = remote_manager.verify(repair='redownload')
+    assert [result.note for result in results] == ['downloaded again'] * 2
+    assert util.get_file_sha256(path) == first['_sha256']
+    assert sorted(record['genome_build'] for record in remote_manager._local._items) == ['GRCh37', 'GRCh38']
+
+    # A record that was not part of the check (eg added by another process) is not left pointing at a missing file
+    os.remove(path)
+    record = remote_manager._local.locate('second_file', genome_build='GRCh37')
+    checked = manager.TaskResult('second_file', {}, record=record, error=exceptions.AssetNotFound())
+    extra = remote_manager._repair([checked], 'quarantine')
+    assert [result.record['genome_build'] for result in extra] == ['GRCh38']
+    assert remote_manager._local.locate('second_file', err_on_missing=False) is None
+
+
+def _import_text(asset_manager: manager.AssetManager, tmpdir, item_type: str, content: bytes, mtime: int = None,
+                 **kwargs) -> dict:
+    source = tmpdir / 'source.txt'
+    source.write_binary(content)
+    if mtime is not None:
+        # Imported files are dated by their modification time
+        os.utime(str(source), (mtime, mtime))
+    return asset_manager.import_file(item_type, str(source), **kwargs)
+
+
+def test_gc_keeps_newest_versions(remote_manager: manager.AssetManager, tmpdir):
+    old = _import_text(remote_manager, tmpdir, 'dbsnp', b'b151', mtime=1500000000, genome_build='GRCh38',
+                       build='b151')
+    new = _import_text(remote_manager, tmpdir, 'dbsnp', b'b153', mtime=1600000000, genome_build='GRCh38',
+                       build='b153')
+
+    assert remote_manager.gc(keep_versions=1) == []  # Different tags: not versions of the same thing
+    assert remote_manager.gc(keep_versions=1, group_by=['genome_build'], dry_run=True) == [old]
+    assert os.path.isfile(remote_manager._local.get_path(old))
+
+    assert remote_manager.gc(keep_versions=1, group_by=['genome_build']) == [old]
+    assert not os.path.exists(remote_manager._local.get_path(old))
+    reloaded = manifest.LocalManifest(remote_manager._local._manifest_path)
+    reloaded.load()
+    assert reloaded._items == [new]
+
+
+def test_gc_orders_versions_by_explicit_import_date(remote_manager: manager.AssetManager, tmpdir):
+    # The release date given by the caller takes precedence over the age of the file on disk
+    old = _import_text(remote_manager, tmpdir, 'dbsnp', b'b151', mtime=1600000000, date='2017-07-14T00:00:00',
+                       genome_build='GRCh38', build='b151')
+    new = _import_text(remote_manager, tmpdir, 'dbsnp', b'b153', mtime=1500000000, date='2020-09-13T00:00:00',
+                       genome_build='GRCh38', build='b153')
+    assert old['_date'] == '2017-07-14T00:00:00'
+
+    assert remote_manager.gc(keep_versions=1, group_by=['genome_build']) == [old]
+    assert remote_manager.locate('dbsnp', build='b153') == remote_manager._local.get_path(new)
+
+
+def test_gc_evicts_least_recently_used_to_meet_budget(remote_manager: manager.AssetManager, tmpdir):
+    first = _import_text(remote_manager, tmpdir, 'first', b'1' * 100)
+    second = _import_text(remote_manager, tmpdir, 'second', b'2' * 100)
+    os.utime(remote_manager._local.get_path(first), (0, 0))
+    os.utime(remote_manager._local.get_path(second), (0, 0))
+
+    # Access is recorded without changing the modification time
+    remote_manager.locate('first')
+    assert os.stat(remote_manager._local.get_path(first)).st_mtime == 0
+
+    assert remote_manager.gc(max_bytes=150) == [second]
+    assert remote_manager.locate('first')
+
+
+def test_gc_keeps_files_that_other_records_share(remote_manager: manager.AssetManager, remote_folder):
+    # The same file, listed under two genome builds
+    _publish_alias(remote_folder)
+    first = remote_manager.download('second_file', genome_build='GRCh37')
+    second = remote_manager.download('second_file', genome_build='GRCh38')
+    assert first['_path'] == second['_path']
+
+    # The shared file is only counted once towards the size of the cache
+    assert remote_manager.gc(max_bytes=first['_size']) == []
+
+    evicted = remote_manager.gc(keep_versions=1, group_by=[])
+    assert len(evicted) == 1
+    kept = second if evicted == [first] else first
+    assert os.path.isfile(remote_manager.locate('second_file', genome_build=kept['genome_build']))
+
+
+def test_gc_never_evicts_held_assets(remote_manager: manager.AssetManager, tmpdir):
+    record = _import_text(remote_manager, tmpdir, 'first', b'In use')
+    with remote_manager.hold('first') as path:
+        assert remote_manager.gc(max_bytes=0) == []
+        assert os.path.isfile(path)
+    assert remote_manager.gc(max_bytes=0) == [record]
+
+
+def test_packages_share_downloaded_files(tmpdir, remote_folder):
+    def make_manager(name):
+        return manager.AssetManager(name, 'file://{}'.format(remote_folder / 'manifest.json'),
+                                    local_manifest=str(tmpdir / name / 'manifest.json'), shared_blobs=True)
+
+    first_package, second_package = make_manager('first'), make_manager('second')
+    first = first_package.download('first_file', genome_build='GRCh37')
+    with mock.patch.object(manager.transfer, 'fetch_file') as fetch_file:
+        second = second_package.download('first_file', genome_build='GRCh37')
+    assert fetch_file.call_count == 0
+    assert os.path.samefile(first_package._local.get_path(first), second_package._local.get_path(second))
+
+    # The shared copy is only deleted once both packages have evicted it
+    blob_path = first_package._blobs.get_path(first['_sha256'])
+    first_package.gc(max_bytes=0)
+    assert os.path.isfile(blob_path)
+    second_package.gc(max_bytes=0)
+    assert not os.path.exists(blob_path)
+
+
+@pytest.fixture
+def site_cache(tmpdir, remote_folder) -> str:
+    """A cache on a shared filesystem, populated in advance"""
+    site_manager = manager.AssetManager('mypackage', 'file://{}'.format(remote_folder / 'manifest.json'),
+                                        local_manifest=str(tmpdir / 'site' / 'manifest.json'))
+    site_manager.download('first_file', genome_build='GRCh37')
+    return site_manager._local._manifest_path
+
+
+@pytest.mark.parametrize('promote', [True, False])
+def test_locate_uses_shared_cache_without_downloading(tmpdir, remote_folder, site_cache, promote):
+    node_manager = manager.AssetManager('mypackage', 'file://{}'.format(remote_folder / 'manifest.json'),
+                                        local_manifest=str(tmpdir / 'node' / 'manifest.json'),
+                                        shared_caches=[site_cache], promote=promote)
+    with mock.patch.object(manager.transfer, 'fetch_file') as fetch_file:
+        path = node_manager.locate('first_file', genome_build='GRCh37')
+    assert fetch_file.call_count == 0
+
+    local_record = node_manager._local.locate('first_file', err_on_missing=False)
+    if promote:
+        assert path == node_manager._local.get_path(local_record)
+        assert util.get_file_sha256(path) == local_record['_sha256']
+    else:
+        assert local_record is None
+        assert path.startswith(os.path.dirname(site_cache))
+
+
+def test_download_copies_from_shared_cache(tmpdir, remote_folder, site_cache):
+    node_manager = manager.AssetManager('mypackage', 'file://{}'.format(remote_folder / 'manifest.json'),
+                                        local_manifest=str(tmpdir / 'node' / 'manifest.json'),
+                                        shared_caches=[str(tmpdir / 'missing' / 'manifest.json'), site_cache])
+    with mock.patch.object(manager.transfer, 'fetch_file') as fetch_file:
+        record = node_manager.download('first_file', genome_build='GRCh37')
+        assert fetch_file.call_count == 0
+        node_manager.download('second_file', genome_build='GRCh37')
+        assert fetch_file.call_count == 1
+    assert os.path.isfile(node_manager._local.get_path(record))
+
+
+def test_damaged_shared_copy_is_not_used(tmpdir, remote_folder, site_cache):
+    site = manifest.SharedManifest(site_cache)
+    site.load()
+    with open(site.get_path(site.locate('first_file')), 'ab') as f:
+        f.write(b'Modified in place')
+
+    node_manager = manager.AssetManager('mypackage', 'file://{}'.format(remote_folder / 'manifest.json'),
+                                        local_manifest=str(tmpdir / 'node' / 'manifest.json'),
+                                        shared_caches=[site_cache])
+    with pytest.raises(exceptions.NoMatchingAsset):
+        node_manager.locate('first_file', genome_build='GRCh37')
+
+    with mock.patch.object(manager.transfer, 'fetch_file', wraps=manager.transfer.fetch_file) as fetch_file:
+        record = node_manager.download('first_file', genome_build='GRCh37')
+    assert fetch_file.call_count == 1
+    assert util.get_file_sha256(node_manager._local.get_path(record)) == record['_sha256']
+    assert not [name for name in os.listdir(str(tmpdir / 'node')) if name.endswith('.promote')]
+
+
+def test_prefetch_downloads_in_background(remote_manager: manager.AssetManager, tmpdir):
+    spec = tmpdir / 'requirements.json'
+    spec.write_text('{"assets": [{"_type": "first_file"}, {"_type": "second_file", "genome_build": "GRCh37"}]}',
+                    'utf-8')
+
+    jobs = remote_manager.prefetch(str(spec))
+    paths = [job.result(timeout=10) for job in jobs]
+    assert all(os.path.isfile(path) for path in paths)
+    assert remote_manager.locate('second_file', genome_build='GRCh37') == paths[1]
+
+
+def test_prefetch_calls_share_one_thread_pool(remote_manager: manager.AssetManager):
+    first, = remote_manager.prefetch([('first_file', {})])
+    second, = remote_manager.prefetch([('second_file', {'genome_build': 'GRCh37'})])
+    executor = remote_manager._prefetch_executor
+    assert first.result(timeout=10) and second.result(timeout=10)
+
+    remote_manager.prefetch([('first_file', {})])[0].result(timeout=10)
+    assert remote_manager._prefetch_executor is executor
+    assert len(executor._threads) <= 4
+
+
+def test_locate_joins_prefetch_in_progress(remote_manager: manager.AssetManager):
+    real_download = remote_manager.download
+    started = futures.Future()
+
+    def slow_download(*args, **kwargs):
+        started.set_result(True)
+        time.sleep(0.2)
+        return real_download(*args, **kwargs)
+
+    with mock.patch.object(remote_manager, 'download', side_effect=slow_download) as download:
+        job, = remote_manager.prefetch([('first_file', {})])
+        started.result(timeout=10)
+        with pytest.raises(exceptions.PrefetchTimeout):
+            remote_manager.locate('first_file', wait=0.01)
+
+        # No second download: the lookup waits for the prefetch and then finds the local copy
+        path = remote_manager.locate('first_file', auto_fetch=True, wait=10)
+        assert download.call_count == 1
+    assert path == job.result()
+
+
+def test_locate_picks_up_new_release_in_background(tmpdir, remote_folder):
+    fresh_manager = manager.AssetManager('mypackage', 'file://{}'.format(remote_folder / 'manifest.json'),
+                                         local_manifest=str(tmpdir / 'local' / 'manifest.json'),
+                                         auto_fetch=True, remote_cache_ttl=0, revalidate_interval=0.1)
+    old_path = fresh_manager.locate('first_file')
+
+    # Publish a newer release of the same asset
+    data = b'The first asset, revised'
+    sha = hashlib.sha256(data).hexdigest()
+    (remote_folder / '{}_first_file.txt'.format(sha)).write_binary(data)
+    contents = json.loads((remote_folder / 'manifest.json').read_text('utf-8'))
+    contents['items'].append({'_type': 'first_file', '_label': 'A remote asset', '_date': '2021-01-01',
+                              '_sha256': sha, '_path': '{}_first_file.txt'.format(sha), '_size': len(data),
+                              'genome_build': 'GRCh37', 'release': 2})
+    (remote_folder / 'manifest.json').write_text(json.dumps(contents), 'utf-8')
+
+    # Once the interval has passed, a lookup answers from the local cache without waiting, and starts an update check
+    time.sleep(0.1)
+    assert fresh_manager.locate('first_file') == old_path
+    deadline = time.monotonic() + 10
+    while fresh_manager.locate('first_file') == old_path and time.monotonic() < deadline:
+        time.sleep(0.02)
+
+    new_path = fresh_manager.locate('first_file')
+    assert new_path != old_path
+    with open(new_path, 'rb') as f:
+        assert f.read() == data
+
+
+def test_revalidation_runs_in_a_bounded_pool(tmpdir, remote_folder):
+    service_manager = manager.AssetManager('mypackage', 'file://{}'.format(remote_folder / 'manifest.json'),
+                                           local_manifest=str(tmpdir / 'local' / 'manifest.json'),
+                                           revalidate_interval=0, prefetch_workers=2)
+    release = threading.Event()
+    with mock.patch.object(service_manager, '_revalidate', side_effect=lambda *args: release.wait(10)) as revalidate:
+        for i in range(10):
+            service_manager._schedule_revalidation(('asset', i), 'asset', {'i': i})
+        # A query that is still being checked is not checked again
+        service_manager._schedule_revalidation(('asset', 0), 'asset', {'i': 0})
+        assert len(service_manager._prefetch_executor._threads) == 2
+        release.set()
+        service_manager._prefetch_executor.shutdown(wait=True)
+    assert revalidate.call_count == 10
+    assert not service_manager._revalidating
+
+
+def test_revalidating_a_local_only_asset_is_not_a_warning(remote_manager: manager.AssetManager, tmpdir, caplog):
+    _import_text(remote_manager, tmpdir, 'built_here', b'Local data')
+    remote_manager._revalidate('built_here', {})
+    assert not [record for record in caplog.records if record.levelno >= logging.WARNING]
+
+
+def test_sync_fetches_only_missing_files(remote_manager: manager.AssetManager, remote_folder):
+    # The same file, listed a second time under different tags
+    alias = _publish_alias(remote_folder)
+    remote_manager.download('first_file')
+
+    plan = remote_manager.plan_sync()
+    assert sorted(record['_type'] for record in plan.transfers) == ['corrupt_file', 'second_file']
+    assert plan.copies == [alias]
+    assert plan.n_bytes == sum(record['_size'] for record in plan.transfers)
+
+    with mock.patch.object(manager.transfer, 'fetch_file', wraps=manager.transfer.fetch_file) as fetch_file:
+        results = remote_manager.sync(plan=plan)
+    assert fetch_file.call_count == 2
+    assert [result.ok for result in results] == [r['_type'] != 'corrupt_file' for r in plan.records]
+    assert remote_manager.locate('second_file', genome_build='GRCh38')
+
+    assert [record['_type'] for record in remote_manager.plan_sync().records] == ['corrupt_file']
+
+
+def test_damaged_local_copy_is_not_reused(remote_manager: manager.AssetManager, remote_folder):
+    _publish_alias(remote_folder)
+
+    record = remote_manager.download('second_file', genome_build='GRCh37')
+    path = remote_manager._local.get_path(record)
+    with open(path, 'ab') as f:
+        f.write(b'Modified in place')
+
+    # The alias refers to the same file, which must be downloaded again rather than trusted
+    with mock.patch.object(manager.transfer, 'fetch_file', wraps=manager.transfer.fetch_file) as fetch_file:
+        remote_manager.download('second_file', genome_build='GRCh38')
+    assert fetch_file.call_count == 1
+    assert util.get_file_sha256(path) == record['_sha256']
+
+
+def _publish_alias(remote_folder) -> dict:
+    """List a remote file a second time, under different tags"""
+    contents = json.loads((remote_folder / 'manifest.json').read_text('utf-8'))
+    alias = dict(next(item for item in contents['items'] if item['_type'] == 'second_file'), genome_build='GRCh38')
+    contents['items'].append(alias)
+    (remote_folder / 'manifest.json').write_text(json.dumps(contents), 'utf-8')
+    return alias
+
+
+def _publish_new_release(remote_folder, item_type: str, data: bytes, **tags) -> dict:
+    """Add a newer release of an asset to the remote, which has the tags of the old release plus some new ones"""
+    sha = hashlib.sha256(data).hexdigest()
+    path = '{}_{}.txt'.format(sha, item_type)
+    (remote_folder / path).write_binary(data)
+    contents = json.loads((remote_folder / 'manifest.json').read_text('utf-8'))
+    old = next(item for item in contents['items'] if item['_type'] == item_type)
+    new = dict(old, _date='2021-01-01', _sha256=sha, _path=path, _size=len(data), **tags)
+    contents['items'].append(new)
+    (remote_folder / 'manifest.json').write_text(json.dumps(contents), 'utf-8')
+    return new
+
+
+def test_sync_fetches_every_planned_version(remote_manager: manager.AssetManager, remote_folder):
+    new = _publish_new_release(remote_folder, 'first_file', b'The first asset, revised', release=2)
+
+    plan = remote_manager.plan_sync()
+    planned = sorted(record['_path'] for record in plan.records if record['_type'] == 'first_file')
+    assert len(planned) == 2 and new['_path'] in planned
+
+    results = remote_manager.sync(plan=plan)
+    assert sorted(result.record['_path'] for result in results if result.ok and result.item_type == 'first_file') \
+        == planned
+    local_paths = sorted(record['_path'] for record in remote_manager._local._items
+                         if record['_type'] == 'first_file')
+    assert local_paths == planned
+    assert all(os.path.isfile(remote_manager._local.get_path(path)) for path in planned)
+    assert remote_manager.locate('first_file') == remote_manager._local.get_path(new)
+
+
+def test_download_plan_adds_exactly_the_planned_records(remote_manager: manager.AssetManager, remote_folder):
+    new = _publish_new_release(remote_folder, 'first_file', b'The first asset, revised', release=2)
+    alias = _publish_alias(remote_folder)
+
+    # The newer release is already local; the older one (whose tags it shares) is not
+    remote_manager.download('first_file', release=2)
+    remote_manager._remote.load()
+    records = [record for record in remote_manager._remote._items if record['_type'] != 'corrupt_file']
+    plan = remote_manager.plan_download(records)
+    assert plan.existing == [new]
+    assert alias in plan.copies
+
+    assert all(result.ok for result in remote_manager.sync(plan=plan))
+    local = [(record['_type'], record['_path'], record.get('genome_build'), record.get('release'))
+             for record in remote_manager._local._items]
+    for record in plan.records:
+        assert (record['_type'], record['_path'], record.get('genome_build'), record.get('release')) in local
+    assert len(local) == len(plan.records) + 1
+
+
+def test_sync_latest_skips_superseded_versions(remote_manager: manager.AssetManager):
+    plan = remote_manager.plan_sync(latest=True, group_by=['genome_build'])
+    assert len(plan.records) == 3
+
+    # Every asset is a version of the same thing, if only the type is considered
+    remote_manager._remote._items = [dict(item, _type='asset') for item in remote_manager._remote._items]
+    plan = remote_manager.plan_sync(latest=True, group_by=[])
+    assert [record['_path'] for record in plan.records] == [
+        max(remote_manager._remote._items, key=lambda item: item['_date'])['_path']]
+
+
+def test_download_plan_reports_bytes_saved(remote_manager: manager.AssetManager):
+    remote_manager._remote.load()
+    first = next(item for item in remote_manager._remote._items if item['_type'] == 'first_file')
+    old_release = dict(first, _date='2019-01-01', _sha256='oldhash', _path='oldhash_first_file.txt')
+    duplicate = dict(first, genome_build='GRCh38')
+    records = [first, old_release, duplicate]
+
+    plan = remote_manager.plan_download(records, latest=True, group_by=['_type'])
+    assert plan.transfers == [first] and plan.superseded == [old_release, duplicate]
+
+    plan = remote_manager.plan_download(records, latest=True)
+    assert plan.transfers == [first] and plan.copies == [duplicate] and plan.superseded == [old_release]
+    assert plan.n_bytes == first['_size']
+    assert plan.n_bytes_requested == 3 * first['_size']
+
+
+def test_different_queries_for_same_asset_share_download(remote_manager: manager.AssetManager):
+    real_fetch = manager.transfer.fetch_file
+
+    def slow_fetch(*args, **kwargs):
+        time.sleep(0.2)
+        return real_fetch(*args, **kwargs)
+
+    queries = [{}, {'genome_build': 'GRCh37'}]
+    with mock.patch.object(manager.transfer, 'fetch_file', side_effect=slow_fetch) as fetch_file:
+        with futures.ThreadPoolExecutor(max_workers=2) as executor:
+            paths = list(executor.map(lambda tags: remote_manager.locate('first_file', auto_fetch=True, **tags),
+                                      queries))
+    assert fetch_file.call_count == 1
+    assert paths[0] == paths[1]
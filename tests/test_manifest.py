@@ -2,11 +2,20 @@
 Test manifest functionality
 """
 from datetime import datetime
+import itertools
+import json
+import multiprocessing
+import operator
 import os
+import random
+import threading
+import time
+import typing as ty
+from unittest import mock
 
 import pytest
 
-from filefetcher import exceptions, manifest
+from filefetcher import exceptions, manifest, transfer
 
 
 SAMPLE_FILE = os.path.join(os.path.dirname(__file__), 'data', 'sample_file.txt')
@@ -43,6 +52,45 @@ def test_errors_when_no_fixtures_match_tags(local_manifest):
         local_manifest.locate('snp_to_rsid', genome_build='nonexistent')
 
 
+def test_indexed_locate_matches_linear_scan(tmpdir):
+    rng = random.Random(42)
+    items = [
+        {
+            '_type': rng.choice(['snp_to_rsid', 'rsid_to_snp']),
+            '_date': '2020-01-{:02d}'.format(rng.randint(1, 28)),
+            'genome_build': rng.choice(['GRCh37', 'GRCh38']),
+            'db_snp_build': rng.choice(['b151', 'b152', 'b153']),
+        }
+        for _ in range(200)
+    ]
+    local = manifest.LocalManifest(tmpdir / 'manifest.json')
+    local.load(data={'items': items, 'collections': []})
+
+    def linear_scan(item_type, **tags):
+        matches = [item for item in items
+                   if item['_type'] == item_type and all(item.get(k) == v for k, v in tags.items())]
+        return sorted(matches, key=operator.itemgetter('_date'), reverse=True)[0] if matches else None
+
+    for item_type, build, db_snp in itertools.product(['snp_to_rsid', 'rsid_to_snp', 'other'],
+                                                      ['GRCh37', 'GRCh38'], ['b152', 'b154']):
+        assert local.locate(item_type, err_on_missing=False) is linear_scan(item_type)
+        assert local.locate(item_type, err_on_missing=False, genome_build=build) is \
+            linear_scan(item_type, genome_build=build)
+        assert local.locate(item_type, err_on_missing=False, genome_build=build, db_snp_build=db_snp) is \
+            linear_scan(item_type, genome_build=build, db_snp_build=db_snp)
+
+
+def test_locate_supports_unhashable_tag_values(local_manifest):
+    local_manifest.add_record('regions', chroms=['1', '2'])
+    assert local_manifest.locate('regions', chroms=['1', '2'])['chroms'] == ['1', '2']
+    assert local_manifest.locate('regions', err_on_missing=False, chroms=['X']) is None
+
+
+def test_index_is_updated_by_add_record(local_manifest):
+    newer = local_manifest.add_record('snp_to_rsid', genome_build='GRCh37', db_snp_build='b154', date='2020-01-01')
+    assert local_manifest.locate('snp_to_rsid', genome_build='GRCh37') is newer
+
+
 # add_record
 def test_adds_record_metadata_from_arguments(local_manifest):
     label = 'Added during test'
@@ -59,6 +107,15 @@ def test_add_record_fails_when_exists(local_manifest):
         local_manifest.add_record('snp_to_rsid')
 
 
+def test_add_record_can_allow_versions_with_extra_tags(local_manifest):
+    # A tagged record would be found by the broader query, but is a different record
+    record = local_manifest.add_record('snp_to_rsid', allow_versions=True, date='2000-01-01')
+    assert local_manifest.find_exact('snp_to_rsid') is record
+    assert local_manifest.locate('snp_to_rsid')['_sha256'] == 'iamthenewest'
+    with pytest.raises(exceptions.ImmutableManifestError):
+        local_manifest.add_record('snp_to_rsid', allow_versions=True)
+
+
 def test_adds_file_to_directory_with_sha_and_versioned_path(local_manifest):
     local_manifest.add_record('my_file', my_tag='avalue', source_path=SAMPLE_FILE, copy_file=True)
     found = local_manifest.locate('my_file')
@@ -95,3 +152,250 @@ def test_remote_manifest_urlpaths():
     fake_record = {'_path': '123_filename.json'}
     child_path = remote_in_root_folder.get_path(fake_record)
     assert child_path == 'https://site.example/123_filename.json'
+
+
+# Concurrent writes to a shared local manifest
+def _add_records_in_process(manifest_path, worker_id, n_records):
+    for i in range(n_records):
+        local = manifest.LocalManifest(manifest_path, compact_every=7)
+        local.load()
+        local.add_record('an_asset', worker=worker_id, i=i)
+        local.save()
+
+
+def test_saves_merge_records_from_other_writers(tmpdir):
+    path = str(tmpdir / 'manifest.json')
+    first = manifest.LocalManifest(path)
+    second = manifest.LocalManifest(path)
+    first.load()
+    second.load()
+
+    first.add_record('an_asset', writer='first')
+    first.save()
+    second.add_record('an_asset', writer='second')
+    second.save()
+
+    # The second writer picked up the first record when saving, rather than silently dropping it
+    assert second.locate('an_asset', writer='first')
+    third = manifest.LocalManifest(path)
+    third.load()
+    assert len(third._items) == 2
+
+
+def test_new_records_are_journaled_then_compacted(tmpdir):
+    path = str(tmpdir / 'manifest.json')
+    local = manifest.LocalManifest(path, compact_every=3)
+    local.load()
+    for i in range(2):
+        local.add_record('an_asset', i=i)
+        local.save()
+
+    with open(path) as f:
+        assert json.load(f)['items'] == []
+    reloaded = manifest.LocalManifest(path)
+    reloaded.load()
+    assert len(reloaded._items) == 2
+
+    local.add_record('an_asset', i=2)
+    local.save()
+    with open(path) as f:
+        assert len(json.load(f)['items']) == 3
+    assert os.path.getsize(local._journal_path) == 0
+
+
+def test_refresh_picks_up_records_saved_elsewhere(tmpdir):
+    path = str(tmpdir / 'manifest.json')
+    reader = manifest.LocalManifest(path)
+    reader.load()
+
+    writer = manifest.LocalManifest(path)
+    writer.load()
+    writer.add_record('an_asset')
+    writer.save()
+
+    assert reader.locate('an_asset', err_on_missing=False) is None
+    reader.refresh()
+    assert reader.locate('an_asset')
+
+
+def test_removed_records_are_journaled(tmpdir):
+    path = str(tmpdir / 'manifest.json')
+    local = manifest.LocalManifest(path)
+    local.load()
+    local.add_record('an_asset', i=0)
+    local.add_record('an_asset', i=1)
+    local.save()
+
+    local.remove_record(local.locate('an_asset', i=0))
+    local.save()
+
+    reloaded = manifest.LocalManifest(path)
+    reloaded.load()
+    assert [record['i'] for record in reloaded._items] == [1]
+
+
+def test_remove_records_updates_index_in_place(tmpdir):
+    path = str(tmpdir / 'manifest.json')
+    local = manifest.LocalManifest(path)
+    local.load()
+    for i in range(5):
+        local.add_record('an_asset', i=i, build='b{}'.format(i % 2), date='2020-01-0{}'.format(i + 1),
+                         _sha256='sha{}'.format(i % 2), _path='file{}'.format(i % 2))
+    local.save()
+
+    reader = manifest.LocalManifest(path)
+    reader.load()
+
+    newest = [local.locate('an_asset', i=i) for i in (3, 4)]
+    with mock.patch.object(local, '_reindex') as reindex:
+        local.remove_records(newest)
+    assert not reindex.called
+    assert local.locate('an_asset')['i'] == 2
+    assert local.locate('an_asset', build='b1')['i'] == 1
+    assert local.locate('an_asset', i=4, err_on_missing=False) is None
+    assert [record['i'] for record in local.find_by_sha256('sha0')] == [0, 2]
+    local.save()
+
+    # Other processes apply the same removals from the journal
+    with mock.patch.object(reader, '_reindex') as reindex:
+        reader.refresh()
+    assert not reindex.called
+    assert [record['i'] for record in reader._items] == [0, 1, 2]
+    assert reader.locate('an_asset')['i'] == 2
+
+
+def test_local_manifest_can_be_read_without_write_access(tmpdir):
+    path = str(tmpdir / 'manifest.json')
+    writer = manifest.LocalManifest(path)
+    writer.load()
+    writer.add_record('an_asset')
+    writer.save()
+
+    # Eg a system-wide cache, read by a service that runs as another user
+    real_open = os.open
+
+    def read_only_open(file, flags, *args, **kwargs):
+        if str(file).startswith(str(tmpdir)) and flags & (os.O_WRONLY | os.O_RDWR | os.O_CREAT):
+            raise PermissionError(13, 'Permission denied', file)
+        return real_open(file, flags, *args, **kwargs)
+
+    with mock.patch.object(os, 'open', side_effect=read_only_open):
+        reader = manifest.LocalManifest(path)
+        reader.load()
+        assert reader.locate('an_asset')
+        reader.refresh()
+
+        os.remove(writer._lock_path)
+        reader.refresh()
+        assert reader.locate('an_asset')
+
+
+def test_shared_manifest_is_read_only(tmpdir):
+    path = str(tmpdir / 'manifest.json')
+    with pytest.raises(exceptions.ManifestNotFound):
+        manifest.SharedManifest(path).load()
+
+    writer = manifest.LocalManifest(path)
+    writer.load()
+    writer.add_record('an_asset')
+    writer.save()
+
+    shared = manifest.SharedManifest(path)
+    shared.load()
+    assert shared.locate('an_asset')
+    with pytest.raises(exceptions.ImmutableManifestError):
+        shared.add_record('another_asset')
+
+    writer.add_record('another_asset')
+    writer.save()
+    shared.refresh()
+    assert shared.locate('another_asset')
+
+
+def test_concurrent_processes_do_not_lose_records(tmpdir):
+    path = str(tmpdir / 'manifest.json')
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=_add_records_in_process, args=(path, worker_id, 10)) for worker_id in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    local = manifest.LocalManifest(path)
+    local.load()
+    assert len(local._items) == 40
+
+
+# Caching the remote manifest
+def test_remote_manifest_is_cached_and_revalidated(tmpdir, http_server):
+    url = http_server.url + 'manifest.json'
+    cache_dir = str(tmpdir.mkdir('cache'))
+
+    first = manifest.RemoteManifest(url, cache_dir=cache_dir, ttl=3600)
+    first.load()
+    assert len(first._items) == 3  # Served with gzip encoding
+
+    # A fresh copy is used without contacting the server
+    second = manifest.RemoteManifest(url, cache_dir=cache_dir, ttl=3600)
+    second.load()
+    assert len(second._items) == 3
+    assert len(http_server.requests) == 1
+
+    # An expired copy is revalidated with a conditional request
+    third = manifest.RemoteManifest(url, cache_dir=cache_dir, ttl=0)
+    third.load()
+    assert len(third._items) == 3
+    assert len(http_server.requests) == 2
+
+
+def test_remote_manifest_is_fetched_by_one_thread_at_a_time(http_server):
+    remote = manifest.RemoteManifest(http_server.url + 'manifest.json', ttl=0)
+    real_fetch = remote._fetch
+    release = threading.Event()
+
+    def slow_fetch():
+        release.wait(10)
+        return real_fetch()
+
+    def run_threads(target) -> ty.List[threading.Thread]:
+        threads = [threading.Thread(target=target) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    with mock.patch.object(remote, '_fetch', side_effect=slow_fetch) as fetch:
+        # Every thread needs the manifest to be loaded, but it is only requested once
+        threads = run_threads(remote.load)
+        release.set()
+        for thread in threads:
+            thread.join()
+        assert fetch.call_count == 1
+
+        # Threads that find a refresh in progress don't wait for it, and keep using the current contents
+        release.clear()
+        threads = run_threads(remote.refresh)
+        deadline = time.monotonic() + 10
+        while sum(thread.is_alive() for thread in threads) > 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert remote.locate('first_file')
+        release.set()
+        for thread in threads:
+            thread.join()
+        assert fetch.call_count == 2
+    assert len(remote._items) == 3
+
+
+def test_cached_remote_manifest_is_used_when_offline(tmpdir, http_server):
+    url = http_server.url + 'manifest.json'
+    cache_dir = str(tmpdir.mkdir('cache'))
+    manifest.RemoteManifest(url, cache_dir=cache_dir).load()
+
+    http_server.shutdown()
+    http_server.server_close()
+    # (New connections only: an open keep-alive connection would still be served)
+    offline = manifest.RemoteManifest(url, cache_dir=cache_dir, ttl=0, transport=transfer.Transport())
+    offline.load()
+    assert len(offline._items) == 3
+
+    with pytest.raises(exceptions.ManifestNotFound):
+        manifest.RemoteManifest(url, transport=transfer.Transport()).load()
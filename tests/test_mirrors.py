@@ -0,0 +1,104 @@
+"""
+Test mirror selection and failover
+"""
+import os
+import shutil
+import time
+from unittest import mock
+
+import pytest
+
+from filefetcher import exceptions, manager, mirrors, transfer
+
+
+def test_mirrors_are_ranked_by_speed_and_failures():
+    mirror_set = mirrors.MirrorSet(['http://a/', 'http://b/', 'http://c/'])
+    mirror_set._probed = True
+    assert mirror_set.ranked() == ['http://a/', 'http://b/', 'http://c/']  # Configured order, until measured
+
+    mirror_set.record('http://a/', 0.5)
+    mirror_set.record('http://b/', 0.1)
+    mirror_set.record('http://c/', 0.2)
+    assert mirror_set.ranked() == ['http://b/', 'http://c/', 'http://a/']
+
+    mirror_set.record_failure('http://b/')
+    assert mirror_set.ranked() == ['http://c/', 'http://a/', 'http://b/']
+
+
+def test_call_fails_over_to_next_mirror():
+    mirror_set = mirrors.MirrorSet(['http://a/', 'http://b/'])
+    mirror_set._probed = True
+
+    def func(url):
+        if url == 'http://a/':
+            raise exceptions.DownloadError
+        return 'from b'
+
+    assert mirror_set.call(func) == ('http://b/', 'from b')
+    assert mirror_set.ranked()[0] == 'http://b/'
+
+    with pytest.raises(exceptions.DownloadError):
+        mirror_set.call(lambda url: func('http://a/'))
+
+
+def test_slow_mirror_is_hedged():
+    mirror_set = mirrors.MirrorSet(['http://slow/', 'http://fast/'])
+    mirror_set._probed = True
+
+    def func(url):
+        if url == 'http://slow/':
+            time.sleep(1)
+        return url
+
+    start = time.monotonic()
+    assert mirror_set.call(func, hedge_delay=0.05) == ('http://fast/', 'http://fast/')
+    assert time.monotonic() - start < 0.5
+
+
+def test_manager_downloads_from_working_mirror(tmpdir, remote_folder):
+    asset_manager = manager.AssetManager(
+        'mypackage',
+        ['file://{}'.format(tmpdir / 'offline' / 'manifest.json'), 'file://{}'.format(remote_folder / 'manifest.json')],
+        local_manifest=str(tmpdir / 'local' / 'manifest.json'),
+        hedge_delay=0.05,
+    )
+    record = asset_manager.download('first_file', genome_build='GRCh37')
+    assert asset_manager.locate('first_file') == asset_manager._local.get_path(record)
+
+
+def test_manager_hedges_slow_transfer_and_cancels_the_loser(tmpdir, remote_folder):
+    slow_folder = tmpdir / 'slow'
+    shutil.copytree(str(remote_folder), str(slow_folder))
+    asset_manager = manager.AssetManager(
+        'mypackage',
+        ['file://{}'.format(slow_folder / 'manifest.json'), 'file://{}'.format(remote_folder / 'manifest.json')],
+        local_manifest=str(tmpdir / 'local' / 'manifest.json'),
+        hedge_delay=0.05,
+    )
+    asset_manager._remote.mirrors._probed = True
+    fetch_file = transfer.fetch_file
+    cancelled = []
+
+    def slow_fetch_file(url, dest, sha256, cancel=None, **kwargs):
+        if url.startswith('file://{}'.format(slow_folder)):
+            # Stalls until the other mirror has delivered the file
+            assert cancel.wait(5)
+            cancelled.append(dest)
+            raise transfer.TransferCancelled
+        return fetch_file(url, dest, sha256, cancel=cancel, **kwargs)
+
+    with mock.patch.object(transfer, 'fetch_file', side_effect=slow_fetch_file), \
+            mock.patch.object(mirrors, 'fetch_first_byte') as probe:
+        start = time.monotonic()
+        record = asset_manager.download('first_file', genome_build='GRCh37')
+        assert time.monotonic() - start < 2
+        path = asset_manager._local.get_path(record)
+        # The transfer itself is hedged, without a separate probe request first
+        assert not probe.called
+        for _ in range(100):
+            if cancelled:
+                break
+            time.sleep(0.01)
+    assert cancelled == [path]
+    assert os.path.isfile(path)
+    assert not [fn for fn in os.listdir(os.path.dirname(path)) if fn.endswith(('.part', '.hedge'))]
@@ -0,0 +1,35 @@
+"""
+Test loading lists of required assets
+"""
+import pytest
+
+from filefetcher import exceptions, requirements
+
+
+def test_parse_accepts_queries_and_pairs():
+    queries = requirements.parse([{'_type': 'snp_to_rsid', 'genome_build': 'GRCh38'}, ('gene_list', {'build': 1})])
+    assert queries == [{'_type': 'snp_to_rsid', 'genome_build': 'GRCh38'}, {'_type': 'gene_list', 'build': 1}]
+
+    with pytest.raises(exceptions.InvalidRequirements):
+        requirements.parse([{'genome_build': 'GRCh38'}])
+
+
+def test_load_json_list(tmpdir):
+    path = tmpdir / 'requirements.json'
+    path.write_text('[{"_type": "snp_to_rsid", "genome_build": "GRCh38"}]', 'utf-8')
+    assert requirements.load(str(path)) == [{'_type': 'snp_to_rsid', 'genome_build': 'GRCh38'}]
+
+
+@pytest.mark.skipif(requirements.tomllib is None, reason='No TOML parser available')
+def test_load_toml_tables(tmpdir):
+    path = tmpdir / 'requirements.toml'
+    path.write_text('[[assets]]\n_type = "snp_to_rsid"\ngenome_build = "GRCh38"\n\n[[assets]]\n_type = "gene_list"\n',
+                    'utf-8')
+    assert requirements.load(str(path)) == [{'_type': 'snp_to_rsid', 'genome_build': 'GRCh38'}, {'_type': 'gene_list'}]
+
+
+def test_load_reports_malformed_file(tmpdir):
+    path = tmpdir / 'requirements.json'
+    path.write_text('{"_type": "snp_to_rsid"}', 'utf-8')
+    with pytest.raises(exceptions.InvalidRequirements):
+        requirements.load(str(path))
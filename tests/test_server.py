@@ -0,0 +1,80 @@
+"""
+Test serving a local cache over HTTP
+"""
+import http.client
+import threading
+from unittest import mock
+
+import pytest
+
+from filefetcher import exceptions, manager, server
+
+
+@pytest.fixture
+def peer(tmpdir, remote_folder):
+    """A warm cache, published over HTTP"""
+    warm_manager = manager.AssetManager('mypackage', 'file://{}'.format(remote_folder / 'manifest.json'),
+                                        local_manifest=str(tmpdir / 'warm' / 'manifest.json'))
+    warm_manager.download('first_file', genome_build='GRCh37')
+
+    httpd = server.serve(warm_manager._local, port=0)
+    thread = threading.Thread(target=httpd.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _get(url: str, path: str, headers: dict = None) -> http.client.HTTPResponse:
+    host, port = url[len('http://'):].rstrip('/').split(':')
+    conn = http.client.HTTPConnection(host, int(port), timeout=5)
+    conn.request('GET', path, headers=headers or {})
+    return conn.getresponse()
+
+
+def test_peer_can_be_used_as_remote(tmpdir, peer):
+    cold_manager = manager.AssetManager('mypackage', peer.url + 'manifest.json',
+                                        local_manifest=str(tmpdir / 'cold' / 'manifest.json'))
+    record = cold_manager.download('first_file', genome_build='GRCh37')
+    with open(cold_manager._local.get_path(record), 'rb') as f:
+        assert f.read() == b'The first asset'
+
+    # Only assets that are in the cache can be downloaded
+    with pytest.raises(exceptions.NoMatchingAsset):
+        cold_manager.download('second_file', genome_build='GRCh37')
+
+
+def test_serves_ranges_and_etags(peer):
+    record = peer.local.locate('first_file')
+    path = '/' + record['_path']
+
+    response = _get(peer.url, path, {'Range': 'bytes=4-'})
+    assert response.status == 206
+    assert response.getheader('Content-Range') == 'bytes 4-14/15'
+    assert response.read() == b'first asset'
+
+    assert _get(peer.url, path, {'Range': 'bytes=-5'}).read() == b'asset'
+    assert _get(peer.url, path, {'Range': 'bytes=50-'}).status == 416
+    assert _get(peer.url, path, {'If-None-Match': '"{}"'.format(record['_sha256'])}).status == 304
+
+    # Files in the cache folder that are not listed in the manifest are not published
+    assert _get(peer.url, '/manifest.json.lock').status == 404
+    assert _get(peer.url, '/../warm/manifest.json').status == 404
+
+
+def test_manifest_is_rebuilt_only_when_cache_changes(remote_folder, peer):
+    etag = _get(peer.url, '/manifest.json').getheader('ETag')
+
+    peer.refresh_interval = 0
+    with mock.patch.object(peer.local, '_serialize', wraps=peer.local._serialize) as serialize:
+        assert _get(peer.url, '/manifest.json').getheader('ETag') == etag
+        assert serialize.call_count == 0
+
+        # Another process adds an asset to the same cache
+        other_manager = manager.AssetManager('mypackage', 'file://{}'.format(remote_folder / 'manifest.json'),
+                                             local_manifest=peer.local._manifest_path)
+        other_manager.download('second_file', genome_build='GRCh37')
+        response = _get(peer.url, '/manifest.json')
+        assert response.getheader('ETag') != etag
+        assert b'second_file' in response.read()
+        assert serialize.call_count == 1
@@ -0,0 +1,159 @@
+"""
+Test file transfer helpers
+"""
+import hashlib
+import os
+import threading
+import urllib.error
+from unittest import mock
+
+import pytest
+
+from filefetcher import exceptions, transfer
+
+
+@pytest.fixture
+def source_file(tmpdir):
+    path = tmpdir.mkdir('remote') / 'asset.txt'
+    path.write_binary(b'Some asset contents' * 1000)
+    return path
+
+
+def test_fetch_file_publishes_validated_file(tmpdir, source_file):
+    sha = hashlib.sha256(source_file.read_binary()).hexdigest()
+    dest = str(tmpdir / 'asset.txt')
+
+    result = transfer.fetch_file('file://{}'.format(source_file), dest, sha, chunk_size=1024)
+    assert result.n_bytes == source_file.size()
+    assert os.path.isfile(dest)
+    assert not os.path.exists(transfer.get_part_path(dest))
+
+
+def test_fetch_file_never_exposes_corrupt_file(tmpdir, source_file):
+    dest = str(tmpdir / 'asset.txt')
+    with pytest.raises(exceptions.IntegrityError):
+        transfer.fetch_file('file://{}'.format(source_file), dest, 'wronghash')
+
+    assert not os.path.exists(dest)
+    assert not os.path.exists(transfer.get_part_path(dest))
+
+
+def test_fetch_file_reports_unreachable_source(tmpdir):
+    with pytest.raises(exceptions.DownloadError):
+        transfer.fetch_file('file://{}'.format(tmpdir / 'missing.txt'), str(tmpdir / 'asset.txt'), 'anyhash',
+                            retries=0)
+
+
+def test_cancelled_transfer_discards_part_file(tmpdir, source_file):
+    sha = hashlib.sha256(source_file.read_binary()).hexdigest()
+    dest = str(tmpdir / 'asset.txt')
+    cancel = threading.Event()
+    cancel.set()
+
+    with pytest.raises(transfer.TransferCancelled):
+        transfer.fetch_file('file://{}'.format(source_file), dest, sha, cancel=cancel)
+    assert not os.path.exists(dest)
+    assert not os.path.exists(transfer.get_part_path(dest))
+
+
+# Resuming interrupted downloads over HTTP
+@pytest.fixture
+def remote_asset(remote_folder):
+    """The name and hash of a file available from the HTTP test server"""
+    name = next(fn for fn in os.listdir(str(remote_folder)) if fn.endswith('first_file.txt'))
+    return name, name.split('_')[0]
+
+
+def test_interrupted_download_keeps_part_file_and_resumes(tmpdir, http_server, remote_asset):
+    name, sha = remote_asset
+    url = http_server.url + name
+    dest = str(tmpdir / name)
+
+    http_server.fail_after = 5
+    with pytest.raises(exceptions.DownloadError):
+        transfer.fetch_file(url, dest, sha, retries=0)
+    assert os.path.getsize(transfer.get_part_path(dest)) == 5
+
+    result = transfer.fetch_file(url, dest, sha, retries=0)
+    assert result.n_resumed == 5
+    assert result.n_bytes == os.path.getsize(dest) - 5
+    assert not os.path.exists(transfer.get_part_path(dest))
+
+
+def test_dropped_connection_is_retried_with_range_request(tmpdir, http_server, remote_asset):
+    name, sha = remote_asset
+    http_server.fail_after = 3
+
+    result = transfer.fetch_file(http_server.url + name, str(tmpdir / name), sha, retries=2, backoff=0)
+    assert result.n_retries == 1
+    assert result.n_resumed == 3
+
+
+def test_bad_partial_data_is_discarded_and_restarted(tmpdir, http_server, remote_asset):
+    name, sha = remote_asset
+    dest = str(tmpdir / name)
+    with open(transfer.get_part_path(dest), 'wb') as f:
+        f.write(b'garbage')
+
+    result = transfer.fetch_file(http_server.url + name, dest, sha, retries=0)
+    assert result.n_resumed == 0
+
+
+def test_parse_content_range():
+    assert transfer.parse_content_range('bytes 7-14/15') == 7
+    assert transfer.parse_content_range('bytes */15') is None
+    assert transfer.parse_content_range(None) is None
+
+
+# Segmented downloads
+def test_segmented_download_assembles_file_from_ranges(tmpdir, remote_folder, http_server, remote_asset):
+    name, sha = remote_asset
+    dest = str(tmpdir / name)
+    size = (remote_folder / name).size()
+
+    result = transfer.fetch_file_segmented(http_server.url + name, dest, sha, size, 4)
+    assert result.n_bytes == size
+    with open(dest, 'rb') as f:
+        assert f.read() == b'The first asset'
+
+
+def test_segmented_download_falls_back_without_range_support(tmpdir, source_file):
+    sha = hashlib.sha256(source_file.read_binary()).hexdigest()
+    dest = str(tmpdir / 'asset.txt')
+
+    result = transfer.fetch_file_segmented('file://{}'.format(source_file), dest, sha, source_file.size(), 4)
+    assert result.n_bytes == source_file.size()
+    assert not os.path.exists(transfer.get_part_path(dest))
+
+
+# Connection pooling
+def test_connections_are_reused(tmpdir, http_server, remote_asset):
+    name, sha = remote_asset
+    transport = transfer.Transport(pool_size=2)
+    for i in range(3):
+        transfer.fetch_file(http_server.url + name, str(tmpdir / '{}_{}'.format(i, name)), sha, transport=transport)
+    assert transport.n_connects == 1
+
+
+def test_redirects_are_followed(tmpdir, http_server, remote_asset):
+    name, sha = remote_asset
+    transport = transfer.Transport()
+    result = transfer.fetch_file(http_server.url + 'redirect/' + name, str(tmpdir / name), sha, transport=transport)
+    assert result.n_bytes == 15
+    assert http_server.requests == ['/redirect/' + name, '/' + name]
+    assert transport.n_connects == 1
+
+
+def test_error_responses_raise_http_errors(http_server):
+    transport = transfer.Transport()
+    with pytest.raises(urllib.error.HTTPError) as e:
+        transport.open(http_server.url + 'missing.txt')
+    assert e.value.code == 404
+
+
+def test_local_errors_are_not_retried(tmpdir, http_server, remote_asset):
+    name, sha = remote_asset
+    with mock.patch.object(transfer, '_stream_to_part', side_effect=PermissionError('read-only cache')) as stream:
+        with pytest.raises(PermissionError):
+            transfer.fetch_file(http_server.url + name, str(tmpdir / name), sha, retries=3, backoff=0)
+    assert stream.call_count == 1
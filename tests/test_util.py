@@ -0,0 +1,57 @@
+"""
+Test utility functions
+"""
+import hashlib
+import os
+from unittest import mock
+
+import pytest
+
+from filefetcher import util
+
+
+@pytest.fixture
+def source_file(tmpdir):
+    path = tmpdir / 'source.txt'
+    path.write_binary(b'Some file contents' * 1000)
+    return str(path)
+
+
+@pytest.fixture
+def no_reflink():
+    """Most test filesystems do not support reflinks anyway, but make sure that the other strategies are tested"""
+    with mock.patch.object(util, '_reflink', side_effect=OSError):
+        yield
+
+
+def test_copy_hashes_and_copies_in_one_pass(tmpdir, source_file, no_reflink):
+    dest = str(tmpdir / 'dest.txt')
+    with mock.patch.object(util, 'get_file_sha256') as get_file_sha256:
+        sha = util.copy_file_hashed(source_file, dest)
+
+    assert get_file_sha256.call_count == 0
+    assert sha == util.get_file_sha256(source_file)
+    with open(dest, 'rb') as f:
+        assert hashlib.sha256(f.read()).hexdigest() == sha
+
+
+def test_copy_with_known_hash_uses_kernel_copy(tmpdir, source_file, no_reflink):
+    dest = str(tmpdir / 'dest.txt')
+    with mock.patch.object(util, '_kernel_copy', wraps=util._kernel_copy) as kernel_copy:
+        util.copy_file_hashed(source_file, dest, sha256='known')
+    assert kernel_copy.call_count == 1
+    assert util.get_file_sha256(dest) == util.get_file_sha256(source_file)
+
+
+def test_copy_can_hardlink_when_allowed(tmpdir, source_file):
+    dest = str(tmpdir / 'dest.txt')
+    util.copy_file_hashed(source_file, dest, allow_link=True)
+    assert os.stat(dest).st_ino == os.stat(source_file).st_ino
+
+
+def test_hashing_writer_matches_file_hash(tmpdir):
+    path = str(tmpdir / 'written.txt')
+    with util.HashingWriter(path) as f:
+        f.write(b'abc')
+        f.write(b'def')
+    assert f.hexdigest() == util.get_file_sha256(path)